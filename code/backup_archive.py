@@ -0,0 +1,459 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+
+import config
+from utils import write_file_atomically
+
+try:
+    import fcntl
+except ImportError:  # Windows: compactions must not run at the same time
+    fcntl = None
+
+
+# Compressed, deduplicated archive of interview backups. Live sessions append to
+# their backup log in `BACKUPS_DIRECTORY` (see transcript_log.py) and write the
+# backup transcript and time files when they end. Every restart or abandoned
+# attempt leaves another set of files, each repeating the system prompt and the
+# opening messages. `python backup_archive.py compact` moves sessions which have
+# not been written for `BACKUP_ARCHIVE_AFTER_HOURS` into `BACKUPS_DIRECTORY/archive`
+# (which has to be longer than `SESSION_RESTORE_HOURS`, so that sessions which may
+# still be restored for a returning respondent stay loose):
+#
+# - chunks-{generation}.pack: backup files, each compressed as a whole and stored
+#   once, identified by the SHA-256 of their contents (index in chunks-{generation}.idx)
+# - sessions.json.gz: per session and file, the reference to its chunk; a backup
+#   transcript which is the rendering of the session's log is stored as just that
+#
+# The system prompt of a session's log is stored as a chunk of its own and used as
+# preset dictionary when compressing the session's files, so that the prompt every
+# session repeats is stored once while each file is still compressed in one piece
+# (compressing messages separately made the archive larger than the loose files).
+#
+# Compaction also applies the retention policy: backups of usernames whose final
+# interview was stored more than `BACKUP_RETENTION_DAYS` ago are dropped, and the
+# pack is rewritten without unreferenced chunks. `python backup_archive.py restore`
+# rebuilds the files of any session (or the log up to a message). Loose files are
+# only deleted after their archived copy has been restored and compared.
+
+BACKUP_FILE = re.compile(
+    r"^(?P<username>.+)_(?P<kind>log|transcript|time)_started_(?P<session>\d{4}(?:_\d{2}){5})\.(?:jsonl|txt)$"
+)
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def rendered_transcript(records):
+    """Backup transcript of a log's records (without the system prompt or first message)."""
+    return "".join(f"{record['role']}: {record['content']}\n" for record in records[1:] if "role" in record)
+
+
+class BackupArchive:
+    """Content-addressed archive of the backup sessions in a directory."""
+
+    def __init__(self, backups_directory=None):
+        self.backups_directory = backups_directory or config.BACKUPS_DIRECTORY
+        self.directory = os.path.join(self.backups_directory, "archive")
+        self.sessions_path = os.path.join(self.directory, "sessions.json.gz")
+        self.generation = 0
+        self.sessions = {}  # (username, session) -> {file name: file entry}
+        self.index = {}  # chunk hash -> (offset, length)
+        self.load()
+
+    def pack_path(self, generation=None):
+        return os.path.join(self.directory, f"chunks-{self.generation if generation is None else generation}.pack")
+
+    def index_path(self, generation=None):
+        return os.path.join(self.directory, f"chunks-{self.generation if generation is None else generation}.idx")
+
+    def load(self):
+        """Read the session entries and chunk index (an empty archive if there is none)."""
+        self.sessions = {}
+        self.index = {}
+        if not os.path.exists(self.sessions_path):
+            return
+        with gzip.open(self.sessions_path, "rt") as f:
+            archive = json.load(f)
+        self.generation = archive["generation"]
+        for entry in archive["sessions"]:
+            self.sessions[(entry["username"], entry["session"])] = entry["files"]
+        if os.path.exists(self.index_path()):
+            with open(self.index_path(), "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Chunks appended by an interrupted compaction are not referenced
+                        break
+                    chunk, offset, length = entry[:3]
+                    self.index[chunk] = (offset, length, entry[3] if len(entry) > 3 else None)
+
+    def save(self):
+        """Store the session entries; this commits all chunks appended before."""
+        os.makedirs(self.directory, exist_ok=True)
+        archive = {
+            "generation": self.generation,
+            "sessions": [
+                {"username": username, "session": session, "files": files}
+                for (username, session), files in sorted(self.sessions.items())
+            ],
+        }
+        temporary_path = self.sessions_path + ".tmp"
+        with gzip.open(temporary_path, "wt") as f:
+            json.dump(archive, f)
+        os.replace(temporary_path, self.sessions_path)
+
+    # Chunks
+
+    def put_chunks(self, chunks, dictionary=None):
+        """Append the chunks (bytes) which are not stored yet to the pack, compressed with the
+        contents of the chunk `dictionary` (a hash) as preset dictionary if given; return their hashes."""
+        os.makedirs(self.directory, exist_ok=True)
+        zdict = self.get_chunks([dictionary])[0] if dictionary else None
+        hashes = []
+        new_chunks = {}
+        for data in chunks:
+            chunk = chunk_hash(data)
+            hashes.append(chunk)
+            if chunk not in self.index and chunk not in new_chunks:
+                compressor = zlib.compressobj(9, zdict=zdict) if zdict else zlib.compressobj(9)
+                new_chunks[chunk] = compressor.compress(data) + compressor.flush()
+        if not new_chunks:
+            return hashes
+
+        with open(self.pack_path(), "ab") as pack:
+            offset = pack.tell()
+            entries = []
+            for chunk, compressed in new_chunks.items():
+                pack.write(compressed)
+                entries.append([chunk, offset, len(compressed)] + ([dictionary] if dictionary else []))
+                offset += len(compressed)
+            pack.flush()
+            os.fsync(pack.fileno())
+        # The index only lists chunks once they are durably in the pack
+        with open(self.index_path(), "a") as index:
+            index.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            index.flush()
+            os.fsync(index.fileno())
+        for chunk, offset, length, *_ in entries:
+            self.index[chunk] = (offset, length, dictionary)
+        return hashes
+
+    def get_chunks(self, hashes):
+        """Contents (bytes) of chunks."""
+        chunks = []
+        if not hashes:
+            return chunks
+        dictionaries = {}
+        with open(self.pack_path(), "rb") as pack:
+            for chunk in hashes:
+                offset, length, dictionary = self.index[chunk]
+                if dictionary and dictionary not in dictionaries:
+                    dictionaries[dictionary] = self.get_chunks([dictionary])[0]
+                pack.seek(offset)
+                decompressor = zlib.decompressobj(zdict=dictionaries[dictionary]) if dictionary else zlib.decompressobj()
+                chunks.append(decompressor.decompress(pack.read(length)) + decompressor.flush())
+        return chunks
+
+    # Sessions
+
+    def archive_session(self, username, session, paths):
+        """Add the backup files of a session ({kind: path}) to the archive."""
+        files = {}
+        records = None
+        dictionary = None
+        if "log" in paths:
+            with open(paths["log"], "rb") as f:
+                data = f.read()
+            records = []
+            size = 0
+            for line in data.splitlines(keepends=True):
+                try:
+                    # Last line is incomplete if the process was stopped while writing it
+                    if not line.endswith(b"\n"):
+                        break
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+                size += len(line)
+            if records and records[0].get("role") == "system":
+                dictionary = self.put_chunks([records[0]["content"].encode()])[0]
+            files[os.path.basename(paths["log"])] = {
+                "type": "log",
+                "chunk": self.put_chunks([data[:size]], dictionary)[0],
+            }
+
+        for kind in ("transcript", "time"):
+            if kind not in paths:
+                continue
+            with open(paths[kind], "rb") as f:
+                data = f.read()
+            name = os.path.basename(paths[kind])
+            if kind == "transcript" and records is not None and rendered_transcript(records).encode() == data:
+                files[name] = {"type": "rendered", "log": os.path.basename(paths["log"])}
+            else:
+                files[name] = {"type": "text", "chunk": self.put_chunks([data], dictionary)[0]}
+
+        # Sessions archived before (e.g. restored for inspection) are replaced
+        self.sessions[(username, session)] = files
+
+    def session_files(self, username, session, messages=None):
+        """Restored contents of a session's files {file name: text}; with `messages`, the log
+        only up to that many messages and the transcript rendered from it."""
+        files = self.sessions[(username, session)]
+        restored = {}
+        logs = {}
+        for name, entry in files.items():
+            if entry["type"] == "log" and "chunk" in entry:
+                lines = self.get_chunks([entry["chunk"]])[0].decode().splitlines(keepends=True)
+                lines = lines[:messages] if messages is not None else lines
+                logs[name] = [json.loads(line) for line in lines]
+                restored[name] = "".join(lines)
+            elif entry["type"] == "log":
+                # Archives compacted before whole files were compressed store each message
+                records = entry["records"][:messages] if messages is not None else entry["records"]
+                contents = self.get_chunks([record["content_chunk"] for record in records])
+                logs[name] = []
+                for record, content in zip(records, contents):
+                    # Keys in the order in which log_record writes them
+                    restored_record = {"role": record["role"]} if "role" in record else {}
+                    restored_record["content"] = content.decode()
+                    restored_record.update(
+                        (key, value) for key, value in record.items() if key not in ("role", "content_chunk")
+                    )
+                    logs[name].append(restored_record)
+                restored[name] = "".join(json.dumps(record) + "\n" for record in logs[name])
+        for name, entry in files.items():
+            if entry["type"] == "rendered":
+                restored[name] = rendered_transcript(logs[entry["log"]])
+            elif entry["type"] == "text":
+                restored[name] = b"".join(self.get_chunks(entry.get("chunks") or [entry["chunk"]])).decode()
+        return restored
+
+    def load_messages(self, username, session):
+        """Messages of a session's archived log (empty if it is not archived)."""
+        if (username, session) not in self.sessions:
+            return []
+        for name, text in self.session_files(username, session).items():
+            if name.endswith(".jsonl"):
+                return [
+                    {"role": record["role"], "content": record["content"]}
+                    for record in map(json.loads, text.splitlines())
+                    if "role" in record
+                ]
+        return []
+
+    def drop_session(self, username, session):
+        self.sessions.pop((username, session), None)
+
+    def referenced_chunks(self):
+        chunks = set()
+        for files in self.sessions.values():
+            for entry in files.values():
+                if "chunk" in entry:
+                    chunks.add(entry["chunk"])
+                elif entry["type"] == "log":
+                    chunks.update(record["content_chunk"] for record in entry["records"])
+                elif entry["type"] == "text":
+                    chunks.update(entry["chunks"])
+        # Preset dictionaries of the chunks
+        return chunks | {self.index[chunk][2] for chunk in chunks if self.index[chunk][2]}
+
+    def rewrite_pack(self):
+        """Write a new pack generation with only the referenced chunks; return the bytes freed."""
+        referenced = self.referenced_chunks()
+        unreferenced = [chunk for chunk in self.index if chunk not in referenced]
+        if not unreferenced:
+            return 0
+        freed = sum(self.index[chunk][1] for chunk in unreferenced)
+        old_generation = self.generation
+        old_index = self.index
+        # Dictionaries are written before the chunks compressed with them
+        chunks = sorted(referenced, key=lambda chunk: (old_index[chunk][2] is not None, old_index[chunk][0]))
+        contents = self.get_chunks(chunks)
+
+        self.generation += 1
+        self.index = {}
+        for path in (self.pack_path(), self.index_path()):
+            if os.path.exists(path):
+                os.remove(path)
+        by_dictionary = {}
+        for chunk, data in zip(chunks, contents):
+            by_dictionary.setdefault(old_index[chunk][2], []).append(data)
+        for dictionary, data in by_dictionary.items():
+            self.put_chunks(data, dictionary)
+        # The new generation is used from here on; then the old one can go
+        self.save()
+        for path in (self.pack_path(old_generation), self.index_path(old_generation)):
+            if os.path.exists(path):
+                os.remove(path)
+        return freed
+
+    def size(self):
+        """Bytes used by the archive."""
+        if not os.path.isdir(self.directory):
+            return 0
+        with os.scandir(self.directory) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.is_file())
+
+
+def loose_sessions(backups_directory):
+    """Backup files in the directory by session: {(username, session): {kind: path}}."""
+    sessions = {}
+    for name in os.listdir(backups_directory):
+        match = BACKUP_FILE.match(name)
+        if match:
+            key = (match.group("username"), match.group("session"))
+            sessions.setdefault(key, {})[match.group("kind")] = os.path.join(backups_directory, name)
+    return sessions
+
+
+def finalised_before(completions_directory, cutoff):
+    """Usernames whose final interview was stored before a time."""
+    usernames = set()
+    if not os.path.isdir(completions_directory):
+        return usernames
+    for name in os.listdir(completions_directory):
+        if not name.endswith(".json") or name.startswith("."):
+            continue
+        try:
+            with open(os.path.join(completions_directory, name), "r") as f:
+                completed_at = json.load(f).get("completed_at")
+        except (OSError, ValueError):
+            continue
+        if completed_at is not None and completed_at < cutoff:
+            usernames.add(name[: -len(".json")])
+    return usernames
+
+
+def compact(backups_directory=None, completions_directory=None, archive_after_hours=None, retention_days=None):
+    """Archive idle backup sessions, apply the retention policy and drop unreferenced chunks;
+    return statistics of the run."""
+    backups_directory = backups_directory or config.BACKUPS_DIRECTORY
+    completions_directory = completions_directory or config.COMPLETIONS_DIRECTORY
+    archive_after_hours = config.BACKUP_ARCHIVE_AFTER_HOURS if archive_after_hours is None else archive_after_hours
+    retention_days = config.BACKUP_RETENTION_DAYS if retention_days is None else retention_days
+    if config.RESTORE_SESSIONS and archive_after_hours <= config.SESSION_RESTORE_HOURS:
+        raise ValueError(
+            f"Backups must be archived after more than SESSION_RESTORE_HOURS ({config.SESSION_RESTORE_HOURS}) "
+            f"hours, as sessions may be restored until then (archive after: {archive_after_hours} hours)."
+        )
+    os.makedirs(os.path.join(backups_directory, "archive"), exist_ok=True)
+
+    with open(os.path.join(backups_directory, "archive", "lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        archive = BackupArchive(backups_directory)
+        now = time.time()
+        stats = {"archived": 0, "loose_bytes": 0, "dropped": 0, "freed_bytes": 0}
+
+        expired = set()
+        if retention_days is not None:
+            expired = finalised_before(completions_directory, now - retention_days * 86400)
+
+        # Sessions which have not been written for a while (live sessions write after every turn)
+        archived_paths = []
+        for (username, session), paths in sorted(loose_sessions(backups_directory).items()):
+            last_write = max(os.path.getmtime(path) for path in paths.values())
+            if now - last_write < archive_after_hours * 3600 and username not in expired:
+                continue
+            archive.archive_session(username, session, paths)
+            archived_paths.append(((username, session), paths))
+        archive.save()
+
+        # Loose files are only deleted once their archived copy is verified
+        for (username, session), paths in archived_paths:
+            restored = archive.session_files(username, session)
+            for path in paths.values():
+                with open(path, "r", newline="") as f:
+                    original = f.read()
+                name = os.path.basename(path)
+                if name.endswith(".jsonl"):
+                    # Only complete lines of a log are archived
+                    original = original[: original.rfind("\n") + 1]
+                    matches = [json.loads(line) for line in original.splitlines()] == [
+                        json.loads(line) for line in restored[name].splitlines()
+                    ]
+                else:
+                    matches = original == restored[name]
+                if not matches:
+                    raise RuntimeError(f"Archived copy of {path} differs; the file was kept.")
+            for path in paths.values():
+                stats["loose_bytes"] += os.path.getsize(path)
+                os.remove(path)
+            stats["archived"] += 1
+
+        # Retention
+        for username, session in list(archive.sessions):
+            if username in expired:
+                archive.drop_session(username, session)
+                stats["dropped"] += 1
+        if stats["dropped"]:
+            archive.save()
+        stats["freed_bytes"] = archive.rewrite_pack()
+        stats["archive_bytes"] = archive.size()
+        return stats
+
+
+def restore(username, session=None, output_directory=None, messages=None, backups_directory=None):
+    """Write the files of an archived session (the latest of the username by default) to a
+    directory; return their paths."""
+    archive = BackupArchive(backups_directory)
+    sessions = sorted(s for u, s in archive.sessions if u == username)
+    if not sessions:
+        raise SystemExit(f"No archived backups of '{username}'.")
+    session = session or sessions[-1]
+    if session not in sessions:
+        raise SystemExit(f"No archived backup of '{username}' started {session}; available: {', '.join(sessions)}")
+
+    output_directory = output_directory or archive.backups_directory
+    os.makedirs(output_directory, exist_ok=True)
+    paths = []
+    for name, text in archive.session_files(username, session, messages).items():
+        path = os.path.join(output_directory, name)
+        write_file_atomically(path, text)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact, list and restore archived interview backups.")
+    parser.add_argument("--backups", default=config.BACKUPS_DIRECTORY, help="Backups directory.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = subparsers.add_parser("compact", help="Archive idle sessions and apply the retention policy.")
+    compact_parser.add_argument("--archive-after-hours", type=float, help="Archive sessions idle for this long.")
+    compact_parser.add_argument("--retention-days", type=float, help="Drop backups of interviews finalised before.")
+
+    list_parser = subparsers.add_parser("list", help="List archived sessions.")
+    list_parser.add_argument("username", nargs="?")
+
+    restore_parser = subparsers.add_parser("restore", help="Rebuild the backup files of a session.")
+    restore_parser.add_argument("username")
+    restore_parser.add_argument("--session", help="Session start as in the file names (default: latest).")
+    restore_parser.add_argument("--messages", type=int, help="Restore the log up to this many messages.")
+    restore_parser.add_argument("--output", help="Output directory (default: the backups directory).")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        stats = compact(args.backups, None, args.archive_after_hours, args.retention_days)
+        print(
+            f"Archived {stats['archived']} sessions ({stats['loose_bytes']} bytes of loose files), "
+            f"dropped {stats['dropped']} expired sessions, freed {stats['freed_bytes']} bytes; "
+            f"archive now {stats['archive_bytes']} bytes"
+        )
+    elif args.command == "list":
+        archive = BackupArchive(args.backups)
+        for (username, session), files in sorted(archive.sessions.items()):
+            if args.username in (None, username):
+                print(f"{username}\t{session}\t{', '.join(sorted(files))}")
+    elif args.command == "restore":
+        for path in restore(args.username, args.session, args.output, args.messages, args.backups):
+            print(f"Restored {path}")
@@ -0,0 +1,102 @@
+import json
+import time
+
+import config
+
+
+# Provider batch APIs (OpenAI Batch API and Anthropic Message Batches) for offline
+# simulation runs, where latency does not matter: many requests are submitted at
+# once, processed by the provider at a lower price, and their results fetched when
+# the whole batch has ended. Requests are passed as {custom_id: API kwargs} and
+# results are returned as the usual response objects, so that they can be read like
+# the responses of individual calls.
+
+
+def openai_batch_line(custom_id, api_kwargs):
+    """Line of the input file of an OpenAI batch; extra body fields become part of the body."""
+    body = dict(api_kwargs)
+    body.update(body.pop("extra_body", None) or {})
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+
+def submit_batch(api, client, requests):
+    """Submit the requests as one batch and return its id."""
+    if api == "openai":
+        lines = "".join(
+            json.dumps(openai_batch_line(custom_id, api_kwargs)) + "\n" for custom_id, api_kwargs in requests.items()
+        )
+        input_file = client.files.create(file=("requests.jsonl", lines.encode()), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h"
+        )
+    elif api == "anthropic":
+        batch = client.messages.batches.create(
+            requests=[{"custom_id": custom_id, "params": api_kwargs} for custom_id, api_kwargs in requests.items()]
+        )
+    return batch.id
+
+
+def retrieve_batch(api, client, batch_id):
+    if api == "openai":
+        return client.batches.retrieve(batch_id)
+    elif api == "anthropic":
+        return client.messages.batches.retrieve(batch_id)
+
+
+def batch_ended(api, batch):
+    if api == "openai":
+        return batch.status in ("completed", "failed", "expired", "cancelled")
+    elif api == "anthropic":
+        return batch.processing_status == "ended"
+
+
+def wait_for_batch(api, client, batch_id, poll_interval=None):
+    """Poll a batch until it has ended and return it."""
+    poll_interval = config.BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+    while True:
+        batch = retrieve_batch(api, client, batch_id)
+        if batch_ended(api, batch):
+            return batch
+        time.sleep(poll_interval)
+
+
+def batch_results(api, client, batch):
+    """Return the responses of the succeeded requests of an ended batch by custom id."""
+    results = {}
+    if api == "openai":
+        from openai.types.chat import ChatCompletion
+
+        # Failed requests are only listed in the error file
+        if batch.output_file_id:
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[record["custom_id"]] = ChatCompletion.model_validate(response["body"])
+    elif api == "anthropic":
+        for item in client.messages.batches.results(batch.id):
+            if item.result.type == "succeeded":
+                results[item.custom_id] = item.result.message
+    return results
+
+
+def run_batch(api, client, requests, poll_interval=None):
+    """Run requests as a batch and return their responses by custom id; failed requests are
+    resubmitted in a further batch up to `BATCH_MAX_ATTEMPTS` times and are missing if they
+    never succeed."""
+    results = {}
+    pending = dict(requests)
+    for attempt in range(config.BATCH_MAX_ATTEMPTS):
+        if not pending:
+            break
+        batch_id = submit_batch(api, client, pending)
+        print(f"  Batch {batch_id}: {len(pending)} requests (attempt {attempt + 1}/{config.BATCH_MAX_ATTEMPTS})")
+        batch = wait_for_batch(api, client, batch_id, poll_interval)
+        succeeded = batch_results(api, client, batch)
+        results.update(succeeded)
+        pending = {custom_id: api_kwargs for custom_id, api_kwargs in pending.items() if custom_id not in succeeded}
+        if pending:
+            print(f"  Batch {batch_id}: {len(pending)} requests failed")
+    return results
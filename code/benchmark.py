@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import config
+from mock_llm import MockLLMServer
+
+
+# Throughput benchmark of the interview simulation against the local mock provider
+# (mock_llm.py), which needs neither network access nor API keys. It reports
+# interviews per minute, the platform's own overhead per API call (wall-clock time
+# not spent waiting on the mock provider) and the bytes written per interview.
+#
+# Example (e.g. in CI):
+#   python benchmark.py --provider openai --min-interviews-per-minute 300
+
+
+def directory_size(directory):
+    """Total size in bytes of all files below a directory."""
+    total = 0
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+
+def use_data_directory(data_directory, fresh=True):
+    """Point all data directories of the configuration to a (fresh) directory."""
+    if fresh:
+        shutil.rmtree(data_directory, ignore_errors=True)
+    config.TRANSCRIPTS_DIRECTORY = os.path.join(data_directory, "transcripts")
+    config.TIMES_DIRECTORY = os.path.join(data_directory, "times")
+    config.BACKUPS_DIRECTORY = os.path.join(data_directory, "backups")
+    config.COMPLETIONS_DIRECTORY = os.path.join(data_directory, "completed")
+    config.CHECKPOINTS_DIRECTORY = os.path.join(data_directory, "checkpoints")
+    config.DATABASE_PATH = os.path.join(data_directory, "interviews.sqlite3")
+    config.RATE_LIMIT_FILE = os.path.join(data_directory, "rate_limits.json")
+    config.RESPONSE_CACHE_PATH = os.path.join(data_directory, "response_cache.sqlite3")
+    config.METRICS_PATH = os.path.join(data_directory, "metrics", "turns.jsonl")
+
+
+def run_mode(simulation, server, mode, concurrency, data_directory):
+    """Run the simulation once in 'sync', 'async' or 'batch' mode and return its measurements."""
+    use_data_directory(data_directory)
+    base_url = f"{server.url}/v1" if simulation.api == "openai" else server.url
+    requests_before = server.stats["requests"]
+    batch_requests_before = server.stats["batch_requests"]
+    busy_before = server.stats["busy_seconds"]
+
+    # Console output of the simulation is part of its cost, but not of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        if mode == "sync":
+            client = simulation.create_client(api_key="mock", base_url=base_url, max_retries=0)
+            simulation.run_simulation(client=client)
+        elif mode == "batch":
+            client = simulation.create_client(api_key="mock", base_url=base_url, max_retries=0)
+            simulation.run_simulation_batch(client=client, poll_interval=0.05)
+        else:
+            async_client = simulation.create_client(
+                asynchronous=True, api_key="mock", base_url=base_url, max_retries=0
+            )
+            asyncio.run(simulation.run_simulation_async(concurrency, async_client=async_client))
+        elapsed = time.perf_counter() - started
+
+    interviews = len(simulation.interview_grid())
+    requests = server.stats["requests"] - requests_before
+    # Requests processed in batches are sent with a few HTTP requests per batch
+    batch_requests = server.stats["batch_requests"] - batch_requests_before
+    busy_seconds = server.stats["busy_seconds"] - busy_before
+    result = {
+        "mode": mode,
+        "interviews": interviews,
+        "api_calls": requests,
+        "batched_api_calls": batch_requests,
+        "seconds": elapsed,
+        "interviews_per_minute": 60 * interviews / elapsed,
+        "bytes_written_per_interview": directory_size(data_directory) / interviews,
+    }
+
+    # Calls run one after another in sync mode, so time not spent in the mock is overhead
+    if mode == "sync":
+        result["overhead_ms_per_api_call"] = 1000 * (elapsed - busy_seconds) / max(requests, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the interview simulation against a local mock LLM.")
+    parser.add_argument("--provider", choices=["openai", "anthropic"], default="openai")
+    parser.add_argument("--modes", default="sync,async", help="Comma-separated list of 'sync', 'async' and 'batch'.")
+    parser.add_argument("--personas", type=int, default=len(config.PERSONAS), help="Number of personas used.")
+    parser.add_argument("--interviews-per-persona", type=int, default=2)
+    parser.add_argument("--turns", type=int, default=10, help="Respondent turns before the closing code.")
+    parser.add_argument("--concurrency", type=int, default=config.SIMULATION_CONCURRENCY)
+    parser.add_argument("--ttft", type=float, default=0.0, help="Mock time to first token in seconds.")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Mock generation speed (0 for instant).")
+    parser.add_argument("--output-tokens", type=int, default=40, help="Mock tokens per reply.")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="Share of mock 429 responses.")
+    parser.add_argument("--json", dest="json_path", help="Write the results to this JSON file.")
+    parser.add_argument("--min-interviews-per-minute", type=float, help="Fail if any mode is slower.")
+    parser.add_argument("--max-overhead-ms", type=float, help="Fail if the sync overhead per API call is larger.")
+    args = parser.parse_args()
+
+    # The provider is selected by the model name when the simulation is imported
+    config.MODEL = "gpt-mock" if args.provider == "openai" else "claude-mock"
+    config.PERSONAS = dict(list(config.PERSONAS.items())[: args.personas])
+    config.INTERVIEWS_PER_PERSONA = args.interviews_per_persona
+    config.MAX_CONVERSATION_TURNS = args.turns
+    import simulation
+
+    server = MockLLMServer(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        rate_limit_probability=args.rate_limit_probability,
+        close_after_turns=args.turns,
+    )
+    data_directory = tempfile.mkdtemp(prefix="interview_benchmark_")
+    results = []
+    with server:
+        for mode in args.modes.split(","):
+            results.append(run_mode(simulation, server, mode, args.concurrency, data_directory))
+    shutil.rmtree(data_directory, ignore_errors=True)
+
+    for result in results:
+        line = (
+            f"{args.provider:9} {result['mode']:5}  {result['interviews']} interviews in {result['seconds']:.2f}s"
+            f"  {result['interviews_per_minute']:.1f} interviews/min"
+            f"  {result['bytes_written_per_interview'] / 1024:.1f} KiB/interview"
+        )
+        if "overhead_ms_per_api_call" in result:
+            line += f"  {result['overhead_ms_per_api_call']:.2f} ms overhead/API call"
+        print(line)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"provider": args.provider, "arguments": vars(args), "results": results}, f, indent=2)
+
+    # Regression checks
+    failed = False
+    for result in results:
+        if args.min_interviews_per_minute and result["interviews_per_minute"] < args.min_interviews_per_minute:
+            print(f"FAIL: {result['mode']} below {args.min_interviews_per_minute} interviews/min")
+            failed = True
+        if args.max_overhead_ms and result.get("overhead_ms_per_api_call", 0) > args.max_overhead_ms:
+            print(f"FAIL: {result['mode']} overhead above {args.max_overhead_ms} ms per API call")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from transcript_log import append_records, log_record
+
+
+# Checkpoints of simulated interviews, so that interrupted runs can be resumed.
+#
+# Each interview has an append-only checkpoint file `{username}.jsonl`: a first
+# record with the initial state of the interview and then one interview log record
+# (see transcript_log.py) per message, so checkpoints can also be replayed
+# or rendered as transcripts. The run manifest `manifest[_k_of_N].jsonl` records which (persona,
+# interview index, turn) items are done and which interviews were completed.
+#
+# Manifests start with a header naming the run's grid (a fingerprint of its personas
+# and interviews) and number of shards. On resume, only the manifests of the current
+# shard layout whose grid matches are read, so that manifests left over from runs
+# with another grid or `--shard` split never mark interviews as completed.
+
+
+def parse_shard(value):
+    """Parse a shard specification 'k/N' (1 <= k <= N) for argparse."""
+    try:
+        k, n = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must have the form k/N, got '{value}'.")
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f"Shard must satisfy 1 <= k <= N, got '{value}'.")
+    return k, n
+
+
+def select_shard(grid, shard):
+    """Return the items of the persona x interview grid which belong to shard (k, N)."""
+    if shard is None:
+        return grid
+    k, n = shard
+    return [item for position, item in enumerate(grid) if position % n == k - 1]
+
+
+def checkpoint_path(directory, username):
+    """Path of the checkpoint file of an interview."""
+    return os.path.join(directory, f"{username}.jsonl")
+
+
+def manifest_path(directory, shard=None):
+    """Path of the run manifest; every shard writes its own manifest."""
+    if shard is None:
+        return os.path.join(directory, "manifest.jsonl")
+    k, n = shard
+    return os.path.join(directory, f"manifest_{k}_of_{n}.jsonl")
+
+
+def grid_fingerprint(grid):
+    """Fingerprint of a persona x interview grid (persona names, descriptions and indices)."""
+    return hashlib.sha256(json.dumps(grid, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def manifest_header(path):
+    """First record of a manifest (None if it does not exist, is empty or has no header)."""
+    try:
+        with open(path, "r") as f:
+            record = json.loads(f.readline())
+    except (OSError, json.JSONDecodeError):
+        return None
+    return record if "grid" in record else None
+
+
+def start_manifest(path, grid, shard=None, resume=False):
+    """Start a new manifest for a run of a grid, or when resuming keep it if it belongs to the
+    same grid and shard layout."""
+    header = {"grid": grid_fingerprint(grid), "shards": 1 if shard is None else shard[1]}
+    current = manifest_header(path)
+    if resume and current is not None and all(current.get(key) == value for key, value in header.items()):
+        return
+    _append_record(path, dict(header, started=time.time()), mode="w")
+
+
+def _append_record(path, record, mode="a"):
+    """Append a JSON record as a line and flush it to the operating system."""
+    with open(path, mode) as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+
+
+# Fields of checkpoint records which are not part of the turn record of a message
+CHECKPOINT_FIELDS = ("role", "content", "timestamp", "conversation_turn", "interview_active", "closing_code")
+
+
+def start_checkpoint(directory, state):
+    """Create a new checkpoint file with the initial state and messages of an interview."""
+    path = checkpoint_path(directory, state["username"])
+    header = {key: value for key, value in state.items() if key not in ("messages", "turns")}
+    _append_record(path, header, mode="w")
+    append_records(path, [log_record(message) for message in state["messages"]])
+
+
+def save_checkpoint(directory, state, **fields):
+    """Append the latest message and the interview progress to the checkpoint."""
+    record = log_record(
+        state["messages"][-1],
+        conversation_turn=state["conversation_turn"],
+        interview_active=state["interview_active"],
+        closing_code=state.get("closing_code"),
+        **fields,
+    )
+    append_records(checkpoint_path(directory, state["username"]), [record])
+
+
+def load_checkpoint(directory, username):
+    """Rebuild the state of an interview from its checkpoint, or return None if there is none."""
+    path = checkpoint_path(directory, username)
+    try:
+        with open(path, "rb") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return None
+
+    state = None
+    valid_bytes = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # The last line is incomplete if the process was killed while writing it;
+            # cut it off so that new records are appended after the last complete one
+            with open(path, "r+b") as f:
+                f.truncate(valid_bytes)
+            break
+        valid_bytes += len(line)
+        if state is None:
+            state = record
+            state["messages"] = []
+            state["turns"] = []
+        else:
+            state["messages"].append({"role": record["role"], "content": record["content"]})
+            state["conversation_turn"] = record.get("conversation_turn", state["conversation_turn"])
+            state["interview_active"] = record.get("interview_active", state["interview_active"])
+            state["closing_code"] = record.get("closing_code", state.get("closing_code"))
+            # Telemetry of generated messages (see telemetry.py)
+            if "duration_seconds" in record:
+                state["turns"].append(
+                    {key: value for key, value in record.items() if key not in CHECKPOINT_FIELDS}
+                )
+    return state
+
+
+def record_progress(path, state, status):
+    """Add an entry for an interview ('turn' or 'completed') to the run manifest."""
+    _append_record(
+        path,
+        {
+            "username": state["username"],
+            "persona_name": state["persona_name"],
+            "interview_index": state["interview_index"],
+            "turn": state["conversation_turn"],
+            "status": status,
+            "time": time.time(),
+        },
+    )
+
+
+def completed_interviews(directory, grid, shard=None):
+    """Return the usernames of all interviews completed according to the manifests of a run of
+    the grid with the same shard layout (those of other grids or layouts are ignored)."""
+    shards = 1 if shard is None else shard[1]
+    paths = [manifest_path(directory, None if shard is None else (k, shards)) for k in range(1, shards + 1)]
+    fingerprint = grid_fingerprint(grid)
+    completed = set()
+    for path in paths:
+        header = manifest_header(path)
+        if header is None or header["grid"] != fingerprint or header.get("shards") != shards:
+            continue
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("status") == "completed":
+                    completed.add(record["username"])
+    return completed
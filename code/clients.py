@@ -0,0 +1,138 @@
+import threading
+import weakref
+
+import httpx
+
+import config
+from rate_limits import observe_headers, observe_headers_async
+
+
+# API clients with a tuned, bounded HTTP connection pool. Synchronous clients are
+# created once per process and settings, so that all Streamlit sessions and reruns
+# (and the simulation) share their keep-alive connections instead of paying new
+# TLS handshakes. Asynchronous clients are bound to an event loop, so the factory
+# creates a new one per call which the caller closes. `pool_stats` reports the
+# usage of all connection pools. The rate-limit headers of all responses are passed
+# on to the rate limiters in use (see rate_limits.py).
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+_pools = []
+_pools_lock = threading.Lock()
+
+
+def http_limits():
+    return httpx.Limits(
+        max_connections=config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def http_timeout():
+    return httpx.Timeout(config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT)
+
+
+def _event_hooks(counters, asynchronous):
+    """httpx event hooks counting requests sent and responses received, and passing on
+    the rate-limit headers of responses."""
+    lock = threading.Lock()
+
+    def on_request(request):
+        with lock:
+            counters["requests"] += 1
+
+    def count_response():
+        with lock:
+            counters["responses"] += 1
+
+    def on_response(response):
+        count_response()
+        observe_headers(response.headers)
+
+    if not asynchronous:
+        return {"request": [on_request], "response": [on_response]}
+
+    async def on_request_async(request):
+        on_request(request)
+
+    async def on_response_async(response):
+        count_response()
+        # The rate limiters update a locked file, which is done in a worker thread
+        await observe_headers_async(response.headers)
+
+    return {"request": [on_request_async], "response": [on_response_async]}
+
+
+def create_client(api, api_key, asynchronous=False, base_url=None, **client_kwargs):
+    """Create an OpenAI or Anthropic client with its own bounded connection pool."""
+    if api == "openai":
+        import openai
+
+        client_class = openai.AsyncOpenAI if asynchronous else openai.OpenAI
+        http_client_class = openai.DefaultAsyncHttpxClient if asynchronous else openai.DefaultHttpxClient
+    elif api == "anthropic":
+        import anthropic
+
+        client_class = anthropic.AsyncAnthropic if asynchronous else anthropic.Anthropic
+        http_client_class = anthropic.DefaultAsyncHttpxClient if asynchronous else anthropic.DefaultHttpxClient
+    else:
+        raise ValueError(f"Unknown API '{api}'.")
+
+    counters = {"requests": 0, "responses": 0}
+    http_client = http_client_class(
+        limits=http_limits(),
+        timeout=http_timeout(),
+        event_hooks=_event_hooks(counters, asynchronous),
+    )
+    with _pools_lock:
+        name = f"{api}{' (async)' if asynchronous else ''}"
+        _pools.append((name, weakref.ref(http_client), counters))
+
+    return client_class(api_key=api_key, base_url=base_url, http_client=http_client, **client_kwargs)
+
+
+def get_client(api, api_key, base_url=None, **client_kwargs):
+    """Return the synchronous client shared by this process for these settings."""
+    key = (api, api_key, base_url, tuple(sorted(client_kwargs.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = create_client(api, api_key, base_url=base_url, **client_kwargs)
+        return _clients[key]
+
+
+def _connections(http_client):
+    """Open and idle connections of an httpx client's pool (None if not available)."""
+    try:
+        connections = list(http_client._transport._pool.connections)
+    except AttributeError:
+        return None, None
+    return len(connections), sum(1 for connection in connections if connection.is_idle())
+
+
+def pool_stats():
+    """Usage of all live connection pools: requests sent, responses received, requests
+    waiting for a response, and open and idle connections."""
+    stats = []
+    with _pools_lock:
+        _pools[:] = [pool for pool in _pools if pool[1]() is not None]
+        pools = list(_pools)
+
+    for name, http_client_ref, counters in pools:
+        http_client = http_client_ref()
+        if http_client is None:
+            continue
+        connections, idle_connections = _connections(http_client)
+        stats.append(
+            {
+                "client": name,
+                "requests": counters["requests"],
+                "responses": counters["responses"],
+                "in_flight": counters["requests"] - counters["responses"],
+                "connections": connections,
+                "idle_connections": idle_connections,
+                "max_connections": config.HTTP_MAX_CONNECTIONS,
+            }
+        )
+    return stats
@@ -0,0 +1,110 @@
+import functools
+from collections import deque
+
+import config
+
+
+# Detection of closing codes in streamed interviewer messages. An Aho-Corasick
+# automaton over all codes is advanced by each new character only, so a message is
+# scanned once in total, however many deltas it arrives in. The automaton state
+# also tells how many trailing characters could be the beginning of a code; only
+# these are held back from display. The deltas are collected in a list and only
+# joined when the text is needed, so that a long message is not copied per delta.
+
+
+@functools.lru_cache(maxsize=None)
+def _build_automaton(codes):
+    """Build goto, failure, output and depth tables for a tuple of codes."""
+    goto = [{}]
+    fail = [0]
+    output = [None]
+    depth = [0]
+
+    # Trie of all codes
+    for code in codes:
+        state = 0
+        for char in code:
+            if char not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                output.append(None)
+                depth.append(depth[state] + 1)
+                goto[state][char] = len(goto) - 1
+            state = goto[state][char]
+        if output[state] is None:
+            output[state] = code
+
+    # Failure links in breadth-first order
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fallback = fail[state]
+            while fallback and char not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(char, 0)
+            if output[next_state] is None:
+                output[next_state] = output[fail[next_state]]
+
+    return goto, fail, output, depth
+
+
+class ClosingCodeMatcher:
+    """Finds closing codes in a message which is fed in as a stream of text deltas."""
+
+    def __init__(self, codes=None):
+        codes = tuple(config.CLOSING_MESSAGES.keys() if codes is None else codes)
+        self._goto, self._fail, self._output, self._depth = _build_automaton(codes)
+        self._state = 0
+        self._chunks = []
+        self.length = 0
+        self.code = None
+
+    def feed(self, delta):
+        """Add a text delta; returns the first closing code found so far (or None)."""
+        if not delta:
+            return self.code
+        self._chunks.append(delta)
+        self.length += len(delta)
+        if self.code is not None:
+            return self.code
+
+        goto, fail, output = self._goto, self._fail, self._output
+        state = self._state
+        for char in delta:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                self.code = output[state]
+                break
+        self._state = state
+        return self.code
+
+    @property
+    def text(self):
+        """The message received so far."""
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    @property
+    def held_back(self):
+        """Number of trailing characters which could still turn out to be part of a code."""
+        return self._depth[self._state]
+
+    @property
+    def display_text(self):
+        """Text which can safely be displayed, i.e. without a possible partial code at its end."""
+        return self.text[: self.display_length]
+
+    @property
+    def display_length(self):
+        """Length of the display text (without joining the deltas)."""
+        return self.length - self.held_back
+
+
+def find_closing_code(text, codes=None):
+    """Return the first closing code in a complete text, or None."""
+    return ClosingCodeMatcher(codes).feed(text)
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+import config
+
+
+# In-process index of completed interviews, so that completion checks on every
+# Streamlit rerun do not hit the (possibly networked) filesystem. It is built once
+# from the completion markers in a directory, updated when this process finalises
+# an interview, and only asks the filesystem again for usernames not known to be
+# completed, at most once per `COMPLETION_INDEX_TTL` seconds (interviews may also
+# be finalised by other processes).
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class CompletionIndex:
+    """Set of usernames with a completion marker `{username}.json` in a directory."""
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = config.COMPLETION_INDEX_TTL if ttl is None else ttl
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.checked = {}  # Time of the last filesystem check per username not completed
+        self.scanned = 0.0
+        self.scan()
+
+    def scan(self):
+        """(Re)build the index from the markers in the directory."""
+        completed = set()
+        if os.path.isdir(self.directory):
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and not entry.name.startswith("."):
+                        completed.add(entry.name[: -len(".json")])
+        with self.lock:
+            self.completed |= completed
+            self.checked.clear()
+            self.scanned = time.monotonic()
+
+    def mark_completed(self, username):
+        with self.lock:
+            self.completed.add(username)
+            self.checked.pop(username, None)
+
+    def is_completed(self, username):
+        """Whether the interview was completed; misses are re-checked on disk after the TTL."""
+        now = time.monotonic()
+        with self.lock:
+            if username in self.completed:
+                return True
+            if now - self.checked.get(username, float("-inf")) < self.ttl:
+                return False
+
+        completed = os.path.exists(os.path.join(self.directory, f"{username}.json"))
+        with self.lock:
+            if completed:
+                self.completed.add(username)
+                self.checked.pop(username, None)
+            else:
+                self.checked[username] = now
+        return completed
+
+    def statuses(self, usernames):
+        """Completion status of many usernames at once (rescans the directory after the TTL)."""
+        if time.monotonic() - self.scanned >= self.ttl:
+            self.scan()
+        with self.lock:
+            return {username: username in self.completed for username in usernames}
+
+
+def get_completion_index(directory):
+    """Return the completion index of this process for a directory (built on first use)."""
+    directory = os.path.abspath(directory)
+    with _indexes_lock:
+        if directory not in _indexes:
+            _indexes[directory] = CompletionIndex(directory)
+        return _indexes[directory]
@@ -62,6 +62,9 @@ CLOSING_MESSAGES["x7y8"] = (
     "Thank you for participating in the interview, this was the last question. Please continue with the remaining sections in the survey part. Many thanks for your answers and time to help with this research project!"
 )
 
+# Message displayed when the respondent quits the interview
+QUIT_MESSAGE = "You have cancelled the interview."
+
 
 # System prompt
 SYSTEM_PROMPT = f"""{INTERVIEW_OUTLINE}
@@ -77,6 +80,32 @@ SYSTEM_PROMPT = f"""{INTERVIEW_OUTLINE}
 MODEL = "gpt-4o-2024-05-13"  # or e.g. "claude-3-5-sonnet-20240620" (OpenAI GPT or Anthropic Claude models)
 TEMPERATURE = None  # (None for default value)
 MAX_OUTPUT_TOKENS = 2048
+# Context window: max. estimated input tokens per request (None for no limit). Beyond that,
+# turns between the opening exchange and the last turns are replaced by a summary
+CONTEXT_TOKEN_BUDGET = 30000
+CONTEXT_KEEP_OPENING_MESSAGES = 3  # Interviewer's opening, consent answer and follow-up
+CONTEXT_KEEP_LAST_TURNS = 10
+CONTEXT_SUMMARY_MAX_TOKENS = 1024
+PROMPT_CACHING = True  # Reuse the unchanged system prompt and history between turns (cheaper and faster)
+# HTTP connection pool shared by all sessions of a process (timeouts in seconds)
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_EXPIRY = 60
+HTTP_TIMEOUT = 120
+HTTP_CONNECT_TIMEOUT = 10
+API_BASE_URL = None  # (None for the provider's API; or a local mock_llm.py, e.g. "http://127.0.0.1:8765/v1" for GPT and "http://127.0.0.1:8765" for Claude models)
+# Hedged requests and failover (see providers.py): a second model, possibly of the other
+# provider, which takes over if the first token of `MODEL` takes longer than
+# `HEDGE_AFTER_SECONDS` (None to only fail over) or on server errors and overload
+FALLBACK_MODEL = None  # e.g. "claude-3-5-sonnet-20240620" (None to disable)
+FALLBACK_API_BASE_URL = None
+HEDGE_AFTER_SECONDS = 5
+
+
+# Streaming display: max. updates of a streamed message per second, and number of new
+# characters after which the message is updated anyway
+RENDER_FRAME_RATE = 10
+RENDER_MAX_PENDING_CHARACTERS = 400
 
 
 # Display login screen with usernames and simple passwords for studies
@@ -92,11 +121,67 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 TRANSCRIPTS_DIRECTORY = os.path.join(PROJECT_ROOT, "data", "transcripts")
 TIMES_DIRECTORY = os.path.join(PROJECT_ROOT, "data", "times")
 BACKUPS_DIRECTORY = os.path.join(PROJECT_ROOT, "data", "backups")
+COMPLETIONS_DIRECTORY = os.path.join(PROJECT_ROOT, "data", "completed")  # completion markers
+COMPLETION_INDEX_TTL = 30  # Seconds before a username not known to be completed is checked on disk again
+CHECKPOINTS_DIRECTORY = os.path.join(PROJECT_ROOT, "data", "checkpoints")  # simulation runs
+BACKUP_ARCHIVE_AFTER_HOURS = 48  # Backups not written for this long are moved to the archive (see backup_archive.py; more than SESSION_RESTORE_HOURS)
+BACKUP_RETENTION_DAYS = None  # Drop backups of interviews finalised this many days ago (None: keep forever)
+BACKUP_WRITE_BEHIND = True  # Write the backups and metrics after each turn in a background thread (see write_behind.py)
+BACKUP_FLUSH_TIMEOUT = 30  # Seconds to wait for queued backups when an interview ends or the process exits
+
+# Storage of interview data: "files" (transcripts, times, backups and completion markers
+# in the directories above) or "sqlite" (everything in one database, see storage.py)
+STORAGE_BACKEND = "files"
+DATABASE_PATH = os.path.join(PROJECT_ROOT, "data", "interviews.sqlite3")
+
+# Returning respondents (e.g. after a closed tab or a restarted worker) continue their
+# latest unfinished interview from its backup, if it was active within this many hours
+RESTORE_SESSIONS = True
+SESSION_RESTORE_HOURS = 24
+
+# Per-turn latency and token metrics of all interviews (see telemetry.py)
+TELEMETRY = True
+METRICS_PATH = os.path.join(PROJECT_ROOT, "data", "metrics", "turns.jsonl")
+
+# Span traces of the phases of turns (see tracing.py); also with `--profile`
+PROFILE = False
+PROFILES_DIRECTORY = os.path.join(PROJECT_ROOT, "data", "profiles")
 
 
 # Simulation settings
 INTERVIEWS_PER_PERSONA = 1 # Number of interviews to generate per persona
 MAX_CONVERSATION_TURNS = 25 # Max number of turns before ending conversation
+SIMULATION_CONCURRENCY = 8 # Max number of interviews running at the same time with `--async`
+BATCH_POLL_INTERVAL = 30 # Seconds between status checks of a submitted batch with `--batch`
+BATCH_MAX_ATTEMPTS = 3 # Number of batches in which a failing request is submitted with `--batch`
+
+# Rate limiting of simulations (see rate_limits.py), shared by all workers and processes
+RATE_LIMITING = True
+RATE_LIMIT_REQUESTS_PER_MINUTE = None # Initial limits; None until learned from the provider's rate-limit headers
+RATE_LIMIT_TOKENS_PER_MINUTE = None
+RATE_LIMIT_FILE = os.path.join(PROJECT_ROOT, "data", "rate_limits.json") # Coordination file of the token buckets
+RETRY_MAX_ATTEMPTS = 8 # Attempts of a request before the interview is given up
+RETRY_BASE_DELAY = 1 # Seconds of the first backoff, doubled on every retry (with full jitter)
+RETRY_MAX_DELAY = 60 # Longest backoff in seconds
+
+# Cache of API responses of simulations (see response_cache.py): "record", "replay" or "bypass"
+RESPONSE_CACHE = "bypass"
+RESPONSE_CACHE_PATH = os.path.join(PROJECT_ROOT, "data", "response_cache.sqlite3")
+RESPONSE_CACHE_MAX_BYTES = 500 * 1024 * 1024 # Least recently used responses are evicted above this size
+
+# Sweeps over personas x models x temperatures x repetitions (see sweep.py)
+SWEEP_MODELS = None # e.g. ["gpt-4o-2024-05-13", "gpt-4o-mini-2024-07-18"], all of the provider of MODEL (None: MODEL only)
+SWEEP_TEMPERATURES = [None] # e.g. [0.2, 0.7, 1.0] (None for default value)
+SWEEP_REPETITIONS = 2 # Interviews per persona, model and temperature
+SWEEP_TOKEN_BUDGET = None # Max. input and output tokens of a sweep (None for no limit)
+SWEEP_COST_BUDGET = None # Max. cost of a sweep in USD, with the prices below (None for no limit)
+SWEEP_DEADLINE_MINUTES = None # No interview is started which would end after this (None for no deadline)
+# USD per million input and output tokens (cached input tokens are counted at the full price)
+MODEL_PRICES = {
+    "gpt-4o-2024-05-13": (5.00, 15.00),
+    "gpt-4o-mini-2024-07-18": (0.15, 0.60),
+    "claude-3-5-sonnet-20240620": (3.00, 15.00),
+}
 
 # Personas for the simulated respondent
 
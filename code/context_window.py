@@ -0,0 +1,160 @@
+import config
+from tracing import span
+
+
+# Context window budgeting for long interviews. Requests always contain the system
+# prompt, the opening exchange (greeting, consent and first answers) and the last
+# `CONTEXT_KEEP_LAST_TURNS` turns verbatim. Once a request would exceed
+# `CONTEXT_TOKEN_BUDGET` input tokens, the turns in between are folded into a
+# summary which is appended to the system prompt. The summary is extended
+# incrementally with the newly folded turns only, and folding happens in chunks so
+# that the prompt prefix (and hence prompt caching) stays stable between folds.
+# The stored interview history itself is never changed.
+#
+# In simulations, interviewer and respondent requests have different system prompts
+# (and may use a different model than `MODEL`), so each side keeps its own summary,
+# budgeted against its own system prompt, written for the side that receives it and
+# made with the model of its requests.
+
+SUMMARY_HEADER = "\n\nSummary of the earlier part of this interview (these turns are omitted below):\n"
+
+SUMMARY_PROMPT = """You keep a running summary of an ongoing research interview, so that {reader} can continue it without the full transcript.
+
+Current summary:
+{summary}
+
+Further part of the transcript:
+{transcript}
+
+Write the updated summary. {instructions} Reply with the summary only."""
+
+# Reader and instructions of the summary prompt per side of the interview
+SUMMARY_PERSPECTIVES = {
+    "interviewer": (
+        "the interviewer",
+        "Keep all topics and questions that were covered, the respondent's concrete examples and views, and anything the interviewer promised or should follow up on.",
+    ),
+    "respondent": (
+        "the respondent",
+        'Address the respondent directly ("You were asked ..., you said ..."). Keep the questions that were asked and everything the respondent said about themselves, including concrete examples and views, so that their later answers stay consistent.',
+    ),
+}
+
+# Speakers of the transcript in the summary prompt
+SPEAKERS = {"assistant": "Interviewer", "user": "Respondent"}
+
+
+def new_summary():
+    """Summary state of an interview: summary text and index of the first message it does not cover."""
+    return {"text": "", "covered_until": 0}
+
+
+def estimate_tokens(text):
+    """Rough number of tokens of a text (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def _head_end(messages):
+    """Index after the opening messages which are always kept (first message and opening exchange)."""
+    return min(len(messages), 1 + config.CONTEXT_KEEP_OPENING_MESSAGES)
+
+
+def context_messages(messages, summary):
+    """Messages sent to the model: the opening and all messages not covered by the summary."""
+    head_end = _head_end(messages)
+    return messages[:head_end] + messages[max(summary["covered_until"], head_end) :]
+
+
+def messages_to_summarise(messages, summary, system_prompt):
+    """Return the messages which have to be folded into the summary to keep requests with this
+    system prompt within the budget (empty if within budget) and the index of the first message
+    then not covered by it."""
+    if config.CONTEXT_TOKEN_BUDGET is None:
+        return [], summary["covered_until"]
+
+    context = context_messages(messages, summary)
+    tokens = estimate_tokens(system_prompt + summary["text"]) + sum(
+        estimate_tokens(message["content"]) for message in context
+    )
+    if tokens <= config.CONTEXT_TOKEN_BUDGET:
+        return [], summary["covered_until"]
+
+    # Keep the last turns verbatim, starting with a respondent message so that roles alternate
+    head_end = _head_end(messages)
+    user_indices = [i for i in range(head_end, len(messages)) if messages[i]["role"] == "user"]
+    if len(user_indices) <= config.CONTEXT_KEEP_LAST_TURNS:
+        return [], summary["covered_until"]
+    keep_from = user_indices[-config.CONTEXT_KEEP_LAST_TURNS]
+    start = max(summary["covered_until"], head_end)
+    return messages[start:keep_from], keep_from
+
+
+def apply_context_window(api, api_kwargs, summary):
+    """Return a copy of the API kwargs with the history reduced to the context window."""
+    if not summary["text"]:
+        return api_kwargs
+
+    api_kwargs = dict(api_kwargs)
+    messages = context_messages(api_kwargs["messages"], summary)
+    if api == "openai":
+        messages[0] = {"role": "system", "content": messages[0]["content"] + SUMMARY_HEADER + summary["text"]}
+    elif api == "anthropic":
+        api_kwargs["system"] = api_kwargs["system"] + SUMMARY_HEADER + summary["text"]
+    api_kwargs["messages"] = messages
+    return api_kwargs
+
+
+def summary_request(summary, messages, model, perspective="interviewer"):
+    """API kwargs of the call which adds `messages` to the summary of one side of the interview."""
+    transcript = "\n".join(
+        f"{SPEAKERS.get(message['role'], message['role'])}: {message['content']}" for message in messages
+    )
+    reader, instructions = SUMMARY_PERSPECTIVES[perspective]
+    prompt = SUMMARY_PROMPT.format(
+        reader=reader,
+        summary=summary["text"] or "(none yet)",
+        transcript=transcript,
+        instructions=instructions,
+    )
+    return {
+        "model": model,
+        "max_tokens": config.CONTEXT_SUMMARY_MAX_TOKENS,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+
+
+def _summary_text(api, response):
+    if response is None:
+        return None
+    if api == "openai":
+        return response.choices[0].message.content
+    elif api == "anthropic":
+        return response.content[0].text
+
+
+def update_summary(api, create, messages, summary, system_prompt, model, perspective="interviewer"):
+    """Fold older turns into the summary of one side if the budget of its requests (with this
+    system prompt and model) requires it; `create` makes the (non-streaming) API call. Returns
+    the new summary state, or the old one if the call failed."""
+    to_summarise, covered_until = messages_to_summarise(messages, summary, system_prompt)
+    if not to_summarise:
+        return summary
+    with span("summary"):
+        text = _summary_text(api, create(**summary_request(summary, to_summarise, model, perspective)))
+    if not text:
+        return summary
+    return {"text": text, "covered_until": covered_until}
+
+
+async def update_summary_async(api, create, messages, summary, system_prompt, model, perspective="interviewer"):
+    """Asynchronous version of update_summary."""
+    to_summarise, covered_until = messages_to_summarise(messages, summary, system_prompt)
+    if not to_summarise:
+        return summary
+    with span("summary"):
+        text = _summary_text(
+            api, await create(**summary_request(summary, to_summarise, model, perspective))
+        )
+    if not text:
+        return summary
+    return {"text": text, "covered_until": covered_until}
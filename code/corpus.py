@@ -0,0 +1,324 @@
+import argparse
+import glob
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+import config
+from storage import session_label
+from transcript_log import read_log
+
+
+# Columnar corpus of all final interviews, for analysis. The transcripts and times
+# files are parsed into one row per message (username, persona, position, role,
+# length in characters and words, message timestamp, interview start and end time,
+# closing code) and stored as NumPy arrays in `data/corpus/messages.npz`, optionally
+# also as Parquet (requires pyarrow). Builds are incremental: a manifest records
+# the size and modification time of each interview's files, and only interviews
+# which are new or changed are parsed again.
+#
+# Transcripts (`role: content` lines) cannot be split reliably where answers span
+# several lines, so messages are taken from the interview's backup log when it is
+# available (which also gives the message timestamps). Otherwise a line starts a
+# new message only if it starts with the other speaker's role, or if it is one of
+# the fixed messages which follow another interviewer message (a closing message
+# after the code, or the quit message).
+
+_MESSAGE_START = re.compile(r"^(user|assistant|system): ", re.MULTILINE)
+
+# Columns and their NumPy types
+COLUMNS = {
+    "username": str,
+    "persona": str,
+    "position": np.int32,
+    "role": str,
+    "characters": np.int32,
+    "words": np.int32,
+    "timestamp": np.float64,
+    "start_time": np.float64,
+    "end_time": np.float64,
+    "closing_code": str,
+}
+
+
+def fixed_messages():
+    """Messages stored after another interviewer message: closing messages and the quit message."""
+    return {message.strip() for message in config.CLOSING_MESSAGES.values()} | {config.QUIT_MESSAGE}
+
+
+def parse_transcript(text):
+    """Messages of a `role: content` transcript. A line starting with a role only starts a new
+    message if the role changes (interviewer and respondent take turns) or if it is a fixed
+    message (see fixed_messages); other lines continue the previous message."""
+    messages = []
+    content_start = None
+    fixed = fixed_messages()
+    for start in _MESSAGE_START.finditer(text):
+        line_end = text.find("\n", start.end())
+        line = text[start.end() : line_end if line_end != -1 else len(text)]
+        if messages and messages[-1]["role"] == start.group(1) and line.strip() not in fixed:
+            continue
+        if messages:
+            messages[-1]["content"] = text[content_start : start.start()]
+        messages.append({"role": start.group(1), "content": ""})
+        content_start = start.end()
+    if messages:
+        messages[-1]["content"] = text[content_start:]
+    # Every message is followed by a newline
+    for message in messages:
+        if message["content"].endswith("\n"):
+            message["content"] = message["content"][:-1]
+    return messages
+
+
+def parse_times(text):
+    """Start and end time of an interview from its times file (NaN if not readable)."""
+    start_time = end_time = float("nan")
+    start = re.search(r"^Start time \(UTC\): (.+)$", text, re.MULTILINE)
+    duration = re.search(r"^Interview duration \(minutes\): ([\d.]+)$", text, re.MULTILINE)
+    if start:
+        # Written with the local time of the server (see save_interview_data)
+        start_time = time.mktime(time.strptime(start.group(1).strip(), "%d/%m/%Y %H:%M:%S"))
+        if duration:
+            end_time = start_time + float(duration.group(1)) * 60
+    return start_time, end_time
+
+
+def persona_of(username):
+    """Persona of a simulated interview, from its username (empty for real respondents); the
+    usernames of sweeps end with the model and temperature (see sweep.Cell.username)."""
+    for persona_name in config.PERSONAS:
+        prefix = re.escape(persona_name.replace(" ", "_") + "_")
+        if re.fullmatch(prefix + r"\d+(_.+_t[^_]+)?", username):
+            return persona_name
+    return ""
+
+
+def closing_code_of(content):
+    """Closing code whose closing message (or the code itself) a message is."""
+    content = content.strip()
+    for code, closing_message in config.CLOSING_MESSAGES.items():
+        if content == closing_message.strip() or content == code:
+            return code
+    return ""
+
+
+class Corpus:
+    """Message table of the interviews in the transcripts and times directories."""
+
+    def __init__(self, corpus_directory, transcripts_directory=None, times_directory=None, backups_directory=None):
+        self.corpus_directory = corpus_directory
+        self.transcripts_directory = transcripts_directory or config.TRANSCRIPTS_DIRECTORY
+        self.times_directory = times_directory or config.TIMES_DIRECTORY
+        self.backups_directory = backups_directory or config.BACKUPS_DIRECTORY
+        self.table_path = os.path.join(corpus_directory, "messages.npz")
+        self.manifest_path = os.path.join(corpus_directory, "manifest.json")
+
+    def load(self):
+        """Return the stored columns and manifest (empty if nothing was built yet)."""
+        if not (os.path.exists(self.table_path) and os.path.exists(self.manifest_path)):
+            return empty_columns(), {}
+        with np.load(self.table_path) as table:
+            columns = {name: table[name] for name in COLUMNS}
+        with open(self.manifest_path, "r") as f:
+            manifest = json.load(f)
+        return columns, manifest
+
+    def _paths(self, username):
+        transcript_path = os.path.join(self.transcripts_directory, f"{username}.txt")
+        time_path = os.path.join(self.times_directory, f"{username}.txt")
+        return transcript_path, time_path
+
+    def _fingerprint(self, paths):
+        fingerprint = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                fingerprint.append([stat.st_size, stat.st_mtime_ns])
+            except FileNotFoundError:
+                fingerprint.append(None)
+        return fingerprint
+
+    def _backup_messages(self, username, start_time):
+        """Messages (with timestamps) of the interview's backup log, if it is available."""
+        if np.isnan(start_time):
+            return None
+        log_name = f"{username}_log_started_{session_label(start_time)}.jsonl"
+        log_path = os.path.join(self.backups_directory, log_name)
+        if not os.path.exists(log_path):
+            return None
+        # The first record is the system prompt (OpenAI) or greeting (Anthropic), not in the transcript
+        return [record for record in read_log(log_path) if "role" in record][1:]
+
+    def _messages(self, username, text, start_time):
+        """Messages and timestamps of an interview: from the backup log if its messages render
+        exactly to the transcript, otherwise parsed from the transcript (without timestamps)."""
+        records = self._backup_messages(username, start_time) or []
+        rendered = []
+        length = 0
+        for record in records:
+            rendered.append(f"{record['role']}: {record['content']}\n")
+            length += len(rendered[-1])
+            if length >= len(text):
+                break
+        if text and "".join(rendered) == text:
+            records = records[: len(rendered)]
+            return records, [record.get("timestamp", float("nan")) for record in records]
+        messages = parse_transcript(text)
+        return messages, [float("nan")] * len(messages)
+
+    def _rows(self, username):
+        """Rows of one interview."""
+        transcript_path, time_path = self._paths(username)
+        with open(transcript_path, "r") as f:
+            text = f.read()
+        start_time = end_time = float("nan")
+        if os.path.exists(time_path):
+            with open(time_path, "r") as f:
+                start_time, end_time = parse_times(f.read())
+        messages, timestamps = self._messages(username, text, start_time)
+
+        persona = persona_of(username)
+        return [
+            (
+                username,
+                persona,
+                position,
+                message["role"],
+                len(message["content"]),
+                len(message["content"].split()),
+                timestamp,
+                start_time,
+                end_time,
+                closing_code_of(message["content"]) if message["role"] == "assistant" else "",
+            )
+            for position, (message, timestamp) in enumerate(zip(messages, timestamps))
+        ]
+
+    def sync(self):
+        """Parse new and changed interviews into the stored table; return (columns, parsed, removed)."""
+        columns, manifest = self.load()
+        transcript_paths = glob.glob(os.path.join(self.transcripts_directory, "*.txt"))
+        usernames = sorted(os.path.basename(path)[: -len(".txt")] for path in transcript_paths)
+
+        current = {}
+        changed = []
+        for username in usernames:
+            transcript_path, time_path = self._paths(username)
+            fingerprint = self._fingerprint([transcript_path, time_path])
+            current[username] = fingerprint
+            if manifest.get(username) != fingerprint:
+                changed.append(username)
+        removed = [username for username in manifest if username not in current]
+
+        # Drop the rows of changed and removed interviews, then add the changed ones again
+        if changed or removed:
+            keep = ~np.isin(columns["username"], changed + removed)
+            columns = {name: values[keep] for name, values in columns.items()}
+            rows = [row for username in changed for row in self._rows(username)]
+            if rows:
+                new_columns = to_columns(rows)
+                columns = {name: np.concatenate([columns[name], new_columns[name]]) for name in COLUMNS}
+            self.save(columns, current)
+        return columns, len(changed), len(removed)
+
+    def save(self, columns, manifest):
+        os.makedirs(self.corpus_directory, exist_ok=True)
+        temporary_path = self.table_path + ".tmp.npz"
+        np.savez(temporary_path, **columns)
+        os.replace(temporary_path, self.table_path)
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+
+def empty_columns():
+    return {name: np.array([], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def to_columns(rows):
+    """Columns of a list of row tuples."""
+    values = list(zip(*rows))
+    return {name: np.array(values[number], dtype=dtype) for number, (name, dtype) in enumerate(COLUMNS.items())}
+
+
+def write_parquet(columns, path):
+    """Write the table as Parquet (requires pyarrow)."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Writing Parquet requires pyarrow (pip install pyarrow).")
+    table = pyarrow.table(
+        {name: values.tolist() if values.dtype.kind == "U" else values for name, values in columns.items()}
+    )
+    pyarrow.parquet.write_table(table, path)
+
+
+def distribution(values):
+    if len(values) == 0:
+        return {"count": 0}
+    return {
+        "count": int(len(values)),
+        "mean": round(float(values.mean()), 2),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "max": int(values.max()),
+    }
+
+
+def summary(columns):
+    """Turns per interview, answer lengths by persona and closing code frequencies."""
+    usernames, interview_ids = np.unique(columns["username"], return_inverse=True)
+    answers = columns["role"] == "user"
+
+    # Respondent answers per interview (also counting interviews without answers)
+    turns = np.bincount(interview_ids[answers], minlength=len(usernames))
+
+    answer_lengths = {}
+    personas = columns["persona"][answers]
+    words = columns["words"][answers]
+    for persona in np.unique(personas):
+        answer_lengths[str(persona) or "(respondents)"] = distribution(words[personas == persona])
+
+    closed = columns["closing_code"] != ""
+    codes, counts = np.unique(columns["closing_code"][closed], return_counts=True)
+
+    # Start and end time are repeated in every row of an interview
+    first_rows = np.unique(interview_ids, return_index=True)[1]
+    durations = (columns["end_time"] - columns["start_time"])[first_rows] / 60
+
+    return {
+        "interviews": int(len(usernames)),
+        "messages": int(len(columns["username"])),
+        "turns_per_interview": distribution(turns),
+        "duration_minutes": distribution(durations[~np.isnan(durations)]),
+        "answer_words_by_persona": answer_lengths,
+        "closing_codes": {str(code): int(count) for code, count in zip(codes, counts)},
+        "interviews_without_closing_code": int(len(usernames) - len(np.unique(interview_ids[closed]))),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the message table of all interviews and summarise it.")
+    parser.add_argument(
+        "--corpus", default=os.path.join(config.PROJECT_ROOT, "data", "corpus"), help="Directory of the table."
+    )
+    parser.add_argument("--parquet", action="store_true", help="Also write messages.parquet (requires pyarrow).")
+    parser.add_argument("--no-summary", action="store_true", help="Only update the table.")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    corpus = Corpus(args.corpus)
+    columns, parsed, removed = corpus.sync()
+    print(
+        f"Corpus: {len(columns['username'])} messages, {parsed} interviews parsed, {removed} removed "
+        f"({time.perf_counter() - started:.2f} seconds)"
+    )
+    if args.parquet:
+        write_parquet(columns, os.path.join(args.corpus, "messages.parquet"))
+    if not args.no_summary:
+        print(json.dumps(summary(columns), indent=2))
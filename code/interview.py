@@ -1,25 +1,43 @@
 import streamlit as st
 import time
-from utils import (
-    check_if_interview_completed,
-    save_interview_data,
-)
+from storage import get_storage
+from closing_codes import ClosingCodeMatcher, find_closing_code
+from rendering import RenderCoalescer
+from prompt_caching import apply_prompt_caching
+from context_window import apply_context_window, new_summary, update_summary
+from clients import get_client
+from providers import HedgedStream, Route, api_of
+from telemetry import TurnTimer, record_turn
+from tracing import flush_trace, span, start_tracing, trace_path, traced
+from write_behind import get_write_queue
 import os
+import sys
 import hmac
 import config
 
-# Load API library
-if "gpt" in config.MODEL.lower():
-    api = "openai"
-    from openai import OpenAI
 
-elif "claude" in config.MODEL.lower():
-    api = "anthropic"
-    import anthropic
-else:
-    raise ValueError(
-        "Model does not contain 'gpt' or 'claude'; unable to determine API."
-    )
+@st.cache_resource(show_spinner=False)
+def prepare_process():
+    """Startup work which is done once per process instead of on every rerun: select the
+    API library of the model, create the data directories and start tracing if profiling
+    (`streamlit run interview.py -- --profile`)."""
+    api = api_of(config.MODEL)
+    if config.PROFILE or "--profile" in sys.argv[1:]:
+        start_tracing(trace_path("interview"))
+
+    for directory in [
+        config.TRANSCRIPTS_DIRECTORY,
+        config.TIMES_DIRECTORY,
+        config.BACKUPS_DIRECTORY,
+        config.COMPLETIONS_DIRECTORY,
+    ]:
+        os.makedirs(directory, exist_ok=True)
+
+    return api
+
+
+# Load API library and create directories if they do not already exist
+api = prepare_process()
 
 # Set page title and icon
 st.set_page_config(page_title="Interview", page_icon=config.AVATAR_INTERVIEWER)
@@ -49,14 +67,30 @@ if config.LOGINS:
 else:
     st.session_state.username = "testaccount"
 
-# Create directories if they do not already exist
-if not os.path.exists(config.TRANSCRIPTS_DIRECTORY):
-    os.makedirs(config.TRANSCRIPTS_DIRECTORY)
-if not os.path.exists(config.TIMES_DIRECTORY):
-    os.makedirs(config.TIMES_DIRECTORY)
-if not os.path.exists(config.BACKUPS_DIRECTORY):
-    os.makedirs(config.BACKUPS_DIRECTORY)
-
+# Storage of interview data (flat files or SQLite, see config.py), shared by all
+# processes serving the app, and the queue writing backups after each turn in the background
+storage = get_storage()
+write_queue = get_write_queue(storage)
+
+# A returning respondent continues their latest unfinished interview from its backup
+# (e.g. after closing the tab, or when the process serving it was restarted), on
+# whichever process serves them, instead of starting a new one. The test account
+# is shared by all testers and always starts a new interview.
+if (
+    "messages" not in st.session_state
+    and config.RESTORE_SESSIONS
+    and st.session_state.username != "testaccount"
+):
+    # Backups of this process which are still queued are written first
+    write_queue.flush(st.session_state.username, timeout=config.BACKUP_FLUSH_TIMEOUT)
+    restored = storage.unfinished_session(st.session_state.username, config.SESSION_RESTORE_HOURS)
+    if restored is not None:
+        st.session_state.messages = restored["messages"]
+        st.session_state.start_time = restored["start_time"]
+        st.session_state.start_time_file_names = restored["session"]
+        st.session_state.logged_messages = len(restored["messages"])
+        st.session_state.turns = restored["turns"]
+        st.session_state.last_message_time = None
 
 # Initialise session state
 if "interview_active" not in st.session_state:
@@ -66,6 +100,15 @@ if "interview_active" not in st.session_state:
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+# Messages shown in the chat (all except system prompt or first message and messages
+# with codes), kept so that reruns redraw the chat without scanning the history
+if "displayed_messages" not in st.session_state:
+    st.session_state.displayed_messages = [
+        message
+        for message in st.session_state.messages[1:]
+        if find_closing_code(message["content"]) is None
+    ]
+
 # Store start time in session state
 if "start_time" not in st.session_state:
     st.session_state.start_time = time.time()
@@ -73,13 +116,80 @@ if "start_time" not in st.session_state:
         "%Y_%m_%d_%H_%M_%S", time.localtime(st.session_state.start_time)
     )
 
-# Check if interview previously completed
-interview_previously_completed = check_if_interview_completed(
-    config.TIMES_DIRECTORY, st.session_state.username
-)
+# Summary of older turns, which replaces them in requests once the history gets too long
+if "context_summary" not in st.session_state:
+    st.session_state.context_summary = new_summary()
+
+# Number of messages already written to the backup of this session
+if "logged_messages" not in st.session_state:
+    st.session_state.logged_messages = 0
+
+# Telemetry of each interviewer message, and when the last one was displayed (to
+# measure the respondent's think time)
+if "turns" not in st.session_state:
+    st.session_state.turns = []
+    st.session_state.last_message_time = None
+
+
+def add_message(role, content, display=True):
+    """Add a message to the interview, and to the chat shown on reruns if displayed."""
+    message = {"role": role, "content": content}
+    st.session_state.messages.append(message)
+    if display:
+        st.session_state.displayed_messages.append(message)
+
+
+@traced("telemetry")
+def record_interviewer_turn(timer, usage, renderer):
+    """Return the telemetry of a finished interviewer message (with the numbers of updates
+    of the streamed message) and add it to the metrics."""
+    turn = timer.record(usage)
+    turn.update(renderer.stats())
+    st.session_state.turns.append(turn)
+    st.session_state.last_message_time = time.time()
+    record_turn(st.session_state.username, turn, queue=write_queue)
+    return turn
+
+
+@traced("backup")
+def append_to_backup_log(**turn):
+    """Queue messages which are not yet in the backup (only the new messages are written, in
+    the background); the telemetry of the turn (latency and token counts) is stored with the
+    latest message."""
+    write_queue.append(
+        st.session_state.username,
+        st.session_state.start_time_file_names,
+        st.session_state.start_time,
+        st.session_state.messages[st.session_state.logged_messages :],
+        **turn,
+    )
+    st.session_state.logged_messages = len(st.session_state.messages)
+
+
+@traced("save_backup")
+def save_backup_transcript(**turn):
+    """Store the complete backup (transcript and time) once the interview has ended, after
+    the queued messages of the session have been written."""
+    append_to_backup_log(**turn)
+    write_queue.flush(
+        st.session_state.username, st.session_state.start_time_file_names, timeout=config.BACKUP_FLUSH_TIMEOUT
+    )
+    storage.save_backup(
+        st.session_state.username,
+        st.session_state.start_time_file_names,
+        st.session_state.start_time,
+        st.session_state.messages,
+        turns=st.session_state.turns,
+    )
+
+# Check if interview previously completed (once per session)
+if "interview_previously_completed" not in st.session_state:
+    st.session_state.interview_previously_completed = storage.is_completed(
+        st.session_state.username
+    )
 
 # If app started but interview was previously completed
-if interview_previously_completed and not st.session_state.messages:
+if st.session_state.interview_previously_completed and not st.session_state.messages:
 
     st.session_state.interview_active = False
     completed_message = "Interview already completed."
@@ -97,35 +207,42 @@ with col2:
 
         # Set interview to inactive, display quit message, and store data
         st.session_state.interview_active = False
-        quit_message = "You have cancelled the interview."
-        st.session_state.messages.append({"role": "assistant", "content": quit_message})
-        save_interview_data(
-            st.session_state.username,
-            config.TRANSCRIPTS_DIRECTORY,
-            config.TIMES_DIRECTORY,
-            st.session_state.messages,
-            st.session_state.start_time,
-        )
-
-
-# Upon rerun, display the previous conversation (except system prompt or first message)
-for message in st.session_state.messages[1:]:
-
-    if message["role"] == "assistant":
-        avatar = config.AVATAR_INTERVIEWER
-    else:
-        avatar = config.AVATAR_RESPONDENT
-    # Only display messages without codes
-    if not any(code in message["content"] for code in config.CLOSING_MESSAGES.keys()):
-        with st.chat_message(message["role"], avatar=avatar):
-            st.markdown(message["content"])
-
-# Load API client
+        add_message("assistant", config.QUIT_MESSAGE)
+        save_backup_transcript()
+        with span("finalise"):
+            storage.finalise(
+                st.session_state.username,
+                st.session_state.messages,
+                st.session_state.start_time,
+                session=st.session_state.start_time_file_names,
+                turns=st.session_state.turns,
+            )
+
+
+@st.cache_resource
+def load_client(client_api, base_url):
+    """API client shared by all sessions of this process, with a bounded pool of
+    keep-alive connections (instead of a new client on every rerun)."""
+    if client_api == "openai":
+        return get_client(client_api, st.secrets["API_KEY_OPENAI"], base_url=base_url)
+    elif client_api == "anthropic":
+        return get_client(client_api, st.secrets["API_KEY_ANTHROPIC"], base_url=base_url)
+
+
+# Load API clients of the model and of the fallback model for hedged requests, if any
+primary = Route(config.MODEL, load_client(api, config.API_BASE_URL), api)
+fallback = None
+if config.FALLBACK_MODEL:
+    fallback_api = api_of(config.FALLBACK_MODEL)
+    fallback = Route(
+        config.FALLBACK_MODEL,
+        load_client(fallback_api, config.FALLBACK_API_BASE_URL),
+        fallback_api,
+    )
+client = primary.client
 if api == "openai":
-    client = OpenAI(api_key=st.secrets["API_KEY_OPENAI"])
-    api_kwargs = {"stream": True}
+    api_kwargs = {}
 elif api == "anthropic":
-    client = anthropic.Anthropic(api_key=st.secrets["API_KEY_ANTHROPIC"])
     api_kwargs = {"system": config.SYSTEM_PROMPT}
 
 # API kwargs
@@ -135,167 +252,175 @@ api_kwargs["max_tokens"] = config.MAX_OUTPUT_TOKENS
 if config.TEMPERATURE is not None:
     api_kwargs["temperature"] = config.TEMPERATURE
 
-# In case the interview history is still empty, pass system prompt to model, and
-# generate and display its first message
-if not st.session_state.messages:
 
+@traced("build_request")
+def interviewer_request():
+    """API kwargs for the next interviewer message: history within the context token budget
+    (folding older turns into the summary if needed), laid out for prompt caching."""
     if api == "openai":
-
-        st.session_state.messages.append(
-            {"role": "system", "content": config.SYSTEM_PROMPT}
-        )
-        with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
-            stream = client.chat.completions.create(**api_kwargs)
-            message_interviewer = st.write_stream(stream)
-
+        create = client.chat.completions.create
     elif api == "anthropic":
-
-        st.session_state.messages.append({"role": "user", "content": "Hi"})
-        with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
-            message_placeholder = st.empty()
-            message_interviewer = ""
-            with client.messages.stream(**api_kwargs) as stream:
-                for text_delta in stream.text_stream:
-                    if text_delta != None:
-                        message_interviewer += text_delta
-                    message_placeholder.markdown(message_interviewer + "▌")
-            message_placeholder.markdown(message_interviewer)
-
-    st.session_state.messages.append(
-        {"role": "assistant", "content": message_interviewer}
+        create = client.messages.create
+    try:
+        st.session_state.context_summary = update_summary(
+            api,
+            create,
+            st.session_state.messages,
+            st.session_state.context_summary,
+            config.SYSTEM_PROMPT,
+            api_kwargs["model"],
+        )
+    except Exception as e:
+        # Continue with the previous summary (and a longer context) if summarising fails
+        print(f"Error updating context summary: {e}")
+    return apply_prompt_caching(
+        api, apply_context_window(api, api_kwargs, st.session_state.context_summary)
     )
 
-    # Store first backup files to record who started the interview
-    save_interview_data(
-        username=st.session_state.username,
-        transcripts_directory=config.BACKUPS_DIRECTORY,
-        times_directory=config.BACKUPS_DIRECTORY,
-        messages=st.session_state.messages,
-        start_time=st.session_state.start_time,
-        file_name_addition_transcript=f"_transcript_started_{st.session_state.start_time_file_names}",
-        file_name_addition_time=f"_time_started_{st.session_state.start_time_file_names}",
-    )
 
+# The chat is a fragment: sending a message only reruns this function, not the whole
+# script, and the conversation so far is redrawn from the list of displayed messages
+@st.fragment
+def chat():
+    """Display the conversation and generate the next interviewer message."""
 
-# Main chat if interview is active
-if st.session_state.interview_active:
+    # Upon rerun, display the previous conversation
+    for message in st.session_state.displayed_messages:
 
-    # Chat input and message for respondent
-    if message_respondent := st.chat_input("Your message here"):
-        st.session_state.messages.append(
-            {"role": "user", "content": message_respondent}
-        )
+        if message["role"] == "assistant":
+            avatar = config.AVATAR_INTERVIEWER
+        else:
+            avatar = config.AVATAR_RESPONDENT
+        with st.chat_message(message["role"], avatar=avatar):
+            st.markdown(message["content"])
 
-        # Display respondent message
-        with st.chat_message("user", avatar=config.AVATAR_RESPONDENT):
-            st.markdown(message_respondent)
+    # In case the interview history is still empty, pass system prompt to model, and
+    # generate and display its first message
+    if not st.session_state.messages:
 
-        # Generate and display interviewer message
-        with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
+        # Start with the system prompt (OpenAI) or a greeting (Anthropic)
+        if api == "openai":
+            add_message("system", config.SYSTEM_PROMPT, display=False)
+        elif api == "anthropic":
+            add_message("user", "Hi", display=False)
 
-            # Create placeholder for message in chat interface
-            message_placeholder = st.empty()
-
-            # Initialise message of interviewer
-            message_interviewer = ""
-
-            if api == "openai":
-
-                # Stream responses
-                stream = client.chat.completions.create(**api_kwargs)
-
-                for message in stream:
-                    text_delta = message.choices[0].delta.content
-                    if text_delta != None:
-                        message_interviewer += text_delta
-                    # Start displaying message only after 5 characters to first check for codes
-                    if len(message_interviewer) > 5:
-                        message_placeholder.markdown(message_interviewer + "▌")
-                    if any(
-                        code in message_interviewer
-                        for code in config.CLOSING_MESSAGES.keys()
-                    ):
-                        # Stop displaying the progress of the message in case of a code
-                        message_placeholder.empty()
-                        break
-
-            elif api == "anthropic":
-
-                # Stream responses
-                with client.messages.stream(**api_kwargs) as stream:
-                    for text_delta in stream.text_stream:
-                        if text_delta != None:
-                            message_interviewer += text_delta
-                        # Start displaying message only after 5 characters to first check for codes
-                        if len(message_interviewer) > 5:
-                            message_placeholder.markdown(message_interviewer + "▌")
-                        if any(
-                            code in message_interviewer
-                            for code in config.CLOSING_MESSAGES.keys()
-                        ):
+        with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
+            renderer = RenderCoalescer(st.empty())
+            chunks = []
+            length = 0
+            request = interviewer_request()
+            timer = TurnTimer("interviewer")
+
+            # Stream response (hedged with the fallback model, if configured); the deltas
+            # are only joined when the message is displayed
+            with span("api_stream"):
+                stream = HedgedStream(primary, fallback, request)
+                for text_delta in stream:
+                    timer.token()
+                    chunks.append(text_delta)
+                    length += len(text_delta)
+                    renderer.update(lambda: "".join(chunks), length)
+                message_interviewer = "".join(chunks)
+                renderer.flush(message_interviewer)
+            timer.served_by(stream.path, stream.model)
+
+        add_message("assistant", message_interviewer)
+
+        # Start backup log to record who started the interview
+        append_to_backup_log(**record_interviewer_turn(timer, stream.usage, renderer))
+
+    # Main chat if interview is active
+    if st.session_state.interview_active:
+
+        # Chat input and message for respondent
+        if message_respondent := st.chat_input("Your message here"):
+            think_seconds = None
+            if st.session_state.last_message_time is not None:
+                think_seconds = time.time() - st.session_state.last_message_time
+            add_message("user", message_respondent)
+
+            # Display respondent message
+            with st.chat_message("user", avatar=config.AVATAR_RESPONDENT):
+                st.markdown(message_respondent)
+
+            # Generate and display interviewer message
+            with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
+
+                # Create placeholder for message in chat interface, which is updated at
+                # a limited frame rate while the message is streamed
+                message_placeholder = st.empty()
+                renderer = RenderCoalescer(message_placeholder)
+
+                # Initialise message of interviewer and detector of closing codes, which holds
+                # back the end of the message while it could be the beginning of a code
+                closing_code_matcher = ClosingCodeMatcher()
+
+                request = interviewer_request()
+                timer = TurnTimer("interviewer", think_seconds=think_seconds)
+
+                # Stream response (hedged with the fallback model, if configured)
+                with span("api_stream"):
+                    stream = HedgedStream(primary, fallback, request)
+                    for text_delta in stream:
+                        timer.token()
+                        if closing_code_matcher.feed(text_delta):
                             # Stop displaying the progress of the message in case of a code
                             message_placeholder.empty()
+                            stream.close()
                             break
-
-            # If no code is in the message, display and store the message
-            if not any(
-                code in message_interviewer for code in config.CLOSING_MESSAGES.keys()
-            ):
-
-                message_placeholder.markdown(message_interviewer)
-                st.session_state.messages.append(
-                    {"role": "assistant", "content": message_interviewer}
-                )
-
-                # Regularly store interview progress as backup, but prevent script from
-                # stopping in case of a write error
-                try:
-
-                    save_interview_data(
-                        username=st.session_state.username,
-                        transcripts_directory=config.BACKUPS_DIRECTORY,
-                        times_directory=config.BACKUPS_DIRECTORY,
-                        messages=st.session_state.messages,
-                        start_time=st.session_state.start_time,
-                        file_name_addition_transcript=f"_transcript_started_{st.session_state.start_time_file_names}",
-                        file_name_addition_time=f"_time_started_{st.session_state.start_time_file_names}",
-                    )
-
-                except:
-
-                    pass
-
-            # If code in the message, display the associated closing message instead
-            # Loop over all codes
-            for code in config.CLOSING_MESSAGES.keys():
-
-                if code in message_interviewer:
-                    # Store message in list of messages
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": message_interviewer}
-                    )
-
-                    # Set chat to inactive and display closing message
-                    st.session_state.interview_active = False
+                        renderer.update(
+                            lambda: closing_code_matcher.display_text, closing_code_matcher.display_length
+                        )
+                message_interviewer = closing_code_matcher.text
+                timer.served_by(stream.path, stream.model)
+
+                # Display the message, or in case of a code the associated closing message
+                # instead, before the telemetry (including the last update) is recorded
+                code = closing_code_matcher.code
+                if code is None:
+                    renderer.flush(message_interviewer)
+                else:
                     closing_message = config.CLOSING_MESSAGES[code]
-                    st.markdown(closing_message)
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": closing_message}
-                    )
+                    renderer.flush(closing_message)
+                turn = record_interviewer_turn(timer, stream.usage, renderer)
+
+                # If no code is in the message, store the message
+                if code is None:
+
+                    add_message("assistant", message_interviewer)
+
+                    # Regularly store interview progress as backup (only the new messages,
+                    # written in the background; write errors are counted by the queue)
+                    append_to_backup_log(**turn)
+
+                # If code in the message, store the closing message instead
+                else:
 
-                    # Store final transcript and time
-                    final_transcript_stored = False
-                    while final_transcript_stored == False:
+                    # Store message in list of messages (but do not display it)
+                    add_message("assistant", message_interviewer, display=False)
 
-                        save_interview_data(
+                    # Set chat to inactive and store the displayed closing message
+                    st.session_state.interview_active = False
+                    add_message("assistant", closing_message)
+
+                    # Store backup, then final transcript and time (written atomically,
+                    # followed by the completion marker)
+                    save_backup_transcript(**turn)
+                    with span("finalise"):
+                        storage.finalise(
                             username=st.session_state.username,
-                            transcripts_directory=config.TRANSCRIPTS_DIRECTORY,
-                            times_directory=config.TIMES_DIRECTORY,
                             messages=st.session_state.messages,
                             start_time=st.session_state.start_time,
+                            closing_code=code,
+                            session=st.session_state.start_time_file_names,
+                            turns=st.session_state.turns,
                         )
 
-                        final_transcript_stored = check_if_interview_completed(
-                            config.TRANSCRIPTS_DIRECTORY, st.session_state.username
-                        )
-                        time.sleep(0.1)
+                    # Rerun the whole app to remove the chat input and 'Quit' button
+                    st.rerun()
+
+    # Append the spans of this run to the trace file, if profiling
+    flush_trace()
+
+
+chat()
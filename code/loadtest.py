@@ -0,0 +1,524 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from tornado.websocket import websocket_connect
+
+import config
+from benchmark import directory_size, use_data_directory
+from telemetry import QUANTILES, quantile
+
+
+# Load test of the interview app with concurrent respondents. The app runs as it
+# does in production: one `streamlit run interview.py` server (in a process of its
+# own, started by this script with `--serve`, which points the app at the mock
+# provider and a data directory of the level), logging in respondents with the
+# `username` and `password` query parameters. Scripted respondents are browser
+# sessions, simulated with Streamlit's websocket protocol: each connects to the
+# server, reruns the app with its answers in the chat input and waits until the run
+# has ended, i.e. the interviewer's reply is shown. The mock provider (mock_llm.py)
+# runs in a separate process as well, so that the CPU time and memory sampled are
+# those of the server. For each number of concurrent respondents (ramped up with
+# `--levels`, each level with a fresh server), the report lists the p50/p95/p99 time
+# from sending an answer until the reply is shown, the server's CPU utilisation,
+# memory (RSS) and threads, the files written and the errors of each respondent,
+# together with the settings and versions used, so that reports of different
+# releases can be compared (`--baseline`).
+#
+# Example:
+#   python loadtest.py --levels 1,4,16 --turns 5 --output loadtest.json
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "interview.py")
+MOCK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_llm.py")
+PASSWORD = "loadtest"
+SECRETS = f"""API_KEY_OPENAI = "mock"
+API_KEY_ANTHROPIC = "mock"
+
+[passwords]
+PASSWORD = "{PASSWORD}"
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout, name):
+    """Wait until a process started by the load test accepts connections."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError(f"{name} did not start.")
+            time.sleep(0.05)
+
+
+@contextlib.contextmanager
+def mock_provider(args):
+    """Run the mock provider in a separate process and yield its URL."""
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            MOCK_PATH,
+            "--port",
+            str(port),
+            "--ttft",
+            str(args.ttft),
+            "--tokens-per-second",
+            str(args.tokens_per_second),
+            "--output-tokens",
+            str(args.output_tokens),
+            "--close-after-turns",
+            str(args.turns),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port, process, 10, "Mock provider")
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@contextlib.contextmanager
+def app_server(args, data_directory, base_url, working_directory):
+    """Run the app's Streamlit server in a separate process and yield it with its URL; the
+    server is stopped (and has written all queued backups) when the context is left."""
+    port = free_port()
+    stderr = tempfile.TemporaryFile(mode="w+")
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--serve",
+            "--port",
+            str(port),
+            "--data",
+            data_directory,
+            "--base-url",
+            base_url,
+            "--provider",
+            args.provider,
+        ],
+        # The server reads the secrets from .streamlit/secrets.toml in its working directory
+        cwd=working_directory,
+        stdout=subprocess.DEVNULL,
+        stderr=stderr,
+    )
+    try:
+        try:
+            wait_for_port(port, process, 60, "App server")
+        except RuntimeError:
+            stderr.seek(0)
+            raise RuntimeError(f"App server did not start: {' '.join(stderr.read().strip().splitlines()[-3:])}")
+        yield process, f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        stderr.close()
+
+
+def configure(provider, base_url):
+    """Settings of the app under test: the provider is selected by the model name, and
+    respondents are logged in with the URL parameters."""
+    config.MODEL = "gpt-mock" if provider == "openai" else "claude-mock"
+    config.FALLBACK_MODEL = None
+    config.LOGINS = True
+    config.RESTORE_SESSIONS = False
+    config.API_BASE_URL = f"{base_url}/v1" if provider == "openai" else base_url
+
+
+def serve(args):
+    """Run `streamlit run interview.py` in this process (started by app_server), with the
+    settings of the load test; the app imports the configuration changed here."""
+    configure(args.provider, args.base_url)
+    use_data_directory(args.data, fresh=False)
+    from streamlit.web import cli
+
+    cli.main(
+        [
+            "run",
+            APP_PATH,
+            "--server.port",
+            str(args.port),
+            "--server.address",
+            "127.0.0.1",
+            "--server.headless",
+            "true",
+            "--server.fileWatcherType",
+            "none",
+            "--global.developmentMode",
+            "false",
+            "--browser.gatherUsageStats",
+            "false",
+        ],
+        prog_name="streamlit",
+    )
+
+
+class ProcessSampler:
+    """Samples the CPU time, resident memory and threads of a process from /proc (Linux; on
+    other systems, all measurements are None)."""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_bytes = None
+        self.peak_threads = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="loadtest-sampler", daemon=True)
+
+    def sample(self):
+        """CPU seconds, RSS bytes and threads of the process now (None if not available)."""
+        try:
+            with open(f"/proc/{self.pid}/stat", "r") as f:
+                # Fields after the process name, which may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{self.pid}/status", "r") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            return None
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss_bytes = int(status["VmRSS"].split()[0]) * 1024
+        threads = int(status["Threads"])
+        self.peak_rss_bytes = max(self.peak_rss_bytes or 0, rss_bytes)
+        self.peak_threads = max(self.peak_threads or 0, threads)
+        return cpu_seconds, rss_bytes, threads
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def count_files(directory):
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+def answer(username, turn):
+    """Scripted answer of a respondent."""
+    return f"This is answer {turn + 1} of {username}. " + "We work long hours before deadlines. " * 5
+
+
+class BrowserSession:
+    """Session of a respondent in the app, as a browser has it: a websocket to the server
+    over which it requests reruns of the app (BackMsg) and receives what the runs display
+    (ForwardMsg)."""
+
+    def __init__(self, url, username):
+        self.url = url.replace("http", "ws", 1) + "/_stcore/stream"
+        self.query_string = urlencode({"username": username, "password": PASSWORD})
+        self.connection = None
+        self.page_script_hash = ""
+        # Chat input of the last run, with the fragment it belongs to (None once the interview has ended)
+        self.chat_input = None
+        # Messages the server may later only send a reference to
+        self.cached_messages = {}
+
+    async def connect(self):
+        self.connection = await websocket_connect(self.url, subprotocols=["streamlit"])
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    async def rerun(self, chat_message=None):
+        """Rerun the app (only the chat fragment when sending a chat message, as the browser
+        does) and wait until the run has ended; return the error it displayed, if any."""
+        message = BackMsg()
+        message.rerun_script.query_string = self.query_string
+        message.rerun_script.page_script_hash = self.page_script_hash
+        if chat_message is not None:
+            widget_id, fragment_id = self.chat_input
+            widget = message.rerun_script.widget_states.widgets.add()
+            widget.id = widget_id
+            widget.string_trigger_value.data = chat_message
+            message.rerun_script.fragment_id = fragment_id
+        await self.connection.write_message(message.SerializeToString(), binary=True)
+        return await self.finish_run()
+
+    async def finish_run(self):
+        """Read the messages of the current run until it has ended (including runs started
+        by st.rerun); return the error it displayed, if any."""
+        chat_input = None
+        error = None
+        while True:
+            payload = await self.connection.read_message()
+            if payload is None:
+                raise ConnectionError("The server closed the connection.")
+            message = ForwardMsg()
+            message.ParseFromString(payload)
+            if message.WhichOneof("type") == "ref_hash":
+                message = self.cached_messages[message.ref_hash]
+            elif message.metadata.cacheable:
+                self.cached_messages[message.hash] = message
+
+            kind = message.WhichOneof("type")
+            if kind == "new_session":
+                self.page_script_hash = message.new_session.page_script_hash
+            elif kind == "delta" and message.delta.WhichOneof("type") == "new_element":
+                element = message.delta.new_element
+                element_type = element.WhichOneof("type")
+                if element_type == "chat_input":
+                    chat_input = (element.chat_input.id, message.delta.fragment_id)
+                elif element_type == "exception":
+                    error = element.exception.message
+                elif element_type == "alert" and element.alert.format == Alert.ERROR:
+                    error = element.alert.body
+            elif kind == "script_finished":
+                if message.script_finished == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    chat_input = None
+                    continue
+                if message.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    error = error or "The app could not be compiled."
+                self.chat_input = chat_input
+                return error
+
+
+async def run_respondent(session, username, args):
+    """Go through one interview in the app (connected session); return the latencies of its
+    turns and any error."""
+    opening_seconds = None
+    latencies = []
+    try:
+        # First run: login and opening message of the interviewer
+        started = time.perf_counter()
+        error = await asyncio.wait_for(session.rerun(), args.timeout)
+        opening_seconds = time.perf_counter() - started
+        if error:
+            return {"opening_seconds": opening_seconds, "latencies": latencies, "error": error}
+
+        for turn in range(args.turns):
+            if session.chat_input is None:
+                break
+            await asyncio.sleep(args.think_time)
+            started = time.perf_counter()
+            error = await asyncio.wait_for(session.rerun(answer(username, turn)), args.timeout)
+            latencies.append(time.perf_counter() - started)
+            if error:
+                return {"opening_seconds": opening_seconds, "latencies": latencies, "error": error}
+        completed = session.chat_input is None
+    except Exception as e:
+        return {"opening_seconds": opening_seconds, "latencies": latencies, "error": repr(e)}
+    finally:
+        session.close()
+    return {"opening_seconds": opening_seconds, "latencies": latencies, "completed": completed, "error": None}
+
+
+async def run_respondents(url, usernames, args, sampler):
+    """Run the interviews of all respondents at the same time; return their results, the
+    seconds taken and the server's CPU seconds meanwhile."""
+    sessions = [BrowserSession(url, username) for username in usernames]
+    # All respondents connect before the interviews start together
+    connections = await asyncio.gather(*(session.connect() for session in sessions), return_exceptions=True)
+    before = sampler.sample()
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            run_respondent(session, username, args)
+            for session, username, connection in zip(sessions, usernames, connections)
+            if connection is None
+        )
+    )
+    elapsed = time.perf_counter() - started
+    after = sampler.sample()
+    cpu_seconds = after[0] - before[0] if before and after else None
+
+    results = iter(results)
+    return (
+        {
+            username: next(results)
+            if connection is None
+            else {"opening_seconds": None, "latencies": [], "error": f"Connection failed: {connection!r}"}
+            for username, connection in zip(usernames, connections)
+        },
+        elapsed,
+        cpu_seconds,
+    )
+
+
+def run_level(respondents, args, data_directory, base_url, working_directory):
+    """Run `respondents` interviews at the same time against a fresh app server and return
+    the measurements."""
+    use_data_directory(data_directory)
+    usernames = [f"loadtest_{respondents}_{number + 1}" for number in range(respondents)]
+    with app_server(args, data_directory, base_url, working_directory) as (process, url):
+        sampler = ProcessSampler(process.pid)
+        idle = sampler.sample()
+        sampler.start()
+        try:
+            results, elapsed, cpu_seconds = asyncio.run(run_respondents(url, usernames, args, sampler))
+        finally:
+            sampler.stop()
+
+    latencies = sorted(latency for result in results.values() for latency in result["latencies"])
+    openings = sorted(
+        result["opening_seconds"] for result in results.values() if result["opening_seconds"] is not None
+    )
+    errors = {username: result["error"] for username, result in results.items() if result["error"]}
+    level = {
+        "respondents": respondents,
+        "seconds": round(elapsed, 3),
+        "turns": len(latencies),
+        "completed_interviews": sum(1 for result in results.values() if result.get("completed")),
+        "errors": len(errors),
+        # CPU time, memory and threads of the server process
+        "cpu_seconds": round(cpu_seconds, 3) if cpu_seconds is not None else None,
+        "cpu_utilisation": round(cpu_seconds / elapsed, 3) if cpu_seconds is not None else None,
+        "idle_rss_bytes": idle[1] if idle else None,
+        "peak_rss_bytes": sampler.peak_rss_bytes,
+        "peak_threads": sampler.peak_threads,
+        # Written once the server has stopped, which writes the backups still queued
+        "files_written": count_files(data_directory),
+        "bytes_written": directory_size(data_directory),
+    }
+    for q in QUANTILES:
+        level[f"turn_latency_p{int(q * 100)}"] = round(quantile(latencies, q), 4) if latencies else None
+        level[f"opening_latency_p{int(q * 100)}"] = round(quantile(openings, q), 4) if openings else None
+    if errors:
+        level["respondent_errors"] = errors
+    return level
+
+
+def environment():
+    """Versions and machine of a load test, to compare reports."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(APP_PATH)
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    try:
+        import streamlit
+
+        streamlit_version = streamlit.__version__
+    except ImportError:
+        streamlit_version = None
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "streamlit": streamlit_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(report, baseline):
+    """Print the change of the turn latencies against an earlier report."""
+    previous = {level["respondents"]: level for level in baseline["levels"]}
+    for level in report["levels"]:
+        before = previous.get(level["respondents"])
+        if before is None:
+            continue
+        changes = []
+        for q in QUANTILES:
+            key = f"turn_latency_p{int(q * 100)}"
+            if level[key] and before.get(key):
+                changes.append(f"p{int(q * 100)} {100 * (level[key] / before[key] - 1):+.1f}%")
+        print(f"{level['respondents']:4} respondents vs baseline: {', '.join(changes) or 'no turns'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the interview app with concurrent scripted respondents.")
+    parser.add_argument("--provider", choices=["openai", "anthropic"], default="openai")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated numbers of concurrent respondents.")
+    parser.add_argument("--turns", type=int, default=5, help="Respondent turns before the closing code.")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Seconds a respondent waits before answering.")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Mock time to first token in seconds.")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Mock generation speed (0 for instant).")
+    parser.add_argument("--output-tokens", type=int, default=40, help="Mock tokens per reply.")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds a single app run may take.")
+    parser.add_argument("--output", help="Write the capacity report to this JSON file.")
+    parser.add_argument("--baseline", help="Earlier report to compare the turn latencies with.")
+    parser.add_argument("--max-p95", type=float, help="Fail if the p95 turn latency of any level is larger.")
+    # Arguments of the app server process (see serve)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--data", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    data_root = tempfile.mkdtemp(prefix="interview_loadtest_")
+    os.makedirs(os.path.join(data_root, ".streamlit"))
+    with open(os.path.join(data_root, ".streamlit", "secrets.toml"), "w") as f:
+        f.write(SECRETS)
+    levels = []
+    with contextlib.ExitStack() as cleanup:
+        cleanup.callback(shutil.rmtree, data_root, ignore_errors=True)
+        url = cleanup.enter_context(mock_provider(args))
+        for respondents in (int(level) for level in args.levels.split(",")):
+            # Every level writes to a directory of its own
+            data_directory = os.path.join(data_root, f"{respondents}_respondents")
+            level = run_level(respondents, args, data_directory, url, data_root)
+            levels.append(level)
+            p50, p95, p99 = (level[f"turn_latency_p{int(q * 100)}"] for q in QUANTILES)
+            print(
+                f"{respondents:4} respondents  {level['turns']} turns  "
+                f"p50/p95/p99 {p50 or 0:.3f}/{p95 or 0:.3f}/{p99 or 0:.3f}s  "
+                f"server CPU {100 * (level['cpu_utilisation'] or 0):.0f}%  "
+                f"RSS {(level['peak_rss_bytes'] or 0) / 2**20:.0f} MiB  "
+                f"{level['peak_threads'] or 0} threads  "
+                f"{level['files_written']} files ({level['bytes_written'] / 1024:.0f} KiB)  "
+                f"{level['errors']} errors"
+            )
+
+    arguments = {key: value for key, value in vars(args).items() if key not in ("serve", "port", "data", "base_url")}
+    report = {"environment": environment(), "arguments": arguments, "levels": levels}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(report, json.load(f))
+
+    # Regression checks
+    failed = False
+    for level in levels:
+        if level["errors"]:
+            print(f"FAIL: {level['errors']} respondents with errors at {level['respondents']} respondents")
+            for username, error in level["respondent_errors"].items():
+                print(f"  {username}: {error}")
+            failed = True
+        if args.max_p95 and (level["turn_latency_p95"] or 0) > args.max_p95:
+            print(f"FAIL: p95 turn latency above {args.max_p95}s at {level['respondents']} respondents")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,606 @@
+import argparse
+import collections
+import email
+import email.policy
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+
+# Local stand-in for the OpenAI chat completions API and the Anthropic messages
+# API (streaming and non-streaming), including their batch APIs (OpenAI files and
+# batches, Anthropic message batches), to test and benchmark the platform without
+# network access or API costs. Point the clients to it with `base_url`:
+# `f"{server.url}/v1"` for OpenAI and `server.url` for Anthropic.
+# With `requests_per_minute`, the server enforces a request limit over a sliding
+# minute and sends the providers' rate-limit headers, to test rate limiting.
+
+WORDS = (
+    "culture integrity team pressure deadline review budget client partner manager "
+    "example story time quality colleague feedback value judgement trust practice"
+).split()
+
+
+class MockLLMServer:
+    """HTTP server answering chat requests with generated text after a configurable delay."""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        ttft=0.0,
+        tokens_per_second=None,
+        output_tokens=40,
+        rate_limit_probability=0.0,
+        close_after_turns=5,
+        batch_delay=0.0,
+        requests_per_minute=None,
+        seed=0,
+    ):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.rate_limit_probability = rate_limit_probability
+        self.close_after_turns = close_after_turns
+        self.batch_delay = batch_delay
+        self.requests_per_minute = requests_per_minute
+        self.request_times = collections.deque()  # Admitted requests in the last minute
+        self.random = random.Random(seed)
+
+        # Closing codes are emitted in turn, e.g. '5j3k' for one interview, 'x7y8' for the next
+        self.closing_codes = itertools.cycle(config.CLOSING_MESSAGES.keys())
+
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "rate_limited": 0,
+            "closing_codes": 0,
+            "busy_seconds": 0.0,
+            "batches": 0,
+            "batch_requests": 0,
+        }
+
+        # Uploaded files (OpenAI) and submitted batches (both APIs) by id
+        self.files = {}
+        self.batches = {}
+
+        # System prompts seen before, to emulate prompt caching
+        self.cached_prompts = set()
+
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def should_rate_limit(self):
+        with self.lock:
+            return self.random.random() < self.rate_limit_probability
+
+    def admit(self):
+        """Admit a request under `requests_per_minute` and return whether it was admitted and
+        its rate-limit headers (in the style of both providers)."""
+        now = time.time()
+        with self.lock:
+            while self.request_times and self.request_times[0] <= now - 60:
+                self.request_times.popleft()
+            admitted = len(self.request_times) < self.requests_per_minute
+            if admitted:
+                self.request_times.append(now)
+            remaining = self.requests_per_minute - len(self.request_times)
+            reset = self.request_times[0] + 60 - now if self.request_times else 0.0
+        reset_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now + reset))
+        headers = {
+            "x-ratelimit-limit-requests": str(self.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+            "anthropic-ratelimit-requests-limit": str(self.requests_per_minute),
+            "anthropic-ratelimit-requests-remaining": str(remaining),
+            "anthropic-ratelimit-requests-reset": reset_time,
+        }
+        if not admitted:
+            headers["retry-after"] = str(max(1, round(reset)))
+        return admitted, headers
+
+    def generate_reply(self, system_prompt, messages):
+        """Return the tokens of the reply: a closing code when due, otherwise random words."""
+
+        # Only the interviewer's system prompt contains the closing codes
+        is_interviewer = any(code in system_prompt for code in config.CLOSING_MESSAGES.keys())
+        respondent_turns = sum(1 for message in messages if message["role"] == "assistant")
+        if is_interviewer and self.close_after_turns and respondent_turns >= self.close_after_turns:
+            with self.lock:
+                self.stats["closing_codes"] += 1
+                code = next(self.closing_codes)
+            # Split the code so that it arrives in several stream deltas
+            return [code[:2], code[2:]]
+
+        with self.lock:
+            return [self.random.choice(WORDS) + " " for _ in range(self.output_tokens)]
+
+    def cached_tokens(self, system_prompt):
+        """Number of cached prompt tokens: the system prompt, if it was sent before."""
+        with self.lock:
+            cached = system_prompt in self.cached_prompts
+            self.cached_prompts.add(system_prompt)
+        return len(system_prompt) // 4 if cached else 0
+
+    def token_delay(self):
+        if not self.tokens_per_second:
+            return 0.0
+        return 1 / self.tokens_per_second
+
+    def chat_completion_response(self, body):
+        """Return the (non-streaming) chat completion of a request and the tokens of its reply."""
+        messages = body["messages"]
+        system_prompt = _text(messages[0]["content"]) if messages and messages[0]["role"] == "system" else ""
+        tokens = self.generate_reply(system_prompt, messages)
+        prompt_tokens = _estimate_tokens(messages)
+        # Automatic caching applies to prompts with at least 1024 tokens, in steps of 128
+        cached_tokens = self.cached_tokens(system_prompt) // 128 * 128 if prompt_tokens >= 1024 else 0
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        response = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage,
+        }
+        return response, tokens
+
+    def anthropic_message_response(self, body):
+        """Return the (non-streaming) message of a request and the tokens of its reply."""
+        messages = body["messages"]
+        system = body.get("system", "")
+        system_prompt = _text(system)
+        tokens = self.generate_reply(system_prompt, messages)
+        usage = {"input_tokens": _estimate_tokens(messages, system_prompt), "output_tokens": len(tokens)}
+
+        # Emulate caching of a system prompt with a cache breakpoint
+        if not isinstance(system, str) and any("cache_control" in block for block in system):
+            cached_tokens = self.cached_tokens(system_prompt)
+            usage["input_tokens"] -= len(system_prompt) // 4
+            usage["cache_read_input_tokens"] = cached_tokens
+            usage["cache_creation_input_tokens"] = len(system_prompt) // 4 - cached_tokens
+        response = {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body["model"],
+            "content": [{"type": "text", "text": "".join(tokens).strip()}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": usage,
+        }
+        return response, tokens
+
+    def create_batch(self, provider, requests):
+        """Process a batch of (custom_id, request body) items at once; the batch is reported as
+        finished after `batch_delay` seconds. Items fail with the rate limit probability."""
+        results = []
+        for custom_id, body in requests:
+            if self.should_rate_limit():
+                self.count("rate_limited")
+                results.append((custom_id, None))
+            elif provider == "openai":
+                results.append((custom_id, self.chat_completion_response(body)[0]))
+            else:
+                results.append((custom_id, self.anthropic_message_response(body)[0]))
+
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}" if provider == "openai" else f"msgbatch_{uuid.uuid4().hex}",
+            "provider": provider,
+            "created_at": time.time(),
+            "results": results,
+        }
+        with self.lock:
+            self.batches[batch["id"]] = batch
+            self.stats["batches"] += 1
+            self.stats["batch_requests"] += len(requests)
+        return batch
+
+    def batch_finished(self, batch):
+        return time.time() - batch["created_at"] >= self.batch_delay
+
+
+def _text(content):
+    """Text of a message content given either as a string or as a list of content blocks."""
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def _timestamp(seconds):
+    """RFC 3339 timestamp, as used by the Anthropic API."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def _estimate_tokens(messages, system_prompt=""):
+    return (len(system_prompt) + sum(len(_text(message["content"])) for message in messages)) // 4
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            started = time.time()
+            server.count("requests")
+            self.extra_headers = {}
+            path = self.path.split("?")[0]
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            # Batch APIs
+            if path.endswith("/files"):
+                self.upload_file(data)
+                return
+            if path.endswith("/messages/batches"):
+                self.anthropic_batch_create(json.loads(data))
+                return
+            if path.endswith("/batches"):
+                self.openai_batch_create(json.loads(data))
+                return
+
+            body = json.loads(data or b"{}")
+            if path.endswith("/chat/completions"):
+                provider = "openai"
+            elif path.endswith("/messages"):
+                provider = "anthropic"
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+
+            if server.requests_per_minute:
+                admitted, self.extra_headers = server.admit()
+                if not admitted:
+                    server.count("rate_limited")
+                    self.send_rate_limit(provider)
+                    server.count("busy_seconds", time.time() - started)
+                    return
+
+            if server.should_rate_limit():
+                server.count("rate_limited")
+                self.send_rate_limit(provider)
+            elif provider == "openai":
+                self.chat_completion(body)
+            else:
+                self.anthropic_message(body)
+            server.count("busy_seconds", time.time() - started)
+
+        def do_GET(self):
+            server.count("requests")
+            self.extra_headers = {}
+            parts = self.path.split("?")[0].strip("/").split("/")
+
+            # /v1/files/{id}/content, /v1/batches/{id}, /v1/messages/batches/{id}[/results]
+            if parts[-3:-2] == ["files"] and parts[-1] == "content" and parts[-2] in server.files:
+                self.send_bytes(server.files[parts[-2]]["content"], "application/octet-stream")
+            elif parts[-2:-1] == ["batches"] and parts[-1] in server.batches:
+                batch = server.batches[parts[-1]]
+                if batch["provider"] == "openai":
+                    self.send_json(200, self.openai_batch(batch))
+                else:
+                    self.send_json(200, self.anthropic_batch(batch))
+            elif parts[-3:-2] == ["batches"] and parts[-1] == "results" and parts[-2] in server.batches:
+                self.anthropic_batch_results(server.batches[parts[-2]])
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def send_bytes(self, data, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def upload_file(self, data):
+            """Store the file of a multipart upload (OpenAI files API)."""
+            form = email.message_from_bytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + data,
+                policy=email.policy.HTTP,
+            )
+            fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+            content = fields["file"].get_payload(decode=True)
+            file_object = {
+                "id": f"file-{uuid.uuid4().hex}",
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": fields["file"].get_filename() or "upload.jsonl",
+                "purpose": fields["purpose"].get_content().strip() if "purpose" in fields else "batch",
+                "status": "processed",
+            }
+            server.files[file_object["id"]] = dict(file_object, content=content)
+            self.send_json(200, file_object)
+
+        def openai_batch_create(self, body):
+            lines = server.files[body["input_file_id"]]["content"].decode().splitlines()
+            requests = [(line["custom_id"], line["body"]) for line in map(json.loads, filter(None, lines))]
+            batch = server.create_batch("openai", requests)
+
+            # Output and error files in the format of the batch API
+            output, errors = [], []
+            for custom_id, response in batch["results"]:
+                if response is not None:
+                    output.append(
+                        {
+                            "id": f"batch_req_{uuid.uuid4().hex}",
+                            "custom_id": custom_id,
+                            "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": response},
+                            "error": None,
+                        }
+                    )
+                else:
+                    errors.append(
+                        {
+                            "id": f"batch_req_{uuid.uuid4().hex}",
+                            "custom_id": custom_id,
+                            "response": {
+                                "status_code": 429,
+                                "request_id": uuid.uuid4().hex,
+                                "body": {"error": {"message": "Rate limit reached (mock).", "type": "rate_limit_error"}},
+                            },
+                            "error": None,
+                        }
+                    )
+            for key, records in [("output_file_id", output), ("error_file_id", errors)]:
+                batch[key] = None
+                if records:
+                    batch[key] = f"file-{uuid.uuid4().hex}"
+                    content = "".join(json.dumps(record) + "\n" for record in records).encode()
+                    server.files[batch[key]] = {"content": content}
+            batch["endpoint"] = body["endpoint"]
+            batch["input_file_id"] = body["input_file_id"]
+            batch["completion_window"] = body.get("completion_window", "24h")
+            batch["counts"] = (len(requests), len(output), len(errors))
+            self.send_json(200, self.openai_batch(batch))
+
+        def openai_batch(self, batch):
+            finished = server.batch_finished(batch)
+            total, completed, failed = batch["counts"]
+            created_at = int(batch["created_at"])
+            return {
+                "id": batch["id"],
+                "object": "batch",
+                "endpoint": batch["endpoint"],
+                "errors": None,
+                "input_file_id": batch["input_file_id"],
+                "completion_window": batch["completion_window"],
+                "status": "completed" if finished else "in_progress",
+                "output_file_id": batch["output_file_id"] if finished else None,
+                "error_file_id": batch["error_file_id"] if finished else None,
+                "created_at": created_at,
+                "in_progress_at": created_at,
+                "expires_at": created_at + 24 * 3600,
+                "completed_at": int(time.time()) if finished else None,
+                "request_counts": {
+                    "total": total,
+                    "completed": completed if finished else 0,
+                    "failed": failed if finished else 0,
+                },
+                "metadata": None,
+            }
+
+        def anthropic_batch_create(self, body):
+            requests = [(request["custom_id"], request["params"]) for request in body["requests"]]
+            batch = server.create_batch("anthropic", requests)
+            self.send_json(200, self.anthropic_batch(batch))
+
+        def anthropic_batch(self, batch):
+            finished = server.batch_finished(batch)
+            succeeded = sum(1 for _, response in batch["results"] if response is not None)
+            return {
+                "id": batch["id"],
+                "type": "message_batch",
+                "processing_status": "ended" if finished else "in_progress",
+                "request_counts": {
+                    "processing": 0 if finished else len(batch["results"]),
+                    "succeeded": succeeded if finished else 0,
+                    "errored": len(batch["results"]) - succeeded if finished else 0,
+                    "canceled": 0,
+                    "expired": 0,
+                },
+                "created_at": _timestamp(batch["created_at"]),
+                "expires_at": _timestamp(batch["created_at"] + 24 * 3600),
+                "ended_at": _timestamp(time.time()) if finished else None,
+                "cancel_initiated_at": None,
+                "archived_at": None,
+                "results_url": f"{server.url}/v1/messages/batches/{batch['id']}/results" if finished else None,
+            }
+
+        def anthropic_batch_results(self, batch):
+            records = []
+            for custom_id, response in batch["results"]:
+                if response is not None:
+                    result = {"type": "succeeded", "message": response}
+                else:
+                    result = {
+                        "type": "errored",
+                        "error": {
+                            "type": "error",
+                            "error": {"type": "rate_limit_error", "message": "Rate limit reached (mock)."},
+                        },
+                    }
+                records.append({"custom_id": custom_id, "result": result})
+            self.send_bytes("".join(json.dumps(record) + "\n" for record in records).encode(), "application/binary")
+
+        def send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in {**self.extra_headers, **(headers or {})}.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_rate_limit(self, provider):
+            message = "Rate limit reached (mock)."
+            if provider == "openai":
+                payload = {"error": {"message": message, "type": "rate_limit_error", "code": "rate_limit_exceeded"}}
+            else:
+                payload = {"type": "error", "error": {"type": "rate_limit_error", "message": message}}
+            self.send_json(429, payload, headers={"retry-after": self.extra_headers.get("retry-after", "1")})
+
+        def start_stream(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            for name, value in self.extra_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.close_connection = True
+
+        def send_event(self, data, event=None):
+            if event:
+                self.wfile.write(f"event: {event}\n".encode())
+            self.wfile.write(f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode())
+            self.wfile.flush()
+
+        def chat_completion(self, body):
+            response, tokens = server.chat_completion_response(body)
+            time.sleep(server.ttft)
+
+            if not body.get("stream"):
+                time.sleep(server.token_delay() * len(tokens))
+                self.send_json(200, response)
+                return
+
+            def chunk(delta, finish_reason=None):
+                return {
+                    "id": response["id"],
+                    "object": "chat.completion.chunk",
+                    "created": response["created"],
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+
+            self.start_stream()
+            self.send_event(chunk({"role": "assistant", "content": ""}))
+            for token in tokens:
+                self.send_event(chunk({"content": token}))
+                time.sleep(server.token_delay())
+            self.send_event(chunk({}, finish_reason="stop"))
+            if body.get("stream_options", {}).get("include_usage"):
+                final = chunk({})
+                final["choices"] = []
+                final["usage"] = response["usage"]
+                self.send_event(final)
+            self.send_event("[DONE]")
+
+        def anthropic_message(self, body):
+            response, tokens = server.anthropic_message_response(body)
+            time.sleep(server.ttft)
+
+            if not body.get("stream"):
+                time.sleep(server.token_delay() * len(tokens))
+                self.send_json(200, response)
+                return
+
+            message = dict(response, content=[], stop_reason=None)
+            self.start_stream()
+            self.send_event({"type": "message_start", "message": message}, event="message_start")
+            self.send_event(
+                {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                event="content_block_start",
+            )
+            for token in tokens:
+                self.send_event(
+                    {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}},
+                    event="content_block_delta",
+                )
+                time.sleep(server.token_delay())
+            self.send_event({"type": "content_block_stop", "index": 0}, event="content_block_stop")
+            self.send_event(
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": len(tokens)},
+                },
+                event="message_delta",
+            )
+            self.send_event({"type": "message_stop"}, event="message_stop")
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenAI and Anthropic APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.3, help="Time to first token in seconds.")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="0 for no delay between tokens.")
+    parser.add_argument("--output-tokens", type=int, default=40, help="Number of tokens per reply.")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="Share of requests answered with 429.")
+    parser.add_argument(
+        "--close-after-turns",
+        type=int,
+        default=5,
+        help="Interviewer replies with a closing code after this many respondent turns (0 for never).",
+    )
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="Seconds until a submitted batch is finished.")
+    parser.add_argument("--requests-per-minute", type=int, help="Enforce this request limit and send rate-limit headers.")
+    args = parser.parse_args()
+
+    server = MockLLMServer(
+        host=args.host,
+        port=args.port,
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        rate_limit_probability=args.rate_limit_probability,
+        close_after_turns=args.close_after_turns,
+        batch_delay=args.batch_delay,
+        requests_per_minute=args.requests_per_minute,
+    )
+    print(f"Mock LLM API listening on {server.url} (OpenAI base URL: {server.url}/v1)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
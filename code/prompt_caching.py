@@ -0,0 +1,70 @@
+import hashlib
+
+import config
+
+
+# Prompt caching. Every turn resends the long system prompt and the whole history,
+# so requests are laid out such that providers can reuse the identical prefix:
+# - Anthropic: `cache_control` breakpoints on the system prompt and on the latest
+#   message; the next turn's request starts with exactly this cached prefix.
+# - OpenAI: caching is automatic for identical prefixes, so the system prompt stays
+#   the first message and the history is never rewritten. A `prompt_cache_key`
+#   derived from the system prompt routes requests with the same prefix together.
+# Cached and uncached input tokens are reported per call by `usage_record`.
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def _cached_content(content):
+    """Content blocks of a message content, with a cache breakpoint on the last block."""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": CACHE_CONTROL}]
+    blocks = [dict(block) for block in content]
+    blocks[-1]["cache_control"] = CACHE_CONTROL
+    return blocks
+
+
+def prompt_cache_key(system_prompt):
+    """Stable key for all requests which share a system prompt."""
+    return "interview-" + hashlib.sha256(system_prompt.encode()).hexdigest()[:16]
+
+
+def apply_prompt_caching(api, api_kwargs):
+    """Return a copy of the API kwargs laid out for prompt caching (the history is not changed)."""
+    if not config.PROMPT_CACHING:
+        return api_kwargs
+
+    api_kwargs = dict(api_kwargs)
+    messages = api_kwargs["messages"]
+    if api == "anthropic":
+        api_kwargs["system"] = _cached_content(api_kwargs["system"])
+        if messages:
+            api_kwargs["messages"] = messages[:-1] + [
+                {"role": messages[-1]["role"], "content": _cached_content(messages[-1]["content"])}
+            ]
+    elif api == "openai":
+        if messages and messages[0]["role"] == "system":
+            api_kwargs["extra_body"] = {"prompt_cache_key": prompt_cache_key(messages[0]["content"])}
+    return api_kwargs
+
+
+def usage_record(api, usage):
+    """Token counts of an API call: total, cached and newly cached input tokens, output tokens."""
+    if usage is None:
+        return {}
+    if api == "openai":
+        details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "input_tokens": usage.prompt_tokens,
+            "cached_input_tokens": (getattr(details, "cached_tokens", None) or 0),
+            "output_tokens": usage.completion_tokens,
+        }
+    elif api == "anthropic":
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return {
+            "input_tokens": usage.input_tokens + cache_read + cache_creation,
+            "cached_input_tokens": cache_read,
+            "cache_creation_input_tokens": cache_creation,
+            "output_tokens": usage.output_tokens,
+        }
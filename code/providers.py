@@ -0,0 +1,291 @@
+import queue
+import threading
+import time
+
+import config
+from prompt_caching import apply_prompt_caching, usage_record
+
+
+# Provider layer with hedged requests and failover. Messages are generated on the
+# primary route (`MODEL`); if a fallback route (`FALLBACK_MODEL`, of either provider)
+# is configured, a streamed request is hedged: when its first token takes longer
+# than `HEDGE_AFTER_SECONDS`, the same request is sent to the fallback and the
+# stream which starts first is used, while the other is cancelled. Server errors,
+# overload and connection errors fail over to the fallback right away. Each result
+# records which path served it: 'primary', 'hedge' or 'failover'.
+#
+# Requests are converted between the two layouts used in this platform: OpenAI
+# with the system prompt as first message, Anthropic with the system prompt as
+# parameter and a greeting ('Hi') as first message.
+
+
+def api_of(model):
+    """Return the API library of a model, 'openai' or 'anthropic'."""
+    if "gpt" in model.lower():
+        return "openai"
+    elif "claude" in model.lower():
+        return "anthropic"
+    raise ValueError("Model does not contain 'gpt' or 'claude'; unable to determine API.")
+
+
+class Route:
+    """A model served by a client of its provider's API."""
+
+    def __init__(self, model, client, api=None):
+        self.model = model
+        self.client = client
+        self.api = api or api_of(model)
+
+    def __repr__(self):
+        return f"Route({self.model!r})"
+
+
+def _text(content):
+    """Text of a message content given either as a string or as a list of content blocks."""
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def convert_request(api_kwargs, from_api, route):
+    """Return the API kwargs of a request, built for `from_api`, for another route."""
+    if from_api == "openai":
+        system_prompt = _text(api_kwargs["messages"][0]["content"])
+    else:
+        system_prompt = _text(api_kwargs["system"])
+    # The first message is the system prompt (OpenAI) or the greeting (Anthropic)
+    messages = [
+        {"role": message["role"], "content": _text(message["content"])}
+        for message in api_kwargs["messages"][1:]
+    ]
+
+    converted = {"model": route.model, "max_tokens": api_kwargs["max_tokens"]}
+    if "temperature" in api_kwargs:
+        # Anthropic accepts temperatures up to 1, OpenAI up to 2
+        converted["temperature"] = api_kwargs["temperature"]
+        if route.api == "anthropic":
+            converted["temperature"] = min(converted["temperature"], 1)
+    if route.api == "openai":
+        converted["messages"] = [{"role": "system", "content": system_prompt}] + messages
+    elif route.api == "anthropic":
+        converted["system"] = system_prompt
+        converted["messages"] = [{"role": "user", "content": "Hi"}] + messages
+    return apply_prompt_caching(route.api, converted)
+
+
+def is_failover_error(error):
+    """Whether another provider should be tried after an error: server errors (5xx),
+    overload (Anthropic's 529) and connection errors or timeouts."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code >= 500
+    # Both SDKs name their connection errors the same (without importing either SDK)
+    return any(cls.__name__ in ("APIConnectionError", "APITimeoutError") for cls in type(error).__mro__)
+
+
+def is_rate_limit_error(error):
+    """Whether an error of either SDK is a rate limit error (429), e.g. of the fallback
+    model after a failover."""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    return any(cls.__name__ == "RateLimitError" for cls in type(error).__mro__)
+
+
+def response_api(response):
+    """API library of a (non-streamed) response."""
+    return "openai" if hasattr(response, "choices") else "anthropic"
+
+
+def create_message(route, api_kwargs):
+    """Non-streamed request on a route."""
+    if route.api == "openai":
+        return route.client.chat.completions.create(**api_kwargs)
+    return route.client.messages.create(**api_kwargs)
+
+
+async def create_message_async(route, api_kwargs):
+    """Non-streamed request on a route with an asynchronous client."""
+    if route.api == "openai":
+        return await route.client.chat.completions.create(**api_kwargs)
+    return await route.client.messages.create(**api_kwargs)
+
+
+class _Attempt:
+    """A streamed request on a route, read in a background thread into a queue of events."""
+
+    def __init__(self, route, path, api_kwargs, events):
+        self.route = route
+        self.path = path
+        self.api_kwargs = api_kwargs
+        self.events = events
+        self.cancelled = threading.Event()
+        self.stream = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        usage = {}
+        try:
+            if self.route.api == "openai":
+                self.stream = self.route.client.chat.completions.create(
+                    **self.api_kwargs, stream=True, stream_options={"include_usage": True}
+                )
+                with self.stream:
+                    for chunk in self.stream:
+                        if self.cancelled.is_set():
+                            return
+                        # Last chunk only contains the token counts
+                        if chunk.usage:
+                            usage = usage_record("openai", chunk.usage)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            self.events.put((self, "delta", chunk.choices[0].delta.content))
+            elif self.route.api == "anthropic":
+                with self.route.client.messages.stream(**self.api_kwargs) as stream:
+                    self.stream = stream
+                    for text_delta in stream.text_stream:
+                        if self.cancelled.is_set():
+                            return
+                        if text_delta:
+                            self.events.put((self, "delta", text_delta))
+                    usage = usage_record("anthropic", stream.current_message_snapshot.usage)
+            self.events.put((self, "done", usage))
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self.events.put((self, "error", e))
+
+    def cancel(self):
+        """Stop reading and close the connection of the stream, if it has started."""
+        self.cancelled.set()
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except Exception:
+                pass
+
+
+class HedgedStream:
+    """Iterates over the text deltas of a message streamed from the primary route, hedged
+    with and failing over to the fallback route. After the iteration, `usage`, `path`
+    and `model` tell the token counts and which path served the message."""
+
+    def __init__(self, primary, fallback, api_kwargs, hedge_after=None):
+        self.primary = primary
+        self.fallback = fallback
+        self.api_kwargs = api_kwargs  # Built for the primary route
+        self.hedge_after = config.HEDGE_AFTER_SECONDS if hedge_after is None else hedge_after
+        self.usage = {}
+        self.path = None
+        self.model = None
+        self.attempts = []
+
+    def close(self):
+        """Cancel all streams, e.g. when the caller stops reading at a closing code."""
+        for attempt in self.attempts:
+            attempt.cancel()
+
+    def _start_fallback(self, path, attempts, events):
+        print(f"Sending request to {self.fallback.model} ({path})")
+        api_kwargs = convert_request(self.api_kwargs, self.primary.api, self.fallback)
+        attempts.append(_Attempt(self.fallback, path, api_kwargs, events))
+
+    def __iter__(self):
+        events = queue.Queue()
+        attempts = self.attempts
+        attempts.append(_Attempt(self.primary, "primary", self.api_kwargs, events))
+        hedge_at = None
+        if self.fallback is not None and self.hedge_after is not None:
+            hedge_at = time.monotonic() + self.hedge_after
+        fallback_started = False
+        winner = None
+
+        try:
+            while True:
+                # Wait for the next event, but only until the hedge is due
+                timeout = None
+                if winner is None and hedge_at is not None and not fallback_started:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    attempt, kind, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    self._start_fallback("hedge", attempts, events)
+                    fallback_started = True
+                    continue
+
+                # Events of the cancelled attempt are ignored
+                if winner is not None and attempt is not winner:
+                    continue
+
+                if kind == "error":
+                    if winner is not None:
+                        raise value
+                    attempts.remove(attempt)
+                    if self.fallback is not None and attempt.path == "primary" and is_failover_error(value):
+                        print(f"Request to {self.primary.model} failed: {value!r}")
+                        if not fallback_started:
+                            self._start_fallback("failover", attempts, events)
+                            fallback_started = True
+                        continue
+                    # Another attempt may still succeed
+                    if attempts:
+                        continue
+                    raise value
+
+                # The first attempt to stream text (or to finish) serves the message
+                if winner is None:
+                    winner = attempt
+                    self.path = attempt.path
+                    self.model = attempt.route.model
+                    for other in attempts:
+                        if other is not attempt:
+                            other.cancel()
+
+                if kind == "delta":
+                    yield value
+                elif kind == "done":
+                    self.usage = value
+                    return
+        finally:
+            self.close()
+
+
+def with_failover(primary, fallback, timer=None):
+    """Non-streamed request function of the primary route which fails over to the fallback
+    route on server errors; the path which served it is noted on the turn's timer."""
+
+    def create(**api_kwargs):
+        try:
+            response = create_message(primary, api_kwargs)
+        except Exception as e:
+            if fallback is None or not is_failover_error(e):
+                raise
+            print(f"Request to {primary.model} failed: {e!r}; failing over to {fallback.model}")
+            response = create_message(fallback, convert_request(api_kwargs, primary.api, fallback))
+            if timer is not None:
+                timer.served_by("failover", fallback.model)
+            return response
+        if timer is not None:
+            timer.served_by("primary", primary.model)
+        return response
+
+    return create
+
+
+def with_failover_async(primary, fallback, timer=None):
+    """Asynchronous version of with_failover."""
+
+    async def create(**api_kwargs):
+        try:
+            response = await create_message_async(primary, api_kwargs)
+        except Exception as e:
+            if fallback is None or not is_failover_error(e):
+                raise
+            print(f"Request to {primary.model} failed: {e!r}; failing over to {fallback.model}")
+            response = await create_message_async(fallback, convert_request(api_kwargs, primary.api, fallback))
+            if timer is not None:
+                timer.served_by("failover", fallback.model)
+            return response
+        if timer is not None:
+            timer.served_by("primary", primary.model)
+        return response
+
+    return create
@@ -0,0 +1,292 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows: buckets are only shared within a process
+    fcntl = None
+
+
+# Adaptive rate limiting of simulation runs. Token buckets for requests and tokens
+# per minute are kept in a small JSON coordination file (`RATE_LIMIT_FILE`), locked
+# while read and updated, so that all threads, asyncio tasks and processes of a run
+# (e.g. shards started side by side) draw from the same budget. Every request first
+# reserves a request and its estimated tokens, waiting until the buckets have
+# refilled if necessary. The buckets learn the account's limits from the provider's
+# rate-limit headers (OpenAI `x-ratelimit-*`, Anthropic `anthropic-ratelimit-*`),
+# which the API clients pass on (see clients.py): remaining requests and tokens
+# lower the buckets, and when nothing remains, all requests wait for the reset.
+# A 429 response blocks all requests for its `retry-after`, and the request is
+# retried with exponential backoff and full jitter. Asynchronous callers access the
+# coordination file in a worker thread, as locking it may block for a while.
+
+# (bucket, limit header, remaining header, reset header) of both providers
+RATE_LIMIT_HEADERS = [
+    ("requests", "x-ratelimit-limit-requests", "x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+    ("tokens", "x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens"),
+    (
+        "requests",
+        "anthropic-ratelimit-requests-limit",
+        "anthropic-ratelimit-requests-remaining",
+        "anthropic-ratelimit-requests-reset",
+    ),
+    (
+        "tokens",
+        "anthropic-ratelimit-tokens-limit",
+        "anthropic-ratelimit-tokens-remaining",
+        "anthropic-ratelimit-tokens-reset",
+    ),
+]
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def reset_seconds(value, now=None):
+    """Seconds until a reset header's time: a duration such as '6m0s' or '20ms' (OpenAI),
+    an RFC 3339 time (Anthropic) or a number of seconds; None if it cannot be read."""
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+    try:
+        reset = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, reset.timestamp() - (now or time.time()))
+
+
+def retry_after_seconds(error):
+    """Seconds to wait according to the `retry-after-ms` or `retry-after` header of an API
+    error's response (None if not given)."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Delay before retry number `attempt` (from 0): exponential backoff with full jitter,
+    but at least the provider's retry-after."""
+    ceiling = min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2**attempt)
+    return max(random.uniform(0, ceiling), retry_after or 0)
+
+
+def estimate_request_tokens(api_kwargs):
+    """Tokens a request counts against the limit: its input (about 4 characters per token)
+    plus the maximum output, as the providers reserve it when the request arrives."""
+    characters = 0
+    system = api_kwargs.get("system", "")
+    for content in [system] + [message.get("content", "") for message in api_kwargs.get("messages", [])]:
+        if isinstance(content, str):
+            characters += len(content)
+        else:
+            characters += sum(len(block.get("text", "")) for block in content)
+    return characters // 4 + api_kwargs.get("max_tokens", 0)
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute, shared through a coordination file."""
+
+    def __init__(self, path=None, requests_per_minute=None, tokens_per_minute=None):
+        self.path = path or config.RATE_LIMIT_FILE
+        self.limits = {
+            "requests": requests_per_minute or config.RATE_LIMIT_REQUESTS_PER_MINUTE,
+            "tokens": tokens_per_minute or config.RATE_LIMIT_TOKENS_PER_MINUTE,
+        }
+        self.lock = threading.Lock()
+        self.stats = {"waits": 0, "waited_seconds": 0.0, "rate_limited": 0}
+
+    @contextlib.contextmanager
+    def _state(self):
+        """Shared state of the buckets, locked against other threads and processes."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.lock, open(self.path, "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except json.JSONDecodeError:
+                    state = {}
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _bucket(self, state, name, now):
+        """A bucket refilled up to the current time (None while its limit is unknown)."""
+        buckets = state.setdefault("buckets", {})
+        if name not in buckets:
+            if not self.limits[name]:
+                return None
+            buckets[name] = {"limit": self.limits[name], "level": self.limits[name], "updated": now}
+        bucket = buckets[name]
+        elapsed = max(0.0, now - bucket["updated"])
+        bucket["level"] = min(bucket["limit"], bucket["level"] + elapsed * bucket["limit"] / 60)
+        bucket["updated"] = now
+        return bucket
+
+    def reserve(self, tokens=0):
+        """Take a request and `tokens` from the buckets and return 0, or return the seconds
+        to wait if they are not available yet."""
+        now = time.time()
+        with self._state() as state:
+            wait = max(0.0, state.get("blocked_until", 0) - now)
+            amounts = []
+            for name, amount in (("requests", 1), ("tokens", tokens)):
+                bucket = self._bucket(state, name, now)
+                if bucket is None or not amount:
+                    continue
+                # A request larger than a whole bucket waits for a full bucket
+                missing = min(amount, bucket["limit"]) - bucket["level"]
+                if missing > 0:
+                    wait = max(wait, missing * 60 / bucket["limit"])
+                amounts.append((bucket, amount))
+            if wait > 0:
+                return wait
+            for bucket, amount in amounts:
+                bucket["level"] -= amount
+            return 0.0
+
+    def _waited(self, seconds):
+        with self.lock:
+            self.stats["waits"] += 1
+            self.stats["waited_seconds"] += seconds
+
+    def acquire(self, tokens=0):
+        """Wait until a request with `tokens` can be sent and return the seconds waited."""
+        waited = 0.0
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                break
+            # Jitter, so that waiting workers do not all try again at the same moment
+            wait += random.uniform(0, 0.1)
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            self._waited(waited)
+        return waited
+
+    async def acquire_async(self, tokens=0):
+        """Asynchronous version of acquire which does not block other interviews."""
+        waited = 0.0
+        while True:
+            # Locking the coordination file would block the event loop
+            wait = await asyncio.to_thread(self.reserve, tokens)
+            if not wait:
+                break
+            wait += random.uniform(0, 0.1)
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited:
+            self._waited(waited)
+        return waited
+
+    def block(self, seconds):
+        """Let all requests wait for `seconds`, e.g. after a 429 response with retry-after."""
+        with self.lock:
+            self.stats["rate_limited"] += 1
+        if not seconds:
+            return
+        with self._state() as state:
+            state["blocked_until"] = max(state.get("blocked_until", 0), time.time() + seconds)
+
+    async def block_async(self, seconds):
+        """Asynchronous version of block."""
+        await asyncio.to_thread(self.block, seconds)
+
+    def update_from_headers(self, headers):
+        """Adapt the buckets to the rate-limit headers of a response."""
+        updates = []
+        for name, limit_header, remaining_header, reset_header in RATE_LIMIT_HEADERS:
+            try:
+                limit = float(headers[limit_header])
+                remaining = float(headers[remaining_header])
+            except (KeyError, TypeError, ValueError):
+                continue
+            reset = reset_seconds(headers[reset_header]) if headers.get(reset_header) else None
+            updates.append((name, limit, remaining, reset))
+        if not updates:
+            return
+
+        now = time.time()
+        with self._state() as state:
+            for name, limit, remaining, reset in updates:
+                self.limits[name] = limit
+                bucket = self._bucket(state, name, now)
+                bucket["limit"] = limit
+                # Requests of this run still in flight are already taken from the bucket
+                bucket["level"] = min(bucket["level"], remaining)
+                if remaining < 1 and reset:
+                    state["blocked_until"] = max(state.get("blocked_until", 0), now + reset)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter():
+    """Return the rate limiter of this process for the coordination file in config.py
+    (None if rate limiting is switched off)."""
+    if not config.RATE_LIMITING:
+        return None
+    path = os.path.abspath(config.RATE_LIMIT_FILE)
+    with _limiters_lock:
+        if path not in _limiters:
+            _limiters[path] = RateLimiter(path)
+        return _limiters[path]
+
+
+def observe_headers(headers):
+    """Pass the headers of an API response to the rate limiters in use in this process."""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    for limiter in limiters:
+        try:
+            limiter.update_from_headers(headers)
+        except OSError as e:
+            print(f"Error updating rate limits: {e}")
+
+
+async def observe_headers_async(headers):
+    """Asynchronous version of observe_headers (for httpx hooks of asynchronous clients)."""
+    with _limiters_lock:
+        if not _limiters:
+            return
+    await asyncio.to_thread(observe_headers, headers)
@@ -0,0 +1,63 @@
+import time
+
+import config
+
+
+# Coalescing of streamed chat messages. Every placeholder update re-sends the whole
+# message to the browser, so instead of one update per text delta, updates are sent
+# at most `RENDER_FRAME_RATE` times per second, or earlier once enough new text is
+# pending (the text itself can be passed as a function, which is then only called
+# for updates actually sent). The numbers of deltas received, updates sent and
+# characters sent are stored in the telemetry of each message (see telemetry.py) to
+# help tune both settings.
+
+
+class RenderCoalescer:
+    """Batches text deltas of a streamed message into rate-limited updates of a placeholder."""
+
+    def __init__(self, placeholder, frame_rate=None, max_pending_characters=None, cursor="▌"):
+        self.placeholder = placeholder
+        frame_rate = frame_rate or config.RENDER_FRAME_RATE
+        self.min_interval = 1 / frame_rate
+        self.max_pending_characters = max_pending_characters or config.RENDER_MAX_PENDING_CHARACTERS
+        self.cursor = cursor
+        self.last_update = 0.0
+        self.rendered_length = 0
+        self.deltas_received = 0
+        self.updates_sent = 0
+        self.characters_sent = 0
+
+    def update(self, text, length=None):
+        """Receive the current text after a delta (or a function returning it and its `length`);
+        the placeholder is only updated when due."""
+        self.deltas_received += 1
+
+        if length is None:
+            length = len(text)
+        pending_characters = length - self.rendered_length
+        if pending_characters <= 0:
+            return
+        if (
+            time.monotonic() - self.last_update >= self.min_interval
+            or pending_characters >= self.max_pending_characters
+        ):
+            self._render(text() if callable(text) else text, self.cursor)
+
+    def flush(self, text):
+        """Always display the final text (without cursor)."""
+        self._render(text, "")
+
+    def _render(self, text, cursor):
+        self.placeholder.markdown(text + cursor)
+        self.rendered_length = len(text)
+        self.last_update = time.monotonic()
+        self.updates_sent += 1
+        self.characters_sent += len(text) + len(cursor)
+
+    def stats(self):
+        """Numbers of deltas received, updates sent and characters sent for the turn record."""
+        return {
+            "render_deltas": self.deltas_received,
+            "render_updates": self.updates_sent,
+            "render_characters": self.characters_sent,
+        }
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+from providers import response_api
+
+
+# On-disk cache of API responses for simulations, so that re-running an unchanged
+# simulation (e.g. after changing the analysis or the save format) replays the
+# interviews instead of generating them again. A response is stored under a hash
+# of everything that determines it: the request's API kwargs (model, parameters,
+# system prompt and messages) and the interview it belongs to, as interviews with
+# the same persona send the same first requests but should still differ. After a
+# prompt edit, only the requests which changed miss the cache.
+#
+# Modes (`RESPONSE_CACHE` or `python simulation.py --cache MODE`):
+# - record: return cached responses, and call the API and store the response on a miss
+# - replay: only return cached responses; a miss raises ResponseCacheMiss
+# - bypass: neither read nor write the cache
+# The cache is a SQLite database in WAL mode (shared by threads and processes),
+# kept below `RESPONSE_CACHE_MAX_BYTES` by evicting the least recently used responses
+# (checked every `EVICTION_INTERVAL` stored responses).
+
+MODES = ("record", "replay", "bypass")
+EVICTION_INTERVAL = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    api TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+class ResponseCacheMiss(KeyError):
+    """A request has no cached response in replay mode."""
+
+
+def request_key(api_kwargs, scope=None):
+    """Hash of a request's API kwargs and the interview (`scope`) it belongs to."""
+    request = {"scope": scope, "request": api_kwargs}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def serialise(response):
+    return response_api(response), response.model_dump_json()
+
+
+def deserialise(api, data):
+    """Response object of a stored response, as returned by the API library."""
+    if api == "openai":
+        from openai.types.chat import ChatCompletion
+
+        return ChatCompletion.model_validate_json(data)
+    from anthropic.types import Message
+
+    return Message.model_validate_json(data)
+
+
+class ResponseCache:
+    """Responses by request key, with least-recently-used eviction above a size cap."""
+
+    def __init__(self, path=None, mode=None, max_bytes=None):
+        self.path = path or config.RESPONSE_CACHE_PATH
+        self.mode = mode or config.RESPONSE_CACHE
+        if self.mode not in MODES:
+            raise ValueError(f"Unknown response cache mode '{self.mode}'; use one of {', '.join(MODES)}.")
+        self.max_bytes = config.RESPONSE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        if self.mode != "bypass":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with self.connection() as connection:
+                connection.executescript(SCHEMA)
+
+    def connection(self):
+        """Connection of the current thread (sqlite3 connections are not shared between threads)."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+            return self.stats[key]
+
+    def get(self, key):
+        """Cached response of a request key, or None (in replay mode, a miss raises ResponseCacheMiss)."""
+        if self.mode == "bypass":
+            return None
+        with self.connection() as connection:
+            row = connection.execute("SELECT api, response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        if row is None:
+            self._count("misses")
+            if self.mode == "replay":
+                raise ResponseCacheMiss(key)
+            return None
+        self._count("hits")
+        return deserialise(*row)
+
+    def put(self, key, response):
+        """Store a response (in record mode) and evict the least recently used ones above the cap."""
+        if self.mode != "record" or response is None:
+            return
+        api, data = serialise(response)
+        now = time.time()
+        with self.connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, api, response, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, api, data, len(data), now, now),
+            )
+        if (self._count("stored") - 1) % EVICTION_INTERVAL == 0:
+            with self.connection() as connection:
+                self._count("evicted", self._evict(connection))
+
+    def _evict(self, connection):
+        """Delete the least recently used responses while the cache is above its cap."""
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted = 0
+        if total <= self.max_bytes:
+            return evicted
+        rows = connection.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        keys = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            keys.append((key,))
+            total -= size
+        connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        return len(keys)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the response cache of this process for the settings in config.py (None when bypassed)."""
+    if config.RESPONSE_CACHE == "bypass":
+        return None
+    key = (config.RESPONSE_CACHE, os.path.abspath(config.RESPONSE_CACHE_PATH))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ResponseCache()
+        return _caches[key]
@@ -1,17 +1,38 @@
+import argparse
+import asyncio
 import time
 import os
 import config
-from utils import save_interview_data
+import clients
+from batches import run_batch
+from storage import get_storage, session_label
+from closing_codes import find_closing_code
+from prompt_caching import apply_prompt_caching, usage_record
+from context_window import apply_context_window, new_summary, update_summary, update_summary_async
+from telemetry import TurnTimer, record_turn
+from tracing import profiling, span, traced
+from response_cache import ResponseCacheMiss, get_response_cache, request_key
+from rate_limits import backoff_delay, estimate_request_tokens, get_limiter, retry_after_seconds
+from providers import Route, api_of, is_rate_limit_error, response_api, with_failover, with_failover_async
+from checkpoints import (
+    completed_interviews,
+    load_checkpoint,
+    manifest_path,
+    parse_shard,
+    record_progress,
+    save_checkpoint,
+    select_shard,
+    start_checkpoint,
+    start_manifest,
+)
 import toml
 
 # Load API library
 if "gpt" in config.MODEL.lower():
     api = "openai"
-    from openai import OpenAI
 
 elif "claude" in config.MODEL.lower():
     api = "anthropic"
-    import anthropic
 else:
     raise ValueError(
         "Model does not contain 'gpt' or 'claude'; unable to determine API."
@@ -20,181 +41,738 @@ else:
 # Path to the secrets file
 secrets_path = os.path.join(os.path.dirname(__file__), '.streamlit', 'secrets.toml')
 
-# Load secrets from the TOML file
-try:
-    secrets = toml.load(secrets_path)
-    openai_api_key = secrets.get("API_KEY_OPENAI")
-    anthropic_api_key = secrets.get("API_KEY_ANTHROPIC")
-except FileNotFoundError:
-    print(f"Error: Secrets file not found at {secrets_path}")
-    print("Please create a .streamlit/secrets.toml file with your API keys.")
-    exit()
-except Exception as e:
-    print(f"Error loading secrets: {e}")
-    exit()
-
-# Load API client
-if api == "openai":
-    if not openai_api_key:
-        print("Error: API_KEY_OPENAI not found in secrets.toml")
+
+def load_api_key(key_api=None):
+    """Load the API key of the selected provider (or of `key_api`) from the secrets file."""
+    try:
+        secrets = toml.load(secrets_path)
+    except FileNotFoundError:
+        print(f"Error: Secrets file not found at {secrets_path}")
+        print("Please create a .streamlit/secrets.toml file with your API keys.")
+        exit()
+    except Exception as e:
+        print(f"Error loading secrets: {e}")
         exit()
-    client = OpenAI(api_key=openai_api_key)
-elif api == "anthropic":
-    if not anthropic_api_key:
-        print("Error: API_KEY_ANTHROPIC not found in secrets.toml")
+
+    key_name = "API_KEY_OPENAI" if (key_api or api) == "openai" else "API_KEY_ANTHROPIC"
+    if not secrets.get(key_name):
+        print(f"Error: {key_name} not found in secrets.toml")
         exit()
-    client = anthropic.Anthropic(api_key=anthropic_api_key)
+    return secrets[key_name]
+
+
+def create_client(asynchronous=False, api_key=None, base_url=None, **client_kwargs):
+    """Return the process-wide API client, or a new asynchronous client (to be closed by the
+    caller); `base_url` can point to e.g. a local mock provider."""
+    api_key = api_key or load_api_key()
+    base_url = base_url or config.API_BASE_URL
+    if asynchronous:
+        return clients.create_client(api, api_key, asynchronous=True, base_url=base_url, **client_kwargs)
+    return clients.get_client(api, api_key, base_url=base_url, **client_kwargs)
+
+
+def fallback_route(asynchronous=False, **client_kwargs):
+    """Route of the fallback model which takes over on server errors (None if not configured);
+    a new asynchronous client is closed by the caller."""
+    if not config.FALLBACK_MODEL:
+        return None
+    fallback_api = api_of(config.FALLBACK_MODEL)
+    api_key = load_api_key(fallback_api)
+    base_url = config.FALLBACK_API_BASE_URL
+    if asynchronous:
+        fallback_client = clients.create_client(
+            fallback_api, api_key, asynchronous=True, base_url=base_url, **client_kwargs
+        )
+    else:
+        fallback_client = clients.get_client(fallback_api, api_key, base_url=base_url, **client_kwargs)
+    return Route(config.FALLBACK_MODEL, fallback_client, fallback_api)
+
+
+def print_pool_stats():
+    """Print the usage of the HTTP connection pools."""
+    for stats in clients.pool_stats():
+        print(
+            f"Connection pool {stats['client']}: {stats['requests']} requests, "
+            f"{stats['connections']} open / {stats['max_connections']} max connections "
+            f"({stats['idle_connections']} idle)"
+        )
+
+
+def print_run_stats():
+    """Print how long requests waited for the rate limiter and how many were cached."""
+    limiter = get_limiter()
+    if limiter is not None:
+        stats = limiter.stats
+        print(
+            f"Rate limiter: {stats['waits']} requests waited {stats['waited_seconds']:.1f} seconds, "
+            f"{stats['rate_limited']} rate limit errors"
+        )
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats
+        print(
+            f"Response cache ({cache.mode}): {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['stored']} stored, {stats['evicted']} evicted"
+        )
+
+
+def cached_response(kwargs, cache_scope, timer=None):
+    """Return the response cache (None if bypassed), the request's key and its cached response."""
+    cache = get_response_cache()
+    if cache is None:
+        return None, None, None
+    key = request_key(kwargs, cache_scope)
+    response = cache.get(key)
+    if response is not None and timer is not None:
+        timer.served_by("cache", kwargs["model"])
+    return cache, key, response
+
+
+def call_api_with_retry(api_call_func, *args, timer=None, cache_scope=None, **kwargs):
+    """Calls an API function paced by the shared rate limiter, retrying rate limit errors (of
+    either provider, also after a failover) with exponential backoff and jitter; retries and
+    time spent waiting are counted by the turn's timer, if given. Responses are cached per
+    interview (`cache_scope`, see response_cache.py)."""
+    with span("cache_lookup"):
+        cache, key, response = cached_response(kwargs, cache_scope, timer)
+    if response is not None:
+        return response
 
-def call_api_with_retry(api_call_func, *args, **kwargs):
-    """Calls an API function with a retry mechanism for rate limit errors."""
-    retry_delays = [1, 10, 30]
-    for i, delay in enumerate(retry_delays):
+    limiter = get_limiter()
+    tokens = estimate_request_tokens(kwargs)
+    for attempt in range(config.RETRY_MAX_ATTEMPTS):
+        if limiter is not None:
+            with span("rate_limit_wait"):
+                waited = limiter.acquire(tokens)
+            if timer is not None:
+                timer.wait(waited)
         try:
-            return api_call_func(*args, **kwargs)
-        except (anthropic.RateLimitError, openai.RateLimitError) as e:
-            print(f"Rate limit exceeded. Retrying in {delay} seconds... (Attempt {i + 1}/{len(retry_delays)})")
-            time.sleep(delay)
+            with span("api_call", attempt=attempt + 1):
+                response = api_call_func(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            retry_after = retry_after_seconds(e)
+            if limiter is not None:
+                limiter.block(retry_after)
+            delay = backoff_delay(attempt, retry_after)
+            print(
+                f"Rate limit exceeded. Retrying in {delay:.1f} seconds... "
+                f"(Attempt {attempt + 1}/{config.RETRY_MAX_ATTEMPTS})"
+            )
+            if timer is not None:
+                timer.retry(delay)
+            with span("retry_sleep"):
+                time.sleep(delay)
+            continue
+        if cache is not None:
+            with span("cache_store"):
+                cache.put(key, response)
+        return response
     print("API call failed after multiple retries. Terminating interview.")
     return None
 
 
-def run_simulation():
-    """Runs the interview simulation."""
+async def call_api_with_retry_async(api_call_func, *args, timer=None, cache_scope=None, **kwargs):
+    """Asynchronous version of call_api_with_retry which does not block other interviews (cache
+    lookups and stores, which use SQLite, run in a thread)."""
+    with span("cache_lookup"):
+        cache, key, response = await asyncio.to_thread(cached_response, kwargs, cache_scope, timer)
+    if response is not None:
+        return response
+
+    limiter = get_limiter()
+    tokens = estimate_request_tokens(kwargs)
+    for attempt in range(config.RETRY_MAX_ATTEMPTS):
+        if limiter is not None:
+            with span("rate_limit_wait"):
+                waited = await limiter.acquire_async(tokens)
+            if timer is not None:
+                timer.wait(waited)
+        try:
+            with span("api_call", attempt=attempt + 1):
+                response = await api_call_func(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            retry_after = retry_after_seconds(e)
+            if limiter is not None:
+                await limiter.block_async(retry_after)
+            delay = backoff_delay(attempt, retry_after)
+            print(
+                f"Rate limit exceeded. Retrying in {delay:.1f} seconds... "
+                f"(Attempt {attempt + 1}/{config.RETRY_MAX_ATTEMPTS})"
+            )
+            if timer is not None:
+                timer.retry(delay)
+            with span("retry_sleep"):
+                await asyncio.sleep(delay)
+            continue
+        if cache is not None:
+            with span("cache_store"):
+                await asyncio.to_thread(cache.put, key, response)
+        return response
+    print("API call failed after multiple retries. Terminating interview.")
+    return None
+
+
+def interview_username(persona_name, interview_index):
+    """Generate a unique username for an interview."""
+    return f"{persona_name.replace(' ', '_')}_{interview_index + 1}"
+
+
+def start_interview(persona_name, persona_description, interview_index, settings=None):
+    """Initialise the state of a single simulated interview; `settings` (the 'model' and
+    'temperature' of a sweep) override those of config.py for this interview, and a
+    'username' in them the username of the interview."""
+
+    # Start with the interviewer's system prompt (OpenAI) or a greeting (Anthropic)
+    if api == "openai":
+        messages = [{"role": "system", "content": config.SYSTEM_PROMPT}]
+    elif api == "anthropic":
+        messages = [{"role": "user", "content": "Hi"}]
+
+    state = {
+        "username": interview_username(persona_name, interview_index),
+        "persona_name": persona_name,
+        "persona_description": persona_description,
+        "interview_index": interview_index,
+        "messages": messages,
+        "start_time": time.time(),
+        "conversation_turn": 0,
+        "interview_active": True,
+        "closing_code": None,
+        "context_summary": new_summary(),
+        "respondent_summary": new_summary(),
+        "turns": [],
+    }
+    state.update(settings or {})
+    return state
+
+
+def next_speaker(state):
+    """Return whose message is generated next, 'interviewer' or 'respondent'."""
+    if state["messages"][-1]["role"] == "assistant":
+        return "respondent"
+    return "interviewer"
 
-    # Create directories if they do not already exist
-    for directory in [config.TRANSCRIPTS_DIRECTORY, config.TIMES_DIRECTORY, config.BACKUPS_DIRECTORY]:
+
+# State keys of the context summaries of both sides (see context_window.py)
+SUMMARY_KEYS = {"interviewer": "context_summary", "respondent": "respondent_summary"}
+
+
+def system_prompt_of(state, speaker):
+    """System prompt of the requests generating a speaker's messages."""
+    if speaker == "respondent":
+        return config.RESPONDENT_SYSTEM_PROMPT.format(
+            persona_name=state["persona_name"],
+            persona_description=state["persona_description"],
+        )
+    return config.SYSTEM_PROMPT
+
+
+def summary_update(state, speaker):
+    """Summary state, system prompt, model and perspective of update_summary for a speaker's next request."""
+    return (
+        state[SUMMARY_KEYS[speaker]],
+        system_prompt_of(state, speaker),
+        state.get("model") or config.MODEL,
+        speaker,
+    )
+
+
+@traced("build_request")
+def build_request(state, speaker):
+    """Build the keyword arguments of the API call generating the next message."""
+    messages = state["messages"]
+    system_prompt = system_prompt_of(state, speaker)
+
+    api_kwargs = {"model": state.get("model") or config.MODEL, "max_tokens": config.MAX_OUTPUT_TOKENS}
+    temperature = state.get("temperature", config.TEMPERATURE)
+    if temperature is not None:
+        api_kwargs["temperature"] = temperature
+
+    if api == "openai":
+        # The system prompt is the first message of the conversation
+        request_messages = messages.copy()
+        request_messages[0] = {"role": "system", "content": system_prompt}
+        api_kwargs["messages"] = request_messages
+    elif api == "anthropic":
+        api_kwargs["system"] = system_prompt
+        api_kwargs["messages"] = messages.copy()
+
+    api_kwargs = apply_context_window(api, api_kwargs, state[SUMMARY_KEYS[speaker]])
+    return apply_prompt_caching(api, api_kwargs)
+
+
+def extract_text(response):
+    """Return the text of an API response (of either provider, after a failover), or None if the call failed."""
+    if response is None:
+        return None
+    if response_api(response) == "openai":
+        return response.choices[0].message.content
+    else:
+        return response.content[0].text
+
+
+def extract_usage(response):
+    """Return the token counts (input, cached input and output) of an API response."""
+    if response is None:
+        return {}
+    return usage_record(response_api(response), response.usage)
+
+
+@traced("record_message")
+def record_message(state, speaker, message):
+    """Add a generated message to the interview and update the interview state."""
+    messages = state["messages"]
+
+    # Respondent's turn
+    if speaker == "respondent":
+        state["conversation_turn"] += 1
+        if message is None:
+            state["interview_active"] = False
+            messages.append({"role": "user", "content": "Interview terminated due to API rate limits."})
+        else:
+            messages.append({"role": "user", "content": message})
+            print(f"    {state['persona_name']}: {message}")
+        return
+
+    # Interviewer's turn
+    closing_code = find_closing_code(message) if message is not None else None
+    if message is None:
+        state["interview_active"] = False
+        messages.append({"role": "assistant", "content": "Interview terminated due to API rate limits."})
+    # Check for closing codes
+    elif closing_code is not None:
+        state["interview_active"] = False
+        state["closing_code"] = closing_code
+        closing_message = config.CLOSING_MESSAGES[closing_code]
+        messages.append({"role": "assistant", "content": closing_message})
+        print(f"    Interviewer: {closing_message}")
+    else:
+        messages.append({"role": "assistant", "content": message})
+        print(f"    Interviewer: {message}")
+
+    # End the conversation after the maximum number of turns
+    if state["conversation_turn"] >= config.MAX_CONVERSATION_TURNS:
+        state["interview_active"] = False
+
+
+@traced("finalise")
+def finish_interview(state):
+    """Save the final interview data."""
+    get_storage().finalise(
+        username=state["username"],
+        messages=state["messages"],
+        start_time=state["start_time"],
+        closing_code=state["closing_code"],
+        session=session_label(state["start_time"]),
+        persona=state["persona_name"],
+        turns=state["turns"],
+    )
+    print(f"  Interview {state['interview_index'] + 1} for {state['persona_name']} completed and saved.")
+
+
+def create_directories():
+    """Create directories if they do not already exist."""
+    for directory in [
+        config.TRANSCRIPTS_DIRECTORY,
+        config.TIMES_DIRECTORY,
+        config.BACKUPS_DIRECTORY,
+        config.COMPLETIONS_DIRECTORY,
+        config.CHECKPOINTS_DIRECTORY,
+    ]:
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-    # Loop through each persona
-    for persona_name, persona_description in config.PERSONAS.items():
-        print(f"Running interviews for persona: {persona_name}")
-
-        # Run the specified number of interviews for the persona
-        for i in range(config.INTERVIEWS_PER_PERSONA):
-            print(f"  Starting interview {i + 1}/{config.INTERVIEWS_PER_PERSONA}")
-
-            # Initialise interview state
-            messages = []
-            start_time = time.time()
-            start_time_file_names = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime(start_time))
-            interview_active = True
-            conversation_turn = 0
-
-            # Generate a unique username for the interview
-            username = f"{persona_name.replace(' ', '_')}_{i + 1}"
-
-            # Start with the interviewer's opening message
-            if api == "openai":
-                messages.append({"role": "system", "content": config.SYSTEM_PROMPT})
-                completion = call_api_with_retry(
-                    client.chat.completions.create,
-                    messages=messages,
-                    model=config.MODEL,
-                    max_tokens=config.MAX_OUTPUT_TOKENS,
-                    temperature=config.TEMPERATURE,
-                )
-                message_interviewer = completion.choices[0].message.content if completion else None
-            elif api == "anthropic":
-                messages.append({"role": "user", "content": "Hi"})
-                response = call_api_with_retry(
-                    client.messages.create,
-                    system=config.SYSTEM_PROMPT,
-                    messages=messages,
-                    model=config.MODEL,
-                    max_tokens=config.MAX_OUTPUT_TOKENS,
-                    temperature=config.TEMPERATURE,
+
+def interview_grid():
+    """Return all (persona name, persona description, interview index) items of a run."""
+    return [
+        (persona_name, persona_description, i)
+        for persona_name, persona_description in config.PERSONAS.items()
+        for i in range(config.INTERVIEWS_PER_PERSONA)
+    ]
+
+
+def resume_or_start_interview(persona_name, persona_description, interview_index, resume, settings=None):
+    """Continue an interview from its checkpoint (if resuming) or start a new one."""
+    state = None
+    if resume:
+        state = load_checkpoint(
+            config.CHECKPOINTS_DIRECTORY,
+            (settings or {}).get("username") or interview_username(persona_name, interview_index),
+        )
+        if state is not None:
+            print(f"  Resuming interview {interview_index + 1} for {persona_name} at turn {state['conversation_turn']}")
+            state.setdefault("context_summary", new_summary())
+            state.setdefault("respondent_summary", new_summary())
+            state.setdefault("turns", [])
+    if state is None:
+        state = start_interview(persona_name, persona_description, interview_index, settings)
+        start_checkpoint(config.CHECKPOINTS_DIRECTORY, state)
+    return state
+
+
+@traced("checkpoint")
+def checkpoint_turn(state, manifest, turn):
+    """Checkpoint the latest message with its telemetry, and record finished turns in the manifest."""
+    state["turns"].append(turn)
+    record_turn(state["username"], turn)
+    save_checkpoint(config.CHECKPOINTS_DIRECTORY, state, **turn)
+    if state["messages"][-1]["role"] == "assistant":
+        record_progress(manifest, state, "turn")
+
+
+def complete_interview(state, manifest):
+    """Save the final interview data and mark the interview as completed in the manifest."""
+    finish_interview(state)
+    record_progress(manifest, state, "completed")
+
+
+def run_interview(
+    client,
+    persona_name,
+    persona_description,
+    interview_index,
+    manifest,
+    resume=False,
+    fallback=None,
+    settings=None,
+    on_turn=None,
+    on_summary=None,
+):
+    """Runs one simulated interview with blocking API calls (failing over to `fallback` on server
+    errors); `on_turn(state, turn)` is called with the record of every turn, and
+    `on_summary(state, record)` with that of every call updating a context summary."""
+    state = resume_or_start_interview(persona_name, persona_description, interview_index, resume, settings)
+    primary = Route(state.get("model") or config.MODEL, client, api)
+    if api == "openai":
+        create = client.chat.completions.create
+    elif api == "anthropic":
+        create = client.messages.create
+
+    def summarise(**kwargs):
+        timer = TurnTimer("summary")
+        response = call_api_with_retry(create, timer=timer, cache_scope=state["username"], **kwargs)
+        if timer.path is None:
+            timer.served_by("primary", kwargs["model"])
+        if on_summary is not None:
+            on_summary(state, timer.record(extract_usage(response)))
+        return response
+
+    while state["interview_active"]:
+        speaker = next_speaker(state)
+        with span("turn", speaker=speaker):
+            state[SUMMARY_KEYS[speaker]] = update_summary(
+                api, summarise, state["messages"], *summary_update(state, speaker)
+            )
+            timer = TurnTimer(speaker)
+            response = call_api_with_retry(
+                with_failover(primary, fallback, timer),
+                timer=timer,
+                cache_scope=state["username"],
+                **build_request(state, speaker),
+            )
+            record_message(state, speaker, extract_text(response))
+            turn = timer.record(extract_usage(response))
+            checkpoint_turn(state, manifest, turn)
+        if on_turn is not None:
+            on_turn(state, turn)
+
+    complete_interview(state, manifest)
+
+
+async def run_interview_async(
+    async_client,
+    semaphore,
+    persona_name,
+    persona_description,
+    interview_index,
+    manifest,
+    resume=False,
+    fallback=None,
+    settings=None,
+    on_turn=None,
+    on_summary=None,
+):
+    """Runs one simulated interview; turns stay in order, other interviews run meanwhile."""
+    if api == "openai":
+        create = async_client.chat.completions.create
+    elif api == "anthropic":
+        create = async_client.messages.create
+
+    async def summarise(**kwargs):
+        timer = TurnTimer("summary")
+        response = await call_api_with_retry_async(create, timer=timer, cache_scope=state["username"], **kwargs)
+        if timer.path is None:
+            timer.served_by("primary", kwargs["model"])
+        if on_summary is not None:
+            on_summary(state, timer.record(extract_usage(response)))
+        return response
+
+    # Only start the interview (and its clock) once a slot is free
+    async with semaphore:
+        print(f"  Starting interview {interview_index + 1}/{config.INTERVIEWS_PER_PERSONA} for {persona_name}")
+        state = resume_or_start_interview(persona_name, persona_description, interview_index, resume, settings)
+        primary = Route(state.get("model") or config.MODEL, async_client, api)
+
+        while state["interview_active"]:
+            speaker = next_speaker(state)
+            with span("turn", speaker=speaker):
+                state[SUMMARY_KEYS[speaker]] = await update_summary_async(
+                    api, summarise, state["messages"], *summary_update(state, speaker)
                 )
-                message_interviewer = response.content[0].text if response else None
-
-            if message_interviewer is None:
-                interview_active = False
-                messages.append({"role": "assistant", "content": "Interview terminated due to API rate limits."})
-            else:
-                messages.append({"role": "assistant", "content": message_interviewer})
-                print(f"    Interviewer: {message_interviewer}")
-
-            # Main conversation loop
-            while interview_active and conversation_turn < config.MAX_CONVERSATION_TURNS:
-                conversation_turn += 1
-
-                # Respondent's turn
-                respondent_system_prompt = config.RESPONDENT_SYSTEM_PROMPT.format(
-                    persona_name=persona_name, persona_description=persona_description
+                timer = TurnTimer(speaker)
+                response = await call_api_with_retry_async(
+                    with_failover_async(primary, fallback, timer),
+                    timer=timer,
+                    cache_scope=state["username"],
+                    **build_request(state, speaker),
                 )
-                if api == "openai":
-                    respondent_messages = messages.copy()
-                    respondent_messages[0] = {"role": "system", "content": respondent_system_prompt}
-                    completion = call_api_with_retry(
-                        client.chat.completions.create,
-                        messages=respondent_messages,
-                        model=config.MODEL,
-                        max_tokens=config.MAX_OUTPUT_TOKENS,
-                        temperature=config.TEMPERATURE,
-                    )
-                    message_respondent = completion.choices[0].message.content if completion else None
-                elif api == "anthropic":
-                    response = call_api_with_retry(
-                        client.messages.create,
-                        system=respondent_system_prompt,
-                        messages=messages,
-                        model=config.MODEL,
-                        max_tokens=config.MAX_OUTPUT_TOKENS,
-                        temperature=config.TEMPERATURE,
-                    )
-                    message_respondent = response.content[0].text if response else None
-                
-                if message_respondent is None:
-                    interview_active = False
-                    messages.append({"role": "user", "content": "Interview terminated due to API rate limits."})
-                else:
-                    messages.append({"role": "user", "content": message_respondent})
-                    print(f"    {persona_name}: {message_respondent}")
-
-                # Interviewer's turn
-                if api == "openai":
-                    completion = call_api_with_retry(
-                        client.chat.completions.create,
-                        messages=messages,
-                        model=config.MODEL,
-                        max_tokens=config.MAX_OUTPUT_TOKENS,
-                        temperature=config.TEMPERATURE,
-                    )
-                    message_interviewer = completion.choices[0].message.content if completion else None
-                elif api == "anthropic":
-                    response = call_api_with_retry(
-                        client.messages.create,
-                        system=config.SYSTEM_PROMPT,
-                        messages=messages,
-                        model=config.MODEL,
-                        max_tokens=config.MAX_OUTPUT_TOKENS,
-                        temperature=config.TEMPERATURE,
-                    )
-                    message_interviewer = response.content[0].text if response else None
-
-                if message_interviewer is None:
-                    interview_active = False
-                    messages.append({"role": "assistant", "content": "Interview terminated due to API rate limits."})
-                # Check for closing codes
-                elif any(code in message_interviewer for code in config.CLOSING_MESSAGES.keys()):
-                    interview_active = False
-                    closing_code = next(code for code in config.CLOSING_MESSAGES.keys() if code in message_interviewer)
-                    closing_message = config.CLOSING_MESSAGES[closing_code]
-                    messages.append({"role": "assistant", "content": closing_message})
-                    print(f"    Interviewer: {closing_message}")
-                else:
-                    messages.append({"role": "assistant", "content": message_interviewer})
-                    print(f"    Interviewer: {message_interviewer}")
-
-            # Save the final interview data
-            save_interview_data(
-                username=username,
-                transcripts_directory=config.TRANSCRIPTS_DIRECTORY,
-                times_directory=config.TIMES_DIRECTORY,
-                messages=messages,
-                start_time=start_time,
+                record_message(state, speaker, extract_text(response))
+                turn = timer.record(extract_usage(response))
+                checkpoint_turn(state, manifest, turn)
+            if on_turn is not None:
+                on_turn(state, turn)
+
+        # Write files without blocking the event loop
+        await asyncio.to_thread(complete_interview, state, manifest)
+
+
+def pending_interviews(resume=False, shard=None):
+    """Return the grid items of this shard, without interviews already completed if resuming."""
+    full_grid = interview_grid()
+    grid = select_shard(full_grid, shard)
+    manifest = manifest_path(config.CHECKPOINTS_DIRECTORY, shard)
+    # A new run starts with a new manifest (also when resuming a run of another grid or shard layout)
+    start_manifest(manifest, full_grid, shard, resume)
+    if not resume:
+        return grid, manifest
+
+    completed = completed_interviews(config.CHECKPOINTS_DIRECTORY, full_grid, shard)
+    pending = [item for item in grid if interview_username(item[0], item[2]) not in completed]
+    print(f"Resuming run: {len(grid) - len(pending)} of {len(grid)} interviews already completed")
+    return pending, manifest
+
+
+def run_simulation(resume=False, shard=None, client=None):
+    """Runs the interview simulation."""
+    create_directories()
+    client = client or create_client()
+    fallback = fallback_route()
+    grid, manifest = pending_interviews(resume, shard)
+
+    # Loop through each persona and interview
+    current_persona = None
+    for persona_name, persona_description, i in grid:
+        if persona_name != current_persona:
+            current_persona = persona_name
+            print(f"Running interviews for persona: {persona_name}")
+        print(f"  Starting interview {i + 1}/{config.INTERVIEWS_PER_PERSONA}")
+        try:
+            run_interview(client, persona_name, persona_description, i, manifest, resume, fallback)
+        except ResponseCacheMiss as e:
+            # In replay mode, interviews without recorded responses are skipped (and reported)
+            print(f"  Interview {i + 1} for {persona_name} failed: {e!r}")
+
+    print_pool_stats()
+    print_run_stats()
+
+
+async def run_simulation_async(concurrency=None, resume=False, shard=None, async_client=None):
+    """Runs the interview simulation with up to `concurrency` interviews at the same time."""
+    create_directories()
+    concurrency = concurrency or config.SIMULATION_CONCURRENCY
+    grid, manifest = pending_interviews(resume, shard)
+    print(f"Running {len(grid)} interviews with concurrency {concurrency}")
+
+    close_client = async_client is None
+    async_client = async_client or create_client(asynchronous=True)
+    fallback = fallback_route(asynchronous=True)
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *(
+            run_interview_async(
+                async_client, semaphore, persona_name, persona_description, i, manifest, resume, fallback
             )
-            print(f"  Interview {i + 1} for {persona_name} completed and saved.")
+            for persona_name, persona_description, i in grid
+        ),
+        return_exceptions=True,
+    )
+
+    # A failing interview does not stop the others, but is reported
+    for (persona_name, _, i), result in zip(grid, results):
+        if isinstance(result, Exception):
+            print(f"  Interview {i + 1} for {persona_name} failed: {result!r}")
+
+    print_pool_stats()
+    print_run_stats()
+
+    if close_client:
+        await async_client.close()
+    if fallback is not None:
+        await fallback.client.close()
+
+
+def run_batch_cached(client, requests, turn, poll_interval=None):
+    """Run the requests of a round as a batch, except those with a cached response; return the
+    responses and the cache misses of requests without a recorded response in replay mode."""
+    cache = get_response_cache()
+    if cache is None:
+        return run_batch(api, client, requests, poll_interval), {}
+
+    keys = {
+        custom_id: request_key(api_kwargs, state["username"])
+        for (custom_id, api_kwargs), state in zip(requests.items(), turn)
+    }
+    responses = {}
+    misses = {}
+    for custom_id, key in keys.items():
+        try:
+            response = cache.get(key)
+        except ResponseCacheMiss as e:
+            misses[custom_id] = e
+            continue
+        if response is not None:
+            responses[custom_id] = response
+    pending = {
+        custom_id: api_kwargs
+        for custom_id, api_kwargs in requests.items()
+        if custom_id not in responses and custom_id not in misses
+    }
+    if pending:
+        for custom_id, response in run_batch(api, client, pending, poll_interval).items():
+            cache.put(keys[custom_id], response)
+            responses[custom_id] = response
+    return responses, misses
+
+
+def drop_interview(state, error):
+    """End an interview of a batch run which cannot continue (e.g. in replay mode, without a
+    recorded response) without completing it, and report it."""
+    state["interview_active"] = False
+    print(f"  Interview {state['interview_index'] + 1} for {state['persona_name']} failed: {error!r}")
+
+
+def run_simulation_batch(resume=False, shard=None, client=None, poll_interval=None):
+    """Runs the interview simulation in lock-step with the provider's batch API: each round
+    submits the next interviewer message of all active interviews as one batch, then the
+    next respondent message; interviews which have ended drop out of later rounds."""
+    create_directories()
+    client = client or create_client()
+    grid, manifest = pending_interviews(resume, shard)
+    print(f"Running {len(grid)} interviews in batches")
+    states = [
+        resume_or_start_interview(persona_name, persona_description, i, resume)
+        for persona_name, persona_description, i in grid
+    ]
+    if api == "openai":
+        create = client.chat.completions.create
+    elif api == "anthropic":
+        create = client.messages.create
+
+    round_number = 0
+    while any(state["interview_active"] for state in states):
+        round_number += 1
+        for speaker in ["interviewer", "respondent"]:
+            turn = [state for state in states if state["interview_active"] and next_speaker(state) == speaker]
+            if not turn:
+                continue
+            print(f"Round {round_number}: {speaker} messages of {len(turn)} interviews")
+
+            # Summaries of long interviews are (rarely) updated with individual calls
+            for state in turn:
+                try:
+                    state[SUMMARY_KEYS[speaker]] = update_summary(
+                        api,
+                        lambda **kwargs: call_api_with_retry(create, cache_scope=state["username"], **kwargs),
+                        state["messages"],
+                        *summary_update(state, speaker),
+                    )
+                except ResponseCacheMiss as e:
+                    drop_interview(state, e)
+            turn = [state for state in turn if state["interview_active"]]
+            if not turn:
+                continue
+
+            # Custom ids are positions, as usernames may contain characters the APIs do not accept
+            requests = {f"interview-{position}": build_request(state, speaker) for position, state in enumerate(turn)}
+            timer = TurnTimer(speaker)
+            with span("batch", speaker=speaker, interviews=len(turn)):
+                responses, misses = run_batch_cached(client, requests, turn, poll_interval)
+            for position, state in enumerate(turn):
+                # Interviews without a recorded response drop out, the others continue
+                if f"interview-{position}" in misses:
+                    drop_interview(state, misses[f"interview-{position}"])
+                    continue
+                response = responses.get(f"interview-{position}")
+                record_message(state, speaker, extract_text(response))
+                # The duration of a turn is the time until its whole batch has ended
+                checkpoint_turn(state, manifest, timer.record(extract_usage(response)))
+                if not state["interview_active"]:
+                    complete_interview(state, manifest)
+
+    print_pool_stats()
+    print_run_stats()
+
 
 if __name__ == "__main__":
-    run_simulation()
+    parser = argparse.ArgumentParser(description="Simulate interviews with LLM respondents.")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run interviews concurrently with asynchronous API clients.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=config.SIMULATION_CONCURRENCY,
+        help="Maximum number of interviews running at the same time in --async mode.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip interviews completed in an earlier run and continue partial ones from their checkpoints.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="k/N",
+        help="Only run the k-th of N disjoint parts of the persona x interview grid.",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Advance all interviews one message per round with the provider's batch API (cheaper, slower).",
+    )
+    parser.add_argument(
+        "--cache",
+        choices=["record", "replay", "bypass"],
+        default=config.RESPONSE_CACHE,
+        help="Reuse cached API responses and store new ones (record), only use cached ones (replay), or neither.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=config.PROFILE,
+        help="Write a trace of the phases of all turns to PROFILES_DIRECTORY and print the time per phase.",
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        help="With --profile, also write a cProfile dump of the Python code.",
+    )
+    args = parser.parse_args()
+    config.RESPONSE_CACHE = args.cache
+
+    with profiling("simulation", args.profile, args.cprofile):
+        if args.batch:
+            run_simulation_batch(args.resume, args.shard)
+        elif args.use_async:
+            asyncio.run(run_simulation_async(args.concurrency, args.resume, args.shard))
+        else:
+            run_simulation(args.resume, args.shard)
@@ -0,0 +1,450 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import config
+from backup_archive import BackupArchive
+from transcript_log import append_messages, append_records, read_log, read_messages
+from utils import (
+    check_if_interview_completed,
+    check_if_interviews_completed,
+    finalise_interview,
+    save_interview_data,
+    write_legacy_completion_markers,
+)
+
+
+# Storage of interview data. Both backends offer the same methods:
+# - append_backup: add the new messages of a running session (after every turn)
+# - append_backup_records: the same with log records built earlier (see write_behind.py)
+# - save_backup: store the complete backup of a session which has ended
+# - finalise: store the final interview and mark the username as completed
+# - is_completed / completion_statuses: check whether usernames completed the interview
+# - load_backup: messages of a session stored so far
+# - unfinished_session: latest session of a username if it has not ended, to restore it
+# `FileStorage` (default) keeps the flat-file layout in `data/`, `SQLiteStorage`
+# keeps everything in one SQLite database in WAL mode (select with `STORAGE_BACKEND`).
+# `python storage.py export` writes the flat-file layout from the database.
+
+
+SESSION_LABEL = re.compile(r"^\d{4}(?:_\d{2}){5}$")
+
+# Fields of backup log records which are not part of the turn record of a message
+MESSAGE_FIELDS = ("role", "content", "timestamp")
+
+
+def session_label(start_time):
+    """Label of an interview session, as used in the names of backup files."""
+    return time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime(start_time))
+
+
+def session_start_time(session):
+    """Start time of a session from its label (to the second)."""
+    return time.mktime(time.strptime(session, "%Y_%m_%d_%H_%M_%S"))
+
+
+def restored_session(session, start_time, records, last_activity, max_age_hours):
+    """Session to restore from the records of its backup, or None if it is too old."""
+    if max_age_hours is not None and time.time() - last_activity > max_age_hours * 3600:
+        return None
+    messages = [{"role": record["role"], "content": record["content"]} for record in records]
+    if not messages:
+        return None
+    turns = [
+        {key: value for key, value in record.items() if key not in MESSAGE_FIELDS}
+        for record in records
+        if "duration_seconds" in record
+    ]
+    return {"session": session, "start_time": start_time, "messages": messages, "turns": turns}
+
+
+class FileStorage:
+    """Transcripts, times, backups and completion markers as files in directories."""
+
+    def __init__(
+        self,
+        transcripts_directory=None,
+        times_directory=None,
+        backups_directory=None,
+        completions_directory=None,
+    ):
+        self.transcripts_directory = transcripts_directory or config.TRANSCRIPTS_DIRECTORY
+        self.times_directory = times_directory or config.TIMES_DIRECTORY
+        self.backups_directory = backups_directory or config.BACKUPS_DIRECTORY
+        self.completions_directory = completions_directory or config.COMPLETIONS_DIRECTORY
+        for directory in [
+            self.transcripts_directory,
+            self.times_directory,
+            self.backups_directory,
+            self.completions_directory,
+        ]:
+            os.makedirs(directory, exist_ok=True)
+
+    def backup_log_path(self, username, session):
+        return os.path.join(self.backups_directory, f"{username}_log_started_{session}.jsonl")
+
+    def append_backup(self, username, session, start_time, messages, persona=None, **fields):
+        append_messages(self.backup_log_path(username, session), messages, **fields)
+
+    def append_backup_records(self, username, session, start_time, records, persona=None):
+        append_records(self.backup_log_path(username, session), records)
+
+    def save_backup(self, username, session, start_time, messages, persona=None, turns=None):
+        save_interview_data(
+            username=username,
+            transcripts_directory=self.backups_directory,
+            times_directory=self.backups_directory,
+            messages=messages,
+            start_time=start_time,
+            file_name_addition_transcript=f"_transcript_started_{session}",
+            file_name_addition_time=f"_time_started_{session}",
+            turns=turns,
+        )
+
+    def load_backup(self, username, session):
+        try:
+            return read_messages(self.backup_log_path(username, session))
+        except FileNotFoundError:
+            # Sessions which have ended may have been moved to the archive
+            return BackupArchive(self.backups_directory).load_messages(username, session)
+
+    def unfinished_session(self, username, max_age_hours=None):
+        """Latest session of a username, with its messages and turn records, if it has not
+        ended (no backup transcript yet) and was active within `max_age_hours`."""
+        prefix = f"{username}_log_started_"
+        sessions = sorted(
+            os.path.basename(path)[len(prefix) : -len(".jsonl")]
+            for path in glob.glob(os.path.join(self.backups_directory, glob.escape(prefix) + "*.jsonl"))
+        )
+        sessions = [session for session in sessions if SESSION_LABEL.match(session)]
+        if not sessions:
+            return None
+        session = sessions[-1]
+        transcript_path = os.path.join(self.backups_directory, f"{username}_transcript_started_{session}.txt")
+        if os.path.exists(transcript_path):
+            return None
+        log_path = self.backup_log_path(username, session)
+        records = [record for record in read_log(log_path) if "role" in record]
+        return restored_session(
+            session, session_start_time(session), records, os.path.getmtime(log_path), max_age_hours
+        )
+
+    def finalise(
+        self, username, messages, start_time, closing_code=None, session=None, persona=None, end_time=None, turns=None
+    ):
+        finalise_interview(
+            username=username,
+            transcripts_directory=self.transcripts_directory,
+            times_directory=self.times_directory,
+            completions_directory=self.completions_directory,
+            messages=messages,
+            start_time=start_time,
+            closing_code=closing_code,
+            end_time=end_time,
+            turns=turns,
+        )
+
+    def is_completed(self, username):
+        return check_if_interview_completed(self.completions_directory, username)
+
+    def completion_statuses(self, usernames):
+        return check_if_interviews_completed(self.completions_directory, usernames)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS interviews (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    session TEXT NOT NULL,
+    persona TEXT,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    closing_code TEXT,
+    completed INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (username, session)
+);
+CREATE INDEX IF NOT EXISTS interviews_username ON interviews (username, completed);
+CREATE INDEX IF NOT EXISTS interviews_persona ON interviews (persona);
+CREATE TABLE IF NOT EXISTS messages (
+    interview_id INTEGER NOT NULL REFERENCES interviews (id),
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    metadata TEXT,
+    PRIMARY KEY (interview_id, position)
+);
+"""
+
+
+class SQLiteStorage:
+    """All interview sessions, messages (with per-turn metadata) and completions in SQLite."""
+
+    def __init__(self, path=None):
+        self.path = path or config.DATABASE_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def connection(self):
+        """Connection of the current thread (sqlite3 connections are not shared between threads)."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def _interview_id(self, connection, username, session, start_time, persona):
+        connection.execute(
+            "INSERT OR IGNORE INTO interviews (username, session, persona, start_time) VALUES (?, ?, ?, ?)",
+            (username, session, persona, start_time),
+        )
+        return connection.execute(
+            "SELECT id FROM interviews WHERE username = ? AND session = ?", (username, session)
+        ).fetchone()[0]
+
+    def _insert_messages(self, connection, interview_id, messages, first_position, fields):
+        """Insert messages from a position on; `fields` are stored as metadata of the last one."""
+        now = time.time()
+        rows = []
+        for offset, message in enumerate(messages):
+            is_last = offset == len(messages) - 1
+            metadata = json.dumps(fields) if (fields and is_last) else None
+            rows.append((interview_id, first_position + offset, message["role"], message["content"], now, metadata))
+        connection.executemany(
+            "INSERT OR IGNORE INTO messages (interview_id, position, role, content, timestamp, metadata) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def _stored_messages(self, connection, interview_id):
+        return connection.execute(
+            "SELECT COUNT(*) FROM messages WHERE interview_id = ?", (interview_id,)
+        ).fetchone()[0]
+
+    def append_backup(self, username, session, start_time, messages, persona=None, **fields):
+        """Add new messages of a session in one transaction."""
+        with self.connection() as connection:
+            interview_id = self._interview_id(connection, username, session, start_time, persona)
+            first_position = self._stored_messages(connection, interview_id)
+            self._insert_messages(connection, interview_id, messages, first_position, fields)
+
+    def append_backup_records(self, username, session, start_time, records, persona=None):
+        """Add log records of new messages (with their own timestamps and metadata) in one transaction."""
+        with self.connection() as connection:
+            interview_id = self._interview_id(connection, username, session, start_time, persona)
+            first_position = self._stored_messages(connection, interview_id)
+            rows = []
+            for offset, record in enumerate(records):
+                metadata = {key: value for key, value in record.items() if key not in MESSAGE_FIELDS}
+                rows.append(
+                    (
+                        interview_id,
+                        first_position + offset,
+                        record["role"],
+                        record["content"],
+                        record["timestamp"],
+                        json.dumps(metadata) if metadata else None,
+                    )
+                )
+            connection.executemany(
+                "INSERT OR IGNORE INTO messages (interview_id, position, role, content, timestamp, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def save_backup(self, username, session, start_time, messages, persona=None, turns=None):
+        """Store all messages of a session which are not stored yet, and its end time
+        (turn records are stored as metadata of their messages by append_backup)."""
+        with self.connection() as connection:
+            interview_id = self._interview_id(connection, username, session, start_time, persona)
+            stored = self._stored_messages(connection, interview_id)
+            self._insert_messages(connection, interview_id, messages[stored:], stored, None)
+            connection.execute("UPDATE interviews SET end_time = ? WHERE id = ?", (time.time(), interview_id))
+
+    def load_backup(self, username, session):
+        rows = self.connection().execute(
+            "SELECT m.role, m.content FROM messages m JOIN interviews i ON m.interview_id = i.id "
+            "WHERE i.username = ? AND i.session = ? ORDER BY m.position",
+            (username, session),
+        )
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def unfinished_session(self, username, max_age_hours=None):
+        """Latest session of a username, with its messages and turn records, if it has not
+        ended and was active within `max_age_hours`."""
+        connection = self.connection()
+        row = connection.execute(
+            "SELECT id, session, start_time, end_time FROM interviews WHERE username = ? "
+            "ORDER BY start_time DESC LIMIT 1",
+            (username,),
+        ).fetchone()
+        if row is None or row[3] is not None:
+            return None
+        interview_id, session, start_time, _ = row
+        records = []
+        for role, content, timestamp, metadata in connection.execute(
+            "SELECT role, content, timestamp, metadata FROM messages WHERE interview_id = ? ORDER BY position",
+            (interview_id,),
+        ):
+            record = {"role": role, "content": content, "timestamp": timestamp}
+            record.update(json.loads(metadata) if metadata else {})
+            records.append(record)
+        last_activity = max((record["timestamp"] for record in records), default=start_time)
+        return restored_session(session, start_time, records, last_activity, max_age_hours)
+
+    def finalise(
+        self, username, messages, start_time, closing_code=None, session=None, persona=None, end_time=None, turns=None
+    ):
+        """Store the session's remaining messages and mark it completed, in one transaction."""
+        session = session or session_label(start_time)
+        with self.connection() as connection:
+            interview_id = self._interview_id(connection, username, session, start_time, persona)
+            stored = self._stored_messages(connection, interview_id)
+            self._insert_messages(connection, interview_id, messages[stored:], stored, None)
+            connection.execute(
+                "UPDATE interviews SET end_time = ?, closing_code = ?, completed = 1 WHERE id = ?",
+                (end_time or time.time(), closing_code, interview_id),
+            )
+
+    def is_completed(self, username):
+        # Test account has multiple interview attempts
+        if username == "testaccount":
+            return False
+        row = self.connection().execute(
+            "SELECT 1 FROM interviews WHERE username = ? AND completed = 1 LIMIT 1", (username,)
+        ).fetchone()
+        return row is not None
+
+    def completion_statuses(self, usernames):
+        usernames = list(usernames)
+        completed = set()
+        connection = self.connection()
+        # Query in chunks to stay below SQLite's limit of variables per statement
+        for start in range(0, len(usernames), 500):
+            chunk = usernames[start : start + 500]
+            rows = connection.execute(
+                f"SELECT DISTINCT username FROM interviews WHERE completed = 1 "
+                f"AND username IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            completed.update(username for (username,) in rows)
+        return {username: username in completed and username != "testaccount" for username in usernames}
+
+    def export(self, storage):
+        """Write all sessions to a FileStorage (the flat-file layout) and return their number."""
+        connection = self.connection()
+        interviews = connection.execute(
+            "SELECT id, username, session, persona, start_time, end_time, closing_code, completed "
+            "FROM interviews ORDER BY start_time"
+        ).fetchall()
+        for interview_id, username, session, persona, start_time, end_time, closing_code, completed in interviews:
+            rows = connection.execute(
+                "SELECT role, content, timestamp, metadata FROM messages WHERE interview_id = ? ORDER BY position",
+                (interview_id,),
+            ).fetchall()
+            messages = [{"role": role, "content": content} for role, content, _, _ in rows]
+            metadata = [json.loads(row[3]) for row in rows if row[3]]
+            turns = [fields for fields in metadata if "duration_seconds" in fields]
+
+            # Backup log with the original timestamps and metadata, and backup transcript and time
+            records = []
+            for role, content, timestamp, metadata in rows:
+                record = {"role": role, "content": content, "timestamp": timestamp}
+                record.update(json.loads(metadata) if metadata else {})
+                records.append(record)
+            log_path = storage.backup_log_path(username, session)
+            if os.path.exists(log_path):
+                os.remove(log_path)
+            append_records(log_path, records)
+            if end_time is not None:
+                save_interview_data(
+                    username=username,
+                    transcripts_directory=storage.backups_directory,
+                    times_directory=storage.backups_directory,
+                    messages=messages,
+                    start_time=start_time,
+                    file_name_addition_transcript=f"_transcript_started_{session}",
+                    file_name_addition_time=f"_time_started_{session}",
+                    end_time=end_time,
+                    turns=turns,
+                )
+
+            # Final transcript, time and completion marker
+            if completed:
+                storage.finalise(
+                    username,
+                    messages,
+                    start_time,
+                    closing_code=closing_code,
+                    session=session,
+                    end_time=end_time,
+                    turns=turns,
+                )
+        return len(interviews)
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage():
+    """Return the storage backend of this process for the settings in config.py."""
+    if config.STORAGE_BACKEND == "files":
+        key = (
+            "files",
+            config.TRANSCRIPTS_DIRECTORY,
+            config.TIMES_DIRECTORY,
+            config.BACKUPS_DIRECTORY,
+            config.COMPLETIONS_DIRECTORY,
+        )
+    elif config.STORAGE_BACKEND == "sqlite":
+        key = ("sqlite", config.DATABASE_PATH)
+    else:
+        raise ValueError(f"Unknown storage backend '{config.STORAGE_BACKEND}'.")
+
+    with _storages_lock:
+        if key not in _storages:
+            _storages[key] = FileStorage() if key[0] == "files" else SQLiteStorage()
+        return _storages[key]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage stored interview data.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write the SQLite database as flat files.")
+    export_parser.add_argument("--database", default=config.DATABASE_PATH, help="Path of the SQLite database.")
+    export_parser.add_argument(
+        "--output",
+        default=os.path.join(config.PROJECT_ROOT, "data"),
+        help="Directory receiving transcripts/, times/, backups/ and completed/.",
+    )
+    subparsers.add_parser(
+        "migrate-markers",
+        help="Write completion markers for interviews finalised before markers existed (run once when upgrading).",
+    )
+    args = parser.parse_args()
+
+    if args.command == "migrate-markers":
+        count = write_legacy_completion_markers(
+            config.TRANSCRIPTS_DIRECTORY, config.TIMES_DIRECTORY, config.COMPLETIONS_DIRECTORY
+        )
+        print(f"Wrote {count} completion markers to {config.COMPLETIONS_DIRECTORY}")
+
+    elif args.command == "export":
+        file_storage = FileStorage(
+            transcripts_directory=os.path.join(args.output, "transcripts"),
+            times_directory=os.path.join(args.output, "times"),
+            backups_directory=os.path.join(args.output, "backups"),
+            completions_directory=os.path.join(args.output, "completed"),
+        )
+        count = SQLiteStorage(args.database).export(file_storage)
+        print(f"Exported {count} interview sessions to {args.output}")
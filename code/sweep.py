@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import config
+import simulation
+from corpus import persona_of
+from providers import api_of
+from tracing import profiling
+
+
+# Budgeted sweeps of simulated interviews over a grid of personas x models x
+# temperatures, with `SWEEP_REPETITIONS` interviews per cell. Interviews run
+# concurrently (as with `simulation.py --async`) and are launched one at a time by
+# a scheduler, which picks the cell with the fewest samples so far (so that all
+# cells fill up evenly) among those still within budget. Before launching, it
+# estimates the tokens (and cost, with `MODEL_PRICES`) still needed by the running
+# interviews and by the new one, from running per-turn token averages of each model
+# and the average number of messages per interview; no interview is launched which
+# would exceed the token or cost budget, or end after the deadline. Interviews
+# already running are finished.
+#
+# All models of a sweep use the provider of `MODEL`; the context summaries of long
+# interviews are written by the model of the cell and count against the budget.
+# Usernames are those of simulation.py with the model and temperature appended (e.g.
+# `David_Chen_(Partner)_3_gpt-4o-mini_t0.2`), so that the files of cells and of plain
+# simulation runs do not overwrite each other (corpus.py still attributes them to
+# their persona), and progress is recorded in a manifest
+# of its own (`sweep_manifest.jsonl` in `CHECKPOINTS_DIRECTORY`). Responses served
+# from the response cache are not counted as spent. The summary lists the samples
+# and tokens per cell.
+#
+# Example:
+#   python sweep.py --models gpt-4o-2024-05-13,gpt-4o-mini-2024-07-18 --temperatures 0.2,1.0 --cost-budget 20
+
+MANIFEST_NAME = "sweep_manifest.jsonl"
+
+
+def parse_temperature(text):
+    return None if text in ("", "default", "None") else float(text)
+
+
+def token_cost(model, input_tokens, output_tokens):
+    """Cost in USD of tokens of a model (None if it has no price in MODEL_PRICES)."""
+    if model not in config.MODEL_PRICES:
+        return None
+    input_price, output_price = config.MODEL_PRICES[model]
+    return (input_tokens * input_price + output_tokens * output_price) / 1e6
+
+
+class Cell:
+    """A persona, model and temperature, with the interviews run for it."""
+
+    def __init__(self, number, persona_name, persona_description, model, temperature):
+        # Interview indices of the cell start at number * repetitions (see SweepScheduler.launch)
+        self.number = number
+        self.persona_name = persona_name
+        self.persona_description = persona_description
+        self.model = model
+        self.temperature = temperature
+        self.running = 0
+        self.completed = 0
+        self.failed = 0  # Failed interviews are not repeated, so a cell has at most `repetitions` attempts
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+
+    def username(self, interview_index):
+        """Username of an interview of the cell."""
+        temperature = "default" if self.temperature is None else f"{self.temperature:g}"
+        return f"{simulation.interview_username(self.persona_name, interview_index)}_{self.model}_t{temperature}"
+
+    def settings(self, interview_index):
+        """Settings of an interview of the cell (see simulation.start_interview)."""
+        return {"model": self.model, "temperature": self.temperature, "username": self.username(interview_index)}
+
+    @property
+    def samples(self):
+        return self.completed + self.running
+
+    @property
+    def attempts(self):
+        return self.completed + self.running + self.failed
+
+
+def sweep_cells(personas=None, models=None, temperatures=None):
+    """Cells of all personas, models and temperatures."""
+    personas = personas or config.PERSONAS
+    models = models or config.SWEEP_MODELS or [config.MODEL]
+    temperatures = temperatures or config.SWEEP_TEMPERATURES
+    for model in models:
+        if api_of(model) != simulation.api:
+            raise ValueError(f"Model {model} does not use the API of MODEL ({simulation.api}).")
+    cells = []
+    for persona_name, persona_description in personas.items():
+        number = 0
+        for model in models:
+            for temperature in temperatures:
+                cells.append(Cell(number, persona_name, persona_description, model, temperature))
+                number += 1
+
+    # The corpus attributes simulated interviews to their persona by username
+    for cell in cells:
+        if persona_of(cell.username(0)) != cell.persona_name:
+            raise ValueError(
+                f"Username {cell.username(0)} of a sweep is not attributed to persona {cell.persona_name} "
+                "by corpus.persona_of."
+            )
+    return cells
+
+
+class SweepScheduler:
+    """Decides which interview of a sweep is launched next and keeps track of the tokens spent.
+    Its methods are called from the event loop of the sweep, one at a time."""
+
+    def __init__(self, cells, repetitions=None, token_budget=None, cost_budget=None, deadline=None):
+        self.cells = cells
+        self.repetitions = repetitions or config.SWEEP_REPETITIONS
+        self.token_budget = token_budget
+        self.cost_budget = cost_budget
+        self.deadline = deadline
+        if cost_budget is not None:
+            unpriced = sorted({cell.model for cell in cells if cell.model not in config.MODEL_PRICES})
+            if unpriced:
+                raise ValueError(f"A cost budget needs the prices of {', '.join(unpriced)} in MODEL_PRICES.")
+        self.started = time.time()
+        self.running = {}  # Username: cell, messages and input tokens of the last turn of a running interview
+        self.turn_tokens = {}  # Model: turns, input and output tokens
+        self.messages = []  # Messages per completed interview
+        self.durations = []  # Seconds per completed interview
+        self.stop_reason = None
+
+    def spent(self):
+        """Tokens and cost spent so far."""
+        tokens = sum(cell.input_tokens + cell.output_tokens for cell in self.cells)
+        return tokens, sum(cell.cost for cell in self.cells)
+
+    def tokens_per_turn(self, model):
+        """Average input and output tokens per turn of a model; before its first turn, the
+        system prompt and the maximum output (as the rate limiter estimates requests)."""
+        turns, input_tokens, output_tokens = self.turn_tokens.get(model, (0, 0, 0))
+        if turns == 0:
+            return len(config.SYSTEM_PROMPT) // 4, config.MAX_OUTPUT_TOKENS
+        return input_tokens / turns, output_tokens / turns
+
+    def expected_messages(self):
+        """Average messages per interview (the maximum until an interview has completed)."""
+        if not self.messages:
+            return 2 * config.MAX_CONVERSATION_TURNS + 1
+        return sum(self.messages) / len(self.messages)
+
+    def estimate(self, model, messages=0, last_input_tokens=0):
+        """Tokens and cost of the remaining turns of an interview after `messages` messages.
+        The input of a turn grows with the conversation, so it is at least that of the last turn."""
+        turns = max(self.expected_messages() - messages, 1)
+        input_per_turn, output_per_turn = self.tokens_per_turn(model)
+        input_tokens = turns * max(input_per_turn, last_input_tokens)
+        output_tokens = turns * output_per_turn
+        return input_tokens + output_tokens, token_cost(model, input_tokens, output_tokens) or 0.0
+
+    def committed(self):
+        """Tokens and cost spent so far plus those estimated for the running interviews."""
+        tokens, cost = self.spent()
+        for interview in self.running.values():
+            remaining_tokens, remaining_cost = self.estimate(
+                interview["cell"].model, interview["messages"], interview["last_input_tokens"]
+            )
+            tokens += remaining_tokens
+            cost += remaining_cost
+        return tokens, cost
+
+    def fits(self, cell, committed):
+        """What a new interview of the cell would exceed: 'token budget', 'cost budget' or
+        'deadline' (None if it fits)."""
+        tokens, cost = self.estimate(cell.model)
+        if self.token_budget is not None and committed[0] + tokens > self.token_budget:
+            return "token budget"
+        if self.cost_budget is not None and committed[1] + cost > self.cost_budget:
+            return "cost budget"
+        if self.deadline is not None:
+            duration = sum(self.durations) / len(self.durations) if self.durations else 0
+            if time.time() + duration > self.deadline:
+                return "deadline"
+        return None
+
+    def launch(self):
+        """Return the cell and interview index of the next interview (None if the sweep is done)."""
+        candidates = [cell for cell in self.cells if cell.attempts < self.repetitions]
+        if not candidates:
+            return None
+        # Under-sampled cells first, then those with fewer completed interviews
+        candidates.sort(key=lambda cell: (cell.samples, cell.completed))
+        committed = self.committed()
+        for cell in candidates:
+            reason = self.fits(cell, committed)
+            if reason is None:
+                break
+            # A cheaper cell may still fit the budget, but not the deadline
+            if reason == "deadline":
+                self.stop_reason = reason
+                return None
+        else:
+            self.stop_reason = reason
+            return None
+
+        self.stop_reason = None
+        interview_index = cell.number * self.repetitions + cell.attempts
+        cell.running += 1
+        username = cell.username(interview_index)
+        self.running[username] = {"cell": cell, "messages": 0, "last_input_tokens": 0, "started": time.time()}
+        return cell, interview_index
+
+    def charge(self, cell, record):
+        """Add the tokens and cost of an API call (turn or summary record) to a cell; return its
+        input and output tokens (None if served from the response cache)."""
+        if record.get("served_by") == "cache":
+            return None
+        input_tokens = record.get("input_tokens", 0)
+        output_tokens = record.get("output_tokens", 0)
+        cell.input_tokens += input_tokens
+        cell.output_tokens += output_tokens
+        # Turns served by the fallback model are charged at its price, if it has one
+        model = record.get("model", cell.model)
+        cost = token_cost(model, input_tokens, output_tokens)
+        if cost is None:
+            cost = token_cost(cell.model, input_tokens, output_tokens) or 0.0
+        cell.cost += cost
+        return input_tokens, output_tokens
+
+    def observe_turn(self, state, turn):
+        """Count the tokens of a turn (passed to the interview as `on_turn`)."""
+        interview = self.running[state["username"]]
+        cell = interview["cell"]
+        interview["messages"] += 1
+        tokens = self.charge(cell, turn)
+        if tokens is None:
+            return
+        input_tokens, output_tokens = tokens
+        interview["last_input_tokens"] = input_tokens
+
+        turns, total_input, total_output = self.turn_tokens.get(cell.model, (0, 0, 0))
+        self.turn_tokens[cell.model] = (turns + 1, total_input + input_tokens, total_output + output_tokens)
+
+    def observe_summary(self, state, record):
+        """Count the tokens of a call updating a context summary (passed to the interview as
+        `on_summary`); they are spent, but not part of the estimates per turn."""
+        self.charge(self.running[state["username"]]["cell"], record)
+
+    def finish(self, username, failed=False):
+        """Record the end of an interview."""
+        interview = self.running.pop(username)
+        cell = interview["cell"]
+        cell.running -= 1
+        if failed:
+            cell.failed += 1
+            return
+        cell.completed += 1
+        self.messages.append(interview["messages"])
+        self.durations.append(time.time() - interview["started"])
+
+    def summary(self):
+        """Samples completed and tokens spent per cell and in total."""
+        tokens, cost = self.spent()
+        return {
+            "cells": [
+                {
+                    "persona": cell.persona_name,
+                    "model": cell.model,
+                    "temperature": cell.temperature,
+                    "completed": cell.completed,
+                    "failed": cell.failed,
+                    "input_tokens": cell.input_tokens,
+                    "output_tokens": cell.output_tokens,
+                    "cost": round(cell.cost, 4),
+                }
+                for cell in self.cells
+            ],
+            "completed": sum(cell.completed for cell in self.cells),
+            "planned": len(self.cells) * self.repetitions,
+            "tokens": tokens,
+            "cost": round(cost, 4),
+            "token_budget": self.token_budget,
+            "cost_budget": self.cost_budget,
+            "stopped_by": self.stop_reason,
+            "seconds": round(time.time() - self.started, 1),
+        }
+
+
+async def run_sweep(scheduler, concurrency=None, async_client=None):
+    """Run the interviews of a sweep with up to `concurrency` at the same time."""
+    simulation.create_directories()
+    concurrency = concurrency or config.SIMULATION_CONCURRENCY
+    # A manifest of its own, so that `simulation.py --resume` still finds that of the last simulation run
+    manifest = os.path.join(config.CHECKPOINTS_DIRECTORY, MANIFEST_NAME)
+    open(manifest, "w").close()
+
+    close_client = async_client is None
+    async_client = async_client or simulation.create_client(asynchronous=True)
+    fallback = simulation.fallback_route(asynchronous=True)
+    # The scheduler launches no more than `concurrency` interviews, so they never wait for a slot
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = {}
+    while True:
+        while len(tasks) < concurrency:
+            launch = scheduler.launch()
+            if launch is None:
+                break
+            cell, interview_index = launch
+            task = asyncio.create_task(
+                simulation.run_interview_async(
+                    async_client,
+                    semaphore,
+                    cell.persona_name,
+                    cell.persona_description,
+                    interview_index,
+                    manifest,
+                    fallback=fallback,
+                    settings=cell.settings(interview_index),
+                    on_turn=scheduler.observe_turn,
+                    on_summary=scheduler.observe_summary,
+                )
+            )
+            tasks[task] = cell.username(interview_index)
+        if not tasks:
+            break
+
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            username = tasks.pop(task)
+            # A failing interview does not stop the others, but is reported
+            if task.exception() is not None:
+                print(f"  Interview {username} failed: {task.exception()!r}")
+            scheduler.finish(username, failed=task.exception() is not None)
+
+    simulation.print_pool_stats()
+    simulation.print_run_stats()
+
+    if close_client:
+        await async_client.close()
+    if fallback is not None:
+        await fallback.client.close()
+    return scheduler.summary()
+
+
+def print_summary(summary):
+    for cell in summary["cells"]:
+        temperature = "default" if cell["temperature"] is None else cell["temperature"]
+        print(
+            f"{cell['persona']:32} {cell['model']:28} {temperature!s:>7}  {cell['completed']} completed"
+            f"  {cell['failed']} failed  {cell['input_tokens'] + cell['output_tokens']} tokens  ${cell['cost']:.4f}"
+        )
+    line = (
+        f"{summary['completed']}/{summary['planned']} interviews, {summary['tokens']} tokens, "
+        f"${summary['cost']:.4f} in {summary['seconds']} seconds"
+    )
+    if summary["stopped_by"]:
+        line += f" (stopped by the {summary['stopped_by']})"
+    print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate interviews over personas x models x temperatures.")
+    parser.add_argument("--models", help="Comma-separated models (default: SWEEP_MODELS or MODEL).")
+    parser.add_argument("--temperatures", help="Comma-separated temperatures, 'default' for the provider's default.")
+    parser.add_argument("--repetitions", type=int, default=config.SWEEP_REPETITIONS, help="Interviews per cell.")
+    parser.add_argument("--token-budget", type=int, default=config.SWEEP_TOKEN_BUDGET)
+    parser.add_argument("--cost-budget", type=float, default=config.SWEEP_COST_BUDGET, help="In USD.")
+    parser.add_argument("--deadline-minutes", type=float, default=config.SWEEP_DEADLINE_MINUTES)
+    parser.add_argument("--concurrency", type=int, default=config.SIMULATION_CONCURRENCY)
+    parser.add_argument(
+        "--cache",
+        choices=["record", "replay", "bypass"],
+        default=config.RESPONSE_CACHE,
+        help="Reuse cached API responses and store new ones (record), only use cached ones (replay), or neither.",
+    )
+    parser.add_argument("--output", help="Write the summary to this JSON file.")
+    parser.add_argument(
+        "--profile", action="store_true", default=config.PROFILE, help="Trace the phases of all turns (see tracing.py)."
+    )
+    parser.add_argument("--cprofile", action="store_true", help="With --profile, also write a cProfile dump.")
+    args = parser.parse_args()
+    config.RESPONSE_CACHE = args.cache
+
+    scheduler = SweepScheduler(
+        sweep_cells(
+            models=args.models.split(",") if args.models else None,
+            temperatures=[parse_temperature(t) for t in args.temperatures.split(",")] if args.temperatures else None,
+        ),
+        repetitions=args.repetitions,
+        token_budget=args.token_budget,
+        cost_budget=args.cost_budget,
+        deadline=time.time() + 60 * args.deadline_minutes if args.deadline_minutes else None,
+    )
+    with profiling("sweep", args.profile, args.cprofile):
+        summary = asyncio.run(run_sweep(scheduler, args.concurrency))
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
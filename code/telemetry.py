@@ -0,0 +1,264 @@
+import argparse
+import json
+import math
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+from transcript_log import append_records
+
+
+# Per-turn telemetry. Every generated message gets a turn record with the time the
+# request started, time to first token (streamed requests only), duration, output
+# tokens per second, input/cached/output token counts, retries and time spent in
+# backoff or waiting for the rate limiter, and the respondent's think time before
+# the request (and for the app, how often the streamed message was re-rendered, see
+# rendering.py). Turn records are stored with the message in the interview's backup,
+# summarised in its times file, and appended to a process-wide metrics log
+# (`METRICS_PATH`), from which `python telemetry.py` computes p50/p95/p99 per model
+# as Prometheus text or JSON.
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+# Metrics summarised per model: (name in the turn record, Prometheus name, help text)
+SUMMARIES = [
+    ("duration_seconds", "interview_turn_duration_seconds", "Duration of API requests generating a message."),
+    ("ttft_seconds", "interview_turn_ttft_seconds", "Time to first token of streamed API requests."),
+    ("tokens_per_second", "interview_turn_tokens_per_second", "Output tokens per second of API requests."),
+    ("think_seconds", "interview_turn_think_seconds", "Time respondents took to reply."),
+    ("backoff_seconds", "interview_turn_backoff_seconds", "Time spent waiting before requests and retries."),
+]
+
+# Metrics summed per model
+COUNTERS = [
+    ("input_tokens", "interview_input_tokens_total", "Input tokens (cached and uncached)."),
+    ("cached_input_tokens", "interview_cached_input_tokens_total", "Input tokens read from the prompt cache."),
+    ("output_tokens", "interview_output_tokens_total", "Output tokens."),
+    ("retries", "interview_retries_total", "Retried API requests."),
+    ("render_deltas", "interview_render_deltas_total", "Text deltas received by the app."),
+    ("render_updates", "interview_render_updates_total", "Updates of streamed messages sent to the browser."),
+    ("render_characters", "interview_render_characters_total", "Characters of streamed messages sent to the browser."),
+]
+
+
+class TurnTimer:
+    """Measures one API request generating a message (created when the request starts)."""
+
+    def __init__(self, speaker, think_seconds=None):
+        self.speaker = speaker
+        self.think_seconds = think_seconds
+        self.request_start = time.time()
+        self.started = time.perf_counter()
+        self.ttft_seconds = None
+        self.retries = 0
+        self.backoff_seconds = 0.0
+        self.path = None
+        self.model = None
+
+    def served_by(self, path, model):
+        """Note which path ('primary', 'hedge' or 'failover', see providers.py, or 'cache', see
+        response_cache.py) and model served the request."""
+        self.path = path
+        self.model = model
+
+    def token(self):
+        """Note that a token (text delta) was received."""
+        if self.ttft_seconds is None:
+            self.ttft_seconds = time.perf_counter() - self.started
+
+    def retry(self, delay):
+        """Note that the request is retried after `delay` seconds."""
+        self.retries += 1
+        self.backoff_seconds += delay
+
+    def wait(self, seconds):
+        """Note time spent waiting for the rate limiter before the request was sent."""
+        self.backoff_seconds += seconds
+
+    def record(self, usage=None):
+        """Return the turn record, including the token counts of the request."""
+        duration = time.perf_counter() - self.started
+        usage = usage or {}
+
+        # Generation speed after the first token if streamed, otherwise over the whole request
+        generation_seconds = duration - (self.ttft_seconds or 0) - self.backoff_seconds
+        tokens_per_second = None
+        if usage.get("output_tokens") and generation_seconds > 0:
+            tokens_per_second = round(usage["output_tokens"] / generation_seconds, 2)
+
+        record = {
+            "speaker": self.speaker,
+            "model": self.model or config.MODEL,
+            "served_by": self.path,
+            "request_start": self.request_start,
+            "ttft_seconds": None if self.ttft_seconds is None else round(self.ttft_seconds, 4),
+            "duration_seconds": round(duration, 4),
+            "tokens_per_second": tokens_per_second,
+            "retries": self.retries,
+            "backoff_seconds": round(self.backoff_seconds, 4),
+            "think_seconds": None if self.think_seconds is None else round(self.think_seconds, 4),
+        }
+        record.update(usage)
+        return {key: value for key, value in record.items() if value is not None}
+
+
+def write_metrics(metrics_path, records):
+    """Append turn records to a metrics log."""
+    os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+    append_records(metrics_path, records)
+
+
+def record_turn(username, turn, metrics_path=None, queue=None):
+    """Append a turn record to the metrics log, or queue it on a write-behind queue (see
+    write_behind.py); errors are reported but never stop an interview."""
+    if not config.TELEMETRY:
+        return
+    metrics_path = metrics_path or config.METRICS_PATH
+    record = dict(turn, username=username)
+    if queue is not None:
+        queue.append_metrics(metrics_path, [record])
+        return
+    try:
+        write_metrics(metrics_path, [record])
+    except OSError as e:
+        print(f"Error writing metrics: {e}")
+
+
+def turns_table(turns):
+    """Per-turn lines of a times file."""
+    columns = [
+        ("Turn", None),
+        ("Speaker", "speaker"),
+        ("Think (s)", "think_seconds"),
+        ("TTFT (s)", "ttft_seconds"),
+        ("Duration (s)", "duration_seconds"),
+        ("Tokens/s", "tokens_per_second"),
+        ("Input tokens", "input_tokens"),
+        ("Cached input tokens", "cached_input_tokens"),
+        ("Output tokens", "output_tokens"),
+        ("Retries", "retries"),
+        ("Backoff (s)", "backoff_seconds"),
+    ]
+    lines = ["\t".join(name for name, _ in columns)]
+    for number, turn in enumerate(turns, start=1):
+        values = [str(number)] + [
+            "" if turn.get(key) is None else f"{turn[key]:.2f}" if isinstance(turn[key], float) else str(turn[key])
+            for _, key in columns[1:]
+        ]
+        lines.append("\t".join(values))
+    return "\n".join(lines)
+
+
+def quantile(values, q):
+    """Quantile of sorted values (nearest rank)."""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def aggregate(turns):
+    """Quantiles, sums and counts of the turn metrics per model."""
+    by_model = {}
+    for turn in turns:
+        by_model.setdefault(turn.get("model", "unknown"), []).append(turn)
+
+    metrics = {}
+    for model, model_turns in sorted(by_model.items()):
+        model_metrics = {"turns": len(model_turns)}
+        for key, _, _ in SUMMARIES:
+            values = sorted(turn[key] for turn in model_turns if turn.get(key) is not None)
+            if values:
+                model_metrics[key] = {
+                    "count": len(values),
+                    "sum": round(sum(values), 4),
+                    **{f"p{int(q * 100)}": quantile(values, q) for q in QUANTILES},
+                }
+        for key, _, _ in COUNTERS:
+            model_metrics[key] = sum(turn.get(key, 0) for turn in model_turns)
+        metrics[model] = model_metrics
+    return metrics
+
+
+def prometheus_text(metrics):
+    """Metrics in the Prometheus text exposition format."""
+    lines = []
+    for key, name, help_text in SUMMARIES:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} summary"]
+        for model, model_metrics in metrics.items():
+            if key not in model_metrics:
+                continue
+            summary = model_metrics[key]
+            for q in QUANTILES:
+                lines.append(f'{name}{{model="{model}",quantile="{q}"}} {summary[f"p{int(q * 100)}"]}')
+            lines.append(f'{name}_sum{{model="{model}"}} {summary["sum"]}')
+            lines.append(f'{name}_count{{model="{model}"}} {summary["count"]}')
+    for key, name, help_text in COUNTERS + [("turns", "interview_turns_total", "Generated messages.")]:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for model, model_metrics in metrics.items():
+            lines.append(f'{name}{{model="{model}"}} {model_metrics[key]}')
+    return "\n".join(lines) + "\n"
+
+
+def read_turns(metrics_path):
+    """Return the turn records of a metrics log (skipping lines which were not completely written)."""
+    turns = []
+    if not os.path.exists(metrics_path):
+        return turns
+    with open(metrics_path, "r") as log:
+        for line in log:
+            try:
+                turns.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return turns
+
+
+def export_metrics(metrics_path, output_format="prometheus"):
+    """Aggregate the metrics log as Prometheus text or JSON."""
+    turns = read_turns(metrics_path)
+    metrics = aggregate(turns)
+    if output_format == "json":
+        return json.dumps(metrics, indent=2)
+    return prometheus_text(metrics)
+
+
+def serve_metrics(metrics_path, host, port):
+    """Serve the aggregated metrics log at /metrics (Prometheus text) and /metrics.json."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path not in ("/metrics", "/metrics.json"):
+                self.send_error(404)
+                return
+            output_format = "json" if path.endswith(".json") else "prometheus"
+            data = export_metrics(metrics_path, output_format).encode()
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "application/json" if output_format == "json" else "text/plain; version=0.0.4"
+            )
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export per-turn latency and token metrics.")
+    parser.add_argument("--metrics", default=config.METRICS_PATH, help="Path of the metrics log.")
+    parser.add_argument("--format", choices=["prometheus", "json"], default="prometheus")
+    parser.add_argument("--output", help="Write to this file (e.g. for a Prometheus textfile collector).")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="Serve /metrics and /metrics.json on this port.")
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_metrics(args.metrics, args.host, args.serve)
+    elif args.output:
+        text = export_metrics(args.metrics, args.format)
+        with open(args.output + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(args.output + ".tmp", args.output)
+    else:
+        print(export_metrics(args.metrics, args.format), end="")
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+
+import config
+from telemetry import quantile
+
+
+# Span tracing of the phases of a turn (building the request, waiting for the rate
+# limiter, the API call, retry sleeps, console output, checkpoints and saving), to
+# find where the time of a slow simulation or interview goes. Code marks a phase
+# with `with span("name"):` (or a function with `@traced("name")`); while tracing
+# is off (the default), `span` returns a shared no-op context manager, so
+# instrumented code costs about one function call.
+#
+# `python simulation.py --profile` (and `sweep.py --profile`) or
+# `streamlit run interview.py -- --profile` (or `PROFILE = True` in config.py)
+# write the spans to a trace file in `PROFILES_DIRECTORY`, in the Chrome trace event
+# format, which can be opened in https://ui.perfetto.dev or chrome://tracing. Spans
+# of concurrent interviews (threads or asyncio tasks) are shown on separate tracks.
+# Simulations then print the time per phase, counting the time of nested phases only
+# once (self time); `python tracing.py TRACE` prints it for any trace file. With
+# `--cprofile`, simulations also write a cProfile dump of the Python code.
+
+FLUSH_EVENTS = 1000  # Spans kept in memory before they are appended to the trace file
+
+_tracer = None
+_NO_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add(self.name, self.started, time.perf_counter(), self.args)
+        return False
+
+
+class Tracer:
+    """Collects spans and appends them to a trace file (JSON array format, which does not
+    need to be closed, so that a running process can keep appending)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        # Timestamps are microseconds since the epoch, so that traces of several processes line up
+        self.origin = time.time() - time.perf_counter()
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("[\n")
+        self.first = True
+
+    def track(self):
+        """Track of the current asyncio task or thread, named when it is first used."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = ("task", id(task)) if task is not None else ("thread", threading.get_ident())
+        if key not in self.tracks:
+            self.tracks[key] = len(self.tracks) + 1
+            name = task.get_name() if task is not None else threading.current_thread().name
+            self.events.append(
+                {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": self.tracks[key], "args": {"name": name}}
+            )
+        return self.tracks[key]
+
+    def add(self, name, started, ended, args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": round((self.origin + started) * 1e6),
+            "dur": round((ended - started) * 1e6),
+            "pid": self.pid,
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            event["tid"] = self.track()
+            self.events.append(event)
+            if len(self.events) >= FLUSH_EVENTS:
+                self._flush()
+
+    def _flush(self):
+        if not self.events:
+            return
+        lines = [json.dumps(event) for event in self.events]
+        with open(self.path, "a") as f:
+            f.write(("" if self.first else ",\n") + ",\n".join(lines))
+        self.first = False
+        self.events = []
+
+    def flush(self):
+        """Append the collected spans to the trace file."""
+        with self.lock:
+            self._flush()
+
+
+def span(name, **args):
+    """Context manager timing a phase (does nothing while tracing is off)."""
+    if _tracer is None:
+        return _NO_SPAN
+    return _Span(_tracer, name, args)
+
+
+def traced(name):
+    """Decorator timing every call of a function as a phase."""
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _Span(_tracer, name, None):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def start_tracing(path):
+    """Record spans to a trace file (if not already tracing) and return the tracer."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(path)
+    return _tracer
+
+
+def stop_tracing():
+    """Stop tracing and write the remaining spans; return the path of the trace file."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return None
+    tracer.flush()
+    with open(tracer.path, "a") as f:
+        f.write("\n]\n")
+    return tracer.path
+
+
+def flush_trace():
+    """Append the spans collected so far to the trace file (e.g. after each rerun of the app)."""
+    if _tracer is not None:
+        _tracer.flush()
+
+
+def trace_path(name):
+    """Path of a new trace file of a program."""
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(config.PROFILES_DIRECTORY, f"{name}-{stamp}-{os.getpid()}.trace.json")
+
+
+def read_trace(path):
+    """Span events of a trace file, also if it was not closed."""
+    with open(path, "r") as f:
+        text = f.read().strip()
+    if not text.endswith("]"):
+        text = text.rstrip(",") + "]"
+    return [event for event in json.loads(text) if event.get("ph") == "X"]
+
+
+def breakdown(events):
+    """Count, total time and self time (without nested spans) per phase, in seconds."""
+    phases = {}
+    by_track = {}
+    for event in events:
+        by_track.setdefault((event["pid"], event["tid"]), []).append(event)
+    for track_events in by_track.values():
+        # Parents start before (or with, and last longer than) their children
+        track_events.sort(key=lambda event: (event["ts"], -event["dur"]))
+        stack = []
+        for event in track_events:
+            while stack and event["ts"] >= stack[-1]["ts"] + stack[-1]["dur"]:
+                stack.pop()
+            phase = phases.setdefault(event["name"], {"count": 0, "durations": [], "self": 0})
+            phase["count"] += 1
+            phase["durations"].append(event["dur"])
+            phase["self"] += event["dur"]
+            if stack:
+                phases[stack[-1]["name"]]["self"] -= event["dur"]
+            stack.append(event)
+
+    result = {}
+    for name, phase in phases.items():
+        durations = sorted(phase["durations"])
+        result[name] = {
+            "count": phase["count"],
+            "total_seconds": round(sum(durations) / 1e6, 4),
+            "self_seconds": round(phase["self"] / 1e6, 4),
+            "p50_ms": round(quantile(durations, 0.5) / 1e3, 3),
+            "p95_ms": round(quantile(durations, 0.95) / 1e3, 3),
+            "max_ms": round(durations[-1] / 1e3, 3),
+        }
+    return dict(sorted(result.items(), key=lambda item: -item[1]["self_seconds"]))
+
+
+def format_breakdown(phases):
+    """Table of the time per phase, largest self time first."""
+    total = sum(phase["self_seconds"] for phase in phases.values()) or 1
+    lines = [
+        f"{'Phase':24} {'Count':>8} {'Self (s)':>10} {'Share':>7} {'Total (s)':>10} {'p50 (ms)':>10} {'p95 (ms)':>10}"
+    ]
+    for name, phase in phases.items():
+        lines.append(
+            f"{name:24} {phase['count']:8} {phase['self_seconds']:10.3f} {100 * phase['self_seconds'] / total:6.1f}%"
+            f" {phase['total_seconds']:10.3f} {phase['p50_ms']:10.2f} {phase['p95_ms']:10.2f}"
+        )
+    return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def profiling(name, enabled=True, cprofile=False):
+    """Trace the block (and with `cprofile`, profile it with cProfile), then print the time per phase."""
+    if not enabled:
+        yield
+        return
+    path = start_tracing(trace_path(name)).path
+    profiler = cProfile.Profile() if cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        stop_tracing()
+        print(f"Trace written to {path} (open it in https://ui.perfetto.dev or chrome://tracing)")
+        print(format_breakdown(breakdown(read_trace(path))))
+        if profiler is not None:
+            profile_path = path[: -len(".trace.json")] + ".prof"
+            profiler.dump_stats(profile_path)
+            print(f"cProfile dump written to {profile_path} (e.g. python -m pstats {profile_path})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the time per phase of a trace file.")
+    parser.add_argument("trace", help="Trace file written with --profile.")
+    parser.add_argument("--json", action="store_true", help="Print the breakdown as JSON.")
+    args = parser.parse_args()
+
+    phases = breakdown(read_trace(args.trace))
+    print(json.dumps(phases, indent=2) if args.json else format_breakdown(phases))
@@ -0,0 +1,78 @@
+import argparse
+import json
+import time
+
+
+# Append-only interview logs. Every message is written once as a JSON line with its
+# role, content, timestamp and (if known) token counts, so that backing up an
+# interview after each turn only writes the new messages. The `role: content`
+# transcript can be rendered from a log at any time.
+
+
+def log_record(message, **fields):
+    """Return the log record of a message; fields which are None are left out."""
+    record = {"role": message["role"], "content": message["content"], "timestamp": time.time()}
+    record.update({key: value for key, value in fields.items() if value is not None})
+    return record
+
+
+def append_records(log_path, records):
+    """Append records to a log with a single write."""
+    if not records:
+        return
+    with open(log_path, "a") as log:
+        log.write("".join(json.dumps(record) + "\n" for record in records))
+        log.flush()
+
+
+def message_records(messages, **fields):
+    """Log records of messages; `fields` (e.g. token counts) are added to the last record."""
+    records = [log_record(message) for message in messages[:-1]]
+    if messages:
+        records.append(log_record(messages[-1], **fields))
+    return records
+
+
+def append_messages(log_path, messages, **fields):
+    """Append messages to a log; `fields` (e.g. token counts) are added to the last record."""
+    append_records(log_path, message_records(messages, **fields))
+
+
+def read_log(log_path):
+    """Return all complete records of a log."""
+    records = []
+    with open(log_path, "r") as log:
+        for line in log:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Last line may be incomplete if the process was stopped while writing
+                break
+    return records
+
+
+def read_messages(log_path):
+    """Return the messages ({'role': ..., 'content': ...}) stored in a log."""
+    return [
+        {"role": record["role"], "content": record["content"]}
+        for record in read_log(log_path)
+        if "role" in record
+    ]
+
+
+def render_transcript(log_path, transcript_path):
+    """Write the `role: content` transcript of a log (except system prompt or first message)."""
+    with open(transcript_path, "w") as t:
+        for message in read_messages(log_path)[1:]:
+            t.write(f"{message['role']}: {message['content']}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the transcript of an interview log.")
+    parser.add_argument("log_path", help="Path of the .jsonl interview log.")
+    parser.add_argument("transcript_path", nargs="?", help="Output path (default: log path with .txt).")
+    args = parser.parse_args()
+
+    transcript_path = args.transcript_path or args.log_path.rsplit(".", 1)[0] + ".txt"
+    render_transcript(args.log_path, transcript_path)
+    print(f"Saved transcript to: {transcript_path}")
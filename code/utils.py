@@ -1,6 +1,10 @@
 
 import time
 import os
+import json
+import tempfile
+from completion_index import get_completion_index
+from telemetry import turns_table
 
 
 # Password screen for dashboard (note: only very basic authentication!)
@@ -40,24 +44,53 @@ def check_password():
 
 
 def check_if_interview_completed(directory, username):
-    """Check if interview transcript/time file exists which signals that interview was completed."""
+    """Check if the completion marker of the interview exists, which is only written once
+    transcript and time file are completely stored (see finalise_interview)."""
 
     # Test account has multiple interview attempts
     if username != "testaccount":
 
-        # Check if file exists
-        try:
-            with open(os.path.join(directory, f"{username}.txt"), "r") as _:
-                return True
-
-        except FileNotFoundError:
-            return False
+        # Look up in the in-process index, which only checks the disk on a miss
+        return get_completion_index(directory).is_completed(username)
 
     else:
 
         return False
 
 
+def check_if_interviews_completed(directory, usernames):
+    """Completion status of several usernames at once, e.g. for study dashboards."""
+    statuses = get_completion_index(directory).statuses(usernames)
+    if "testaccount" in statuses:
+        statuses["testaccount"] = False
+    return statuses
+
+
+def write_file_atomically(path, text):
+    """Write a file via a temporary file, fsync and rename, so that it is either complete or not changed."""
+    directory = os.path.dirname(path) or "."
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+    try:
+        with os.fdopen(file_descriptor, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        # Temporary files are only readable by the owner by default
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+    # Make the rename itself durable (not supported on Windows)
+    if hasattr(os, "O_DIRECTORY"):
+        directory_descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
+
+
 def save_interview_data(
     username,
     transcripts_directory,
@@ -66,29 +99,90 @@ def save_interview_data(
     start_time,
     file_name_addition_transcript="",
     file_name_addition_time="",
+    end_time=None,
+    turns=None,
 ):
-    """Write interview data (transcript and time) to disk."""
+    """Write interview data (transcript and time) to disk; the interview ends now unless `end_time`
+    is given, and the time file lists the telemetry of each turn if `turns` are given."""
 
     # Store chat transcript
     transcript_path = os.path.join(
         transcripts_directory, f"{username}{file_name_addition_transcript}.txt"
     )
     print(f"Saving transcript to: {transcript_path}")
-    with open(
+    write_file_atomically(
         transcript_path,
-        "w",
-    ) as t:
-        for message in messages[1:]:
-            t.write(f"{message['role']}: {message['content']}\n")
+        "".join(f"{message['role']}: {message['content']}\n" for message in messages[1:]),
+    )
 
     # Store file with start time and duration of interview
     time_path = os.path.join(times_directory, f"{username}{file_name_addition_time}.txt")
     print(f"Saving time data to: {time_path}")
-    with open(
-        time_path,
-        "w",
-    ) as d:
-        duration = (time.time() - start_time) / 60
-        d.write(
-            f"Start time (UTC): {time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(start_time))}\nInterview duration (minutes): {duration:.2f}"
-        )
+    duration = ((end_time or time.time()) - start_time) / 60
+    time_text = f"Start time (UTC): {time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(start_time))}\nInterview duration (minutes): {duration:.2f}"
+    if turns:
+        time_text += "\n\n" + turns_table(turns)
+    write_file_atomically(time_path, time_text)
+
+    return transcript_path, time_path
+
+
+def finalise_interview(
+    username,
+    transcripts_directory,
+    times_directory,
+    completions_directory,
+    messages,
+    start_time,
+    closing_code=None,
+    end_time=None,
+    turns=None,
+):
+    """Store the final transcript and time files and then commit the completion marker.
+
+    Each file is replaced atomically, and the marker is only written after both files
+    are durably stored, so an interview never counts as completed with partial files.
+    """
+    transcript_path, time_path = save_interview_data(
+        username, transcripts_directory, times_directory, messages, start_time, end_time=end_time, turns=turns
+    )
+    marker = {
+        "username": username,
+        "completed_at": time.time(),
+        "closing_code": closing_code,
+        "transcript": os.path.basename(transcript_path),
+        "time": os.path.basename(time_path),
+        "messages": len(messages),
+    }
+    write_file_atomically(
+        os.path.join(completions_directory, f"{username}.json"), json.dumps(marker)
+    )
+    get_completion_index(completions_directory).mark_completed(username)
+
+
+def write_legacy_completion_markers(transcripts_directory, times_directory, completions_directory):
+    """Write completion markers for interviews finalised before markers were introduced (which
+    only have a time file); return the number of markers written. Run once when upgrading."""
+    os.makedirs(completions_directory, exist_ok=True)
+    written = 0
+    for file_name in sorted(os.listdir(times_directory)) if os.path.isdir(times_directory) else []:
+        if not file_name.endswith(".txt") or file_name.startswith("."):
+            continue
+        username = file_name[: -len(".txt")]
+        marker_path = os.path.join(completions_directory, f"{username}.json")
+        if os.path.exists(marker_path):
+            continue
+        transcript_path = os.path.join(transcripts_directory, file_name)
+        marker = {
+            "username": username,
+            "completed_at": os.path.getmtime(os.path.join(times_directory, file_name)),
+            "closing_code": None,
+            "transcript": file_name if os.path.exists(transcript_path) else None,
+            "time": file_name,
+            "messages": None,
+            "migrated": True,
+        }
+        write_file_atomically(marker_path, json.dumps(marker))
+        get_completion_index(completions_directory).mark_completed(username)
+        written += 1
+    return written
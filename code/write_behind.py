@@ -0,0 +1,231 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from storage import get_storage
+from telemetry import write_metrics
+from tracing import span
+from transcript_log import message_records
+
+
+# Write-behind queue for the per-turn backups of the app, so that a slow or
+# networked disk does not add to the time before a respondent can answer. After a
+# turn, the new messages are turned into log records (with the time of the turn)
+# and queued; a worker thread per process writes them to the storage backend.
+# Records of a session which are queued while an earlier write is pending are
+# coalesced into one write, and as a single worker writes in queue order, the
+# records of each session are stored in order.
+#
+# A failed write is counted and reported (`stats`), and its records are kept and
+# written again, before newer ones, with the next write of the session or when the
+# queue is flushed. Sessions are flushed before their backup is completed and the
+# interview is finalised, and all sessions when the process exits (waiting up to
+# `BACKUP_FLUSH_TIMEOUT` seconds). With `BACKUP_WRITE_BEHIND = False`, backups are
+# written right away on the script thread, with the same error handling.
+#
+# The app's per-turn metrics (see telemetry.py) are written by the same worker
+# whenever no backups are waiting. Metrics are best effort: records of a
+# failed write are counted as an error and dropped.
+
+
+class WriteBehindQueue:
+    """Per-turn backup (and metrics) writes of a storage backend, done in the background."""
+
+    def __init__(self, storage, background=True):
+        self.storage = storage
+        self.background = background
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # (username, session): start time, persona and records to write
+        self.metrics = OrderedDict()  # Path of a metrics log: turn records to append
+        self.failed = {}  # Records of sessions whose last write failed, written again with the next one
+        self.writing = None  # Session being written by the worker
+        self.closed = False
+        self.counters = {"queued": 0, "coalesced": 0, "writes": 0, "errors": 0, "max_depth": 0}
+        self.last_error = None
+        self.worker = None
+        if background:
+            self.worker = threading.Thread(target=self._run, name="backup-write-behind", daemon=True)
+            self.worker.start()
+
+    def append(self, username, session, start_time, messages, persona=None, **fields):
+        """Queue the new messages of a session (`fields` are stored with the last one)."""
+        records = message_records(messages, **fields)
+        if not records:
+            return
+        key = (username, session)
+        with self.condition:
+            self.counters["queued"] += 1
+            if key in self.pending:
+                self.pending[key]["records"].extend(records)
+                self.counters["coalesced"] += 1
+            else:
+                entry = self.failed.pop(key, None) or {"start_time": start_time, "persona": persona, "records": []}
+                entry["records"].extend(records)
+                self.pending[key] = entry
+            self.counters["max_depth"] = max(self.counters["max_depth"], self._depth())
+            self.condition.notify_all()
+        if not self.background:
+            self._write_pending()
+
+    def append_metrics(self, path, records):
+        """Queue turn records to append to a metrics log."""
+        with self.condition:
+            self.counters["queued"] += 1
+            self.metrics.setdefault(path, []).extend(records)
+            self.counters["max_depth"] = max(self.counters["max_depth"], self._depth())
+            self.condition.notify_all()
+        if not self.background:
+            self._write_pending()
+
+    def _depth(self):
+        return sum(len(entry["records"]) for entry in self.pending.values()) + sum(
+            len(records) for records in self.metrics.values()
+        )
+
+    def _write_next(self):
+        """Write the records of the session queued first (or else of a metrics log); return
+        False if none are queued."""
+        with self.condition:
+            if not self.pending:
+                if not self.metrics:
+                    return False
+                path, records = self.metrics.popitem(last=False)
+                # Metrics belong to no user, so only flushes of all users wait for them
+                self.writing = (None, path)
+                key = None
+            else:
+                key, entry = self.pending.popitem(last=False)
+                self.writing = key
+        try:
+            if key is None:
+                self._write_metrics(path, records)
+            else:
+                self._write_backup(key, entry)
+        finally:
+            with self.condition:
+                self.writing = None
+                self.condition.notify_all()
+        return True
+
+    def _write_backup(self, key, entry):
+        username, session = key
+        try:
+            with span("backup_write"):
+                self.storage.append_backup_records(
+                    username, session, entry["start_time"], entry["records"], persona=entry["persona"]
+                )
+        except Exception as e:
+            print(f"Error writing backup of {username}: {e!r}")
+            with self.condition:
+                self.counters["errors"] += 1
+                self.last_error = repr(e)
+                # Keep the records, ahead of any queued meanwhile
+                if key in self.pending:
+                    self.pending[key]["records"][:0] = entry["records"]
+                else:
+                    self.failed[key] = entry
+        else:
+            with self.condition:
+                self.counters["writes"] += 1
+
+    def _write_metrics(self, path, records):
+        try:
+            with span("metrics_write"):
+                write_metrics(path, records)
+        except Exception as e:
+            print(f"Error writing metrics: {e!r}")
+            with self.condition:
+                self.counters["errors"] += 1
+                self.last_error = repr(e)
+        else:
+            with self.condition:
+                self.counters["writes"] += 1
+
+    def _write_pending(self):
+        while self._write_next():
+            pass
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.metrics or self.closed)
+                if self.closed and not self.pending and not self.metrics:
+                    return
+            self._write_next()
+
+    def flush(self, username=None, session=None, timeout=None):
+        """Write the queued records of a session (of all sessions of `username` if `session`
+        is None, or of all users), also retrying failed writes once; return whether
+        everything was written."""
+
+        def matches(key):
+            return username is None or (key[0] == username and (session is None or key[1] == session))
+
+        def done():
+            return (
+                not any(matches(key) for key in self.pending)
+                and (username is not None or not self.metrics)
+                and (self.writing is None or not matches(self.writing))
+            )
+
+        # Sessions whose write fails while waiting (also the last write of the worker) are retried once
+        retried = set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.condition:
+                retry = [key for key in self.failed if matches(key) and key not in retried]
+                for key in retry:
+                    self.pending[key] = self.failed.pop(key)
+                retried.update(retry)
+                self.condition.notify_all()
+            if not self.background:
+                self._write_pending()
+            with self.condition:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                if not self.condition.wait_for(done, remaining):
+                    return False
+                if not any(matches(key) and key not in retried for key in self.failed):
+                    return not any(matches(key) for key in self.failed)
+
+    def close(self, timeout=None):
+        """Flush all sessions and stop the worker."""
+        timeout = config.BACKUP_FLUSH_TIMEOUT if timeout is None else timeout
+        written = self.flush(timeout=timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.worker is not None:
+            self.worker.join(timeout)
+        if not written:
+            print(f"Backups of {len(self.pending) + len(self.failed)} sessions could not be written.")
+        return written
+
+    def stats(self):
+        """Queue depth (sessions, metrics and records waiting), sessions with failed writes and counters."""
+        with self.condition:
+            return {
+                "pending_sessions": len(self.pending),
+                "pending_metrics": sum(len(records) for records in self.metrics.values()),
+                "depth": self._depth(),
+                "failed_sessions": len(self.failed),
+                **self.counters,
+                "last_error": self.last_error,
+            }
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_write_queue(storage=None):
+    """Return the write-behind queue of this process for a storage backend (default: get_storage())."""
+    storage = storage or get_storage()
+    with _queues_lock:
+        if id(storage) not in _queues:
+            queue = WriteBehindQueue(storage, background=config.BACKUP_WRITE_BEHIND)
+            _queues[id(storage)] = queue
+            # Backups still queued are written when the process exits
+            atexit.register(queue.close)
+        return _queues[id(storage)]